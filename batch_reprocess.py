@@ -0,0 +1,201 @@
+from googlemaps_query_util import reprocess_csv
+from googlemaps_api_mining import GooglemapsAPIMiner
+import getopt
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import traceback
+
+
+def find_result_pairs(results_root, pickle_roots=None, prefer_journal=False):
+    """
+    Discover the query input files under a results tree and the recorded results of each: 'output_<input name>.cpkl'
+        or 'output_<input name>.journal' next to the input, or anywhere under the pickle roots (e.g., a local copy of
+        the pickles kept out of the repository). Output CSVs, logs and inputs without recorded results are skipped.
+    :param results_root: directory searched for query input files (e.g., './results')
+    :param pickle_roots: list of more directories searched for output pickles and journals
+    :param prefer_journal: T/F use the journal when both it and the pickle are found (journals are replayed a record at
+        a time, pickles are loaded whole)
+    :return: list of (query filename, results filename) in path order
+    """
+    recorded = {}
+    for root in [results_root] + (pickle_roots if pickle_roots else []):
+        for dirpath, dirnames, filenames in os.walk(root):
+            for fn in filenames:
+                stem, ext = os.path.splitext(fn)
+                if fn.startswith('output_') and ext in ('.cpkl', '.journal'):
+                    # files next to the input are found first and win over copies elsewhere
+                    recorded.setdefault((stem[len('output_'):], ext), os.path.join(dirpath, fn))
+    pairs = []
+    for dirpath, dirnames, filenames in os.walk(results_root):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            stem, ext = os.path.splitext(fn)
+            if ext != '.csv' or stem.startswith('output_') or stem.startswith('_output') or stem.endswith('_log'):
+                continue
+            local = [os.path.join(dirpath, 'output_' + stem + e) for e in ('.cpkl', '.journal')]
+            found = [lf for lf in local if os.path.exists(lf)] + \
+                [recorded[(stem, e)] for e in ('.cpkl', '.journal') if (stem, e) in recorded]
+            if not found:
+                continue
+            if prefer_journal:
+                found.sort(key=lambda f: not f.endswith('.journal'))
+            pairs.append((os.path.join(dirpath, fn), found[0]))
+    return pairs
+
+
+def output_retention(get_outputs=None, outputs_where=None):
+    """
+    Paths of results that the output columns read, for pruning results replayed from a journal to what is written.
+    :return: list of tuples of depth-wise calls (see RetentionProfile)
+    """
+    outputs = get_outputs if get_outputs else GooglemapsAPIMiner.default_outputs
+    paths = [tuple(p) for p in outputs.values()] + [tuple(p) for p in (outputs_where.keys() if outputs_where else [])]
+    # split point of split transit output falls back on where the first part of the pair ends or starts
+    return paths + [('*', 'legs', '*', 'start_location'), ('*', 'legs', '*', 'end_location')]
+
+
+def reprocess_pair(task):
+    """
+    Pool worker: write the output of one query/results pair again, with the time it took.
+    :param task: dictionary of 'query_filename', 'results_filename', 'output_dir' (None to write next to the input,
+        otherwise the input's path relative to 'results_root' is kept under it), and the keyword arguments of
+        reprocess_csv(...) in 'reprocess_args'
+    :return: dictionary of the pair, 'status' ('Success'/'Failure'), 'results', 'seconds', 'max_rss_mb' and 'error'
+    """
+    report = {'query_filename': task['query_filename'], 'results_filename': task['results_filename'],
+              'pid': os.getpid(), 'results': 0, 'error': ''}
+    original_stdout = sys.stdout
+    t0 = time.time()
+    try:
+        output_filename = None
+        if task['output_dir']:
+            relative = os.path.relpath(task['query_filename'], task['results_root'])
+            stem = os.path.splitext(relative)[0]
+            output_filename = os.path.join(task['output_dir'], os.path.dirname(stem),
+                                           'output_' + os.path.basename(stem))
+            if not os.path.isdir(os.path.dirname(output_filename)):
+                os.makedirs(os.path.dirname(output_filename))
+        if not task['verbose']:
+            # the miner prints every result it stores
+            sys.stdout = open(os.devnull, 'w')
+        report['results'] = reprocess_csv(query_filename=task['query_filename'],
+                                          results_pickle_filename=task['results_filename'],
+                                          output_filename=output_filename, **task['reprocess_args'])
+        report['status'] = 'Success'
+    except KeyboardInterrupt:
+        # pooled process should pass on Keyboard Interrupt, which will get caught by try:except on pool
+        report['status'] = 'Interrupted'
+    except BaseException as e:
+        report['status'] = 'Failure'
+        report['error'] = traceback.format_exc(e)
+    finally:
+        if sys.stdout is not original_stdout:
+            sys.stdout.close()
+            sys.stdout = original_stdout
+    report['seconds'] = time.time() - t0
+    report['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / \
+        (1048576. if sys.platform == 'darwin' else 1024.)
+    return report
+
+
+def batch_reprocess(results_root, pickle_roots=None, output_dir=None, processes=None, get_outputs=None,
+                    outputs_where=None, write_columnar=False, prefer_journal=False, verbose=False):
+    """
+    Write the output of every query/results pair found under a results tree again, on a pool of processes. Each
+        process handles one pair at a time and is replaced after it, so memory held for one pair's results goes back
+        to the system before the next. Reports are printed as each pair finishes.
+    :param results_root: directory searched for query input files (see find_result_pairs(...))
+    :param pickle_roots: list of more directories searched for output pickles and journals
+    :param output_dir: write outputs under this directory, keeping paths relative to results_root (default = None,
+        outputs are written next to their inputs, replacing them)
+    :param processes: number of processes (default = number of CPUs)
+    :param get_outputs: output columns, see GooglemapsAPIMiner.output_results(...)
+    :param outputs_where: row conditions of long output, see GooglemapsAPIMiner.output_results(...)
+    :param write_columnar: also write output columns as typed, memory-mappable arrays (see ColumnarWriter)
+    :param prefer_journal: T/F replay journals instead of loading pickles where there are both; results replayed from
+        a journal are pruned to what the output columns read as they are read
+    :param verbose: T/F show the miner's output
+    :return: list of reports from reprocess_pair(...) in the order pairs finished
+    """
+    pairs = find_result_pairs(results_root, pickle_roots=pickle_roots, prefer_journal=prefer_journal)
+    print "Found", len(pairs), "query/results pairs under", results_root
+    reprocess_args = {'get_outputs': get_outputs, 'outputs_where': outputs_where, 'write_columnar': write_columnar,
+                      'retention_profile': output_retention(get_outputs, outputs_where)}
+    tasks = [{'query_filename': qf, 'results_filename': rf, 'results_root': results_root, 'output_dir': output_dir,
+              'reprocess_args': reprocess_args, 'verbose': verbose} for qf, rf in pairs]
+    reports = []
+    if not tasks:
+        return reports
+    t0 = time.time()
+    pool = multiprocessing.Pool(processes=min(processes if processes else multiprocessing.cpu_count(), len(tasks)),
+                                maxtasksperchild=1)
+    try:
+        # largest files first, so a big one doesn't start last and hold up the end of the batch
+        tasks.sort(key=lambda t: os.path.getsize(t['results_filename']), reverse=True)
+        for report in pool.imap_unordered(reprocess_pair, tasks):
+            reports.append(report)
+            print_report(report, len(reports), len(tasks))
+        pool.close()
+    except KeyboardInterrupt:
+        print "Batch interrupted, terminating processes."
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    failed = [r for r in reports if r['status'] != 'Success']
+    print "Reprocessed %d of %d pairs in %.1f sec (%.1f sec of processing)." % \
+          (len(reports) - len(failed), len(tasks), time.time() - t0, sum([r['seconds'] for r in reports]))
+    for r in failed:
+        print "Failed:", r['query_filename'], "with", r['results_filename']
+        print r['error']
+    return reports
+
+
+def print_report(report, done, total):
+    print "[%d/%d] %-7s %8.2f sec %6d results %8.1f MB peak  %s <- %s" % \
+          (done, total, report['status'], report['seconds'], report['results'], report['max_rss_mb'],
+           report['query_filename'], report['results_filename'])
+
+
+if __name__ == '__main__':
+    usage = """
+    usage: batch_reprocess.py -r <results_root> --[pickle_roots, output_dir, processes, write_columnar, prefer_journal,
+                verbose]
+    ex: python batch_reprocess.py -r "./results" --pickle_roots "../results_local" --output_dir "./reprocessed"
+    note: --pickle_roots takes a |-delimited list of more directories to search for output pickles and journals
+    note: without --output_dir, output files next to the query inputs are replaced
+    """
+    results_root = './results'
+    pickle_roots = None
+    output_dir = None
+    processes = None
+    flags = {'write_columnar': False, 'prefer_journal': False, 'verbose': False}
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:", ["pickle_roots=", "output_dir=", "processes=",
+                                                          "write_columnar=", "prefer_journal=", "verbose="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print usage
+            sys.exit(0)
+        elif opt == "-r":
+            results_root = arg
+        elif opt == "--pickle_roots":
+            pickle_roots = arg.split('|')
+        elif opt == "--output_dir":
+            output_dir = arg
+        elif opt == "--processes":
+            processes = int(arg)
+        elif opt in ["--write_columnar", "--prefer_journal", "--verbose"]:
+            if arg.lower() not in ['true', 'false']:
+                print opt, "should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
+            flags[opt[2:]] = arg.lower() == 'true'
+
+    batch_reprocess(results_root=results_root, pickle_roots=pickle_roots, output_dir=output_dir, processes=processes,
+                    **flags)
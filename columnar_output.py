@@ -0,0 +1,177 @@
+import os
+import json
+import datetime as dt
+import numpy as np
+import pytz
+from collections import OrderedDict
+from googlemaps_query_util import localize_to_my_timezone
+
+
+class ColumnarWriter(object):
+    """
+    Typed columnar output of the rows written to the CSV output, as a directory holding one NumPy .npy file per column
+        and a columns.json file describing them. Each column can be memory-mapped on its own with
+        numpy.load(filename, mmap_mode='r') or with read_columnar(...).
+    Column types are taken from the first value that isn't empty:
+        - 'float': numbers, as float64 with NaN for empty cells
+        - 'datetime': datetimes, as datetime64[us] in UTC with NaT for empty cells (naive datetimes are taken to be in
+            the local timezone); the timezone of the first value is recorded as 'source_timezone'
+        - 'string': anything else, as int32 codes into a vocabulary file of the distinct values, code 0 being ''
+    Rows are converted and written a batch at a time into the column files, which are created at full size up front.
+        A value that doesn't fit its column's type is written as empty and counted in 'unfit_values'.
+    """
+    def __init__(self, directory, header, n_rows, batch_size=10000):
+        """
+        :param directory: directory to write the column files to (created if it doesn't exist)
+        :param header: list of column names (a repeated name, like the second leg's columns of split transit output,
+            gets '_2', '_3', ... added)
+        :param n_rows: number of rows that will be written
+        :param batch_size: number of rows to convert and write at a time
+        :return: None
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.header = []
+        for name in header:
+            unique, n = name, 1
+            while unique in self.header:
+                n += 1
+                unique = "%s_%d" % (name, n)
+            self.header.append(unique)
+        self.n_rows = n_rows
+        self.batch_size = batch_size
+        self.batch = []
+        self.rows_written = 0
+        self.kinds = [None] * len(self.header)
+        self.arrays = [None] * len(self.header)
+        self.vocabularies = [None] * len(self.header)
+        self.timezones = [None] * len(self.header)
+        self.unfit = [0] * len(self.header)
+
+    def write_row(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return
+
+    def flush(self):
+        """
+        Convert and write the rows of the current batch.
+        :return: None
+        """
+        if not self.batch:
+            return
+        assert self.rows_written + len(self.batch) <= self.n_rows, "More rows written than the columns were sized for."
+        stop = self.rows_written + len(self.batch)
+        for ci, values in enumerate(zip(*self.batch)):
+            if self.kinds[ci] is None:
+                first = next((v for v in values if v not in ('', None)), None)
+                if first is None:
+                    # still no values in this column, so it is created when the first one comes
+                    continue
+                self._open_column(ci, first)
+            self.arrays[ci][self.rows_written:stop] = self._convert(ci, values)
+        self.rows_written = stop
+        self.batch = []
+        return
+
+    def _filename(self, ci, suffix=''):
+        return "column_%03d%s.npy" % (ci, suffix)
+
+    def _open_column(self, ci, first):
+        if isinstance(first, (int, long, float)):
+            kind, dtype, empty = 'float', np.float64, np.nan
+        elif isinstance(first, dt.datetime):
+            kind, dtype, empty = 'datetime', 'datetime64[us]', np.datetime64('NaT')
+            self.timezones[ci] = getattr(first.tzinfo, 'zone', str(first.tzinfo)) if first.tzinfo else \
+                localize_to_my_timezone(first).tzinfo.zone
+        else:
+            kind, dtype, empty = 'string', np.int32, 0
+            self.vocabularies[ci] = {u'': 0}
+        self.kinds[ci] = kind
+        self.arrays[ci] = np.lib.format.open_memmap(os.path.join(self.directory, self._filename(ci)), mode='w+',
+                                                    dtype=dtype, shape=(self.n_rows,))
+        self.arrays[ci][:] = empty
+        return
+
+    def _convert(self, ci, values):
+        kind = self.kinds[ci]
+        if kind == 'float':
+            out = np.full(len(values), np.nan)
+            for vi, v in enumerate(values):
+                if isinstance(v, (int, long, float)):
+                    out[vi] = v
+                elif v not in ('', None):
+                    self.unfit[ci] += 1
+            return out
+        if kind == 'datetime':
+            out = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[us]')
+            for vi, v in enumerate(values):
+                if isinstance(v, dt.datetime):
+                    utc = (v if v.tzinfo else localize_to_my_timezone(v)).astimezone(pytz.utc)
+                    out[vi] = np.datetime64(utc.replace(tzinfo=None), 'us')
+                elif v not in ('', None):
+                    self.unfit[ci] += 1
+            return out
+        vocabulary = self.vocabularies[ci]
+        codes = np.zeros(len(values), dtype=np.int32)
+        for vi, v in enumerate(values):
+            if v in ('', None):
+                continue
+            if isinstance(v, str):
+                v = v.decode('utf-8', 'replace')
+            elif not isinstance(v, unicode):
+                v = unicode(v)
+            codes[vi] = vocabulary.setdefault(v, len(vocabulary))
+        return codes
+
+    def close(self):
+        """
+        Write the last batch, the vocabularies and columns.json, and close the column files.
+        :return: None
+        """
+        self.flush()
+        columns = []
+        for ci, name in enumerate(self.header):
+            if self.kinds[ci] is None:
+                # column with no values at all
+                self._open_column(ci, u'')
+            col = {'name': name, 'kind': self.kinds[ci], 'file': self._filename(ci)}
+            if self.kinds[ci] == 'string':
+                vocabulary = sorted(self.vocabularies[ci].items(), key=lambda x: x[1])
+                col['vocabulary_file'] = self._filename(ci, '_vocabulary')
+                np.save(os.path.join(self.directory, col['vocabulary_file']),
+                        np.array([v for v, _ in vocabulary], dtype=np.unicode_))
+            elif self.kinds[ci] == 'datetime':
+                col['timezone'] = 'UTC'
+                col['source_timezone'] = self.timezones[ci]
+            if self.unfit[ci]:
+                col['unfit_values'] = self.unfit[ci]
+            columns.append(col)
+            self.arrays[ci].flush()
+        self.arrays = [None] * len(self.header)
+        with open(os.path.join(self.directory, 'columns.json'), 'w') as f:
+            json.dump({'rows': self.rows_written, 'columns': columns}, f, indent=1)
+        return
+
+
+def read_columnar(directory, mmap_mode='r', decode_strings=True):
+    """
+    Load columnar output written by ColumnarWriter, memory-mapping the column files.
+    :param directory: directory holding columns.json and the column files
+    :param mmap_mode: numpy.load(...) memory-map mode, None to read the columns into memory
+    :param decode_strings: T/F give string columns as arrays of their values; if False, they are given as tuples of
+        (int32 codes, vocabulary array) and stay memory-mapped
+    :return: ordered dictionary of column name to array
+    """
+    with open(os.path.join(directory, 'columns.json'), 'r') as f:
+        meta = json.load(f)
+    table = OrderedDict()
+    for col in meta['columns']:
+        values = np.load(os.path.join(directory, col['file']), mmap_mode=mmap_mode)[:meta['rows']]
+        if col['kind'] == 'string':
+            vocabulary = np.load(os.path.join(directory, col['vocabulary_file']))
+            values = vocabulary[values] if decode_strings else (values, vocabulary)
+        table[col['name']] = values
+    return table
@@ -11,8 +11,16 @@ import getopt
 from inspect import getargspec
 import multiprocessing
 from copy import copy
+from multiprocessing.pool import ThreadPool
 import protect
+from result_journal import ResultJournal, QueueJournal
+from columnar_output import ColumnarWriter
+from station_cache import StationCache
+from key_pool import KeyPool
 import string
+import math
+import Queue
+import resource
 
 
 class GooglemapsAPIMiner:
@@ -20,7 +28,27 @@ class GooglemapsAPIMiner:
     Full execution class to call Google Maps Python API (googlemaps) using an input query list and outputting results
         in the form of CSV and Python pickle objects.
     """
-    def __init__(self, api_key_file, execute_in_time=False, split_transit=False, queries_per_second=1, password=None):
+    # output columns when output_results(...) isn't given get_outputs
+    default_outputs = {'distance_m': (0, 'legs', 0, 'distance', 'value'),
+                       'duration-sec': (0, 'legs', 0, 'duration', 'value'),
+                       'duration_in_traffic-sec': (0, 'legs', 0, 'duration_in_traffic', 'value'),
+                       'start_x': (0, 'legs', 0, 'start_location', 'lng'),
+                       'start_y': (0, 'legs', 0, 'start_location', 'lat'),
+                       'end_x': (0, 'legs', 0, 'end_location', 'lng'),
+                       'end_y': (0, 'legs', 0, 'end_location', 'lat')}
+
+    # Distance Matrix limits per request (origins or destinations, and origins x destinations)
+    matrix_max_locations = 25
+    matrix_max_elements = 100
+    matrix_modes = ['driving', 'walking', 'bicycling']
+
+    # when results aren't journaled, one in this many pruned results is pickled to measure its sizes for memory_report()
+    size_sample_interval = 50
+
+    def __init__(self, api_key_file, execute_in_time=False, split_transit=False, queries_per_second=1, password=None,
+                 concurrent_requests=1, distance_matrix=False, station_cache_file=None, places_query_limit=90,
+                 pool_api_key_files=None, directions_quota=None, places_quota=None, retention_profile=None,
+                 quota_share=1.):
         """
         Initialize API miner with API key to the Google Maps service. Create empty class variables for reading input
             and executing queries.
@@ -28,21 +56,75 @@ class GooglemapsAPIMiner:
         :param execute_in_time: wait until the departure time indicated to execute the query as departure_time='now'
         :param queries_per_second: limit sent to googlemaps module (default = 10 q/s), can also be changed with delay
             parameter in run_queries() function
+        :param concurrent_requests: number of Directions requests kept in flight at once (default = 1, sequential);
+            all requests share a token bucket that holds them to queries_per_second
+        :param distance_matrix: pack consecutive driving/walking/bicycling queries that differ only in origin and
+            destination into Distance Matrix requests, with results returned as one-leg routes (distance and duration
+            only); not used when executing in time
+        :param station_cache_file: path of a SQLite file caching the transit stations found for split queries, shared
+            by parallel processes and later runs (default = None, stations are cached for this run only)
+        :param places_query_limit: number of Places searches per API key beyond which transit queries are no longer
+            split (stations already cached are still used), so a key pool gets this many from each key; None for no
+            limit
+        :param pool_api_key_files: list of paths to more API key files (same password) to use alongside api_key_file as
+            a key pool - each call goes to the key with the most quota left and fails over on OVER_QUERY_LIMIT, and
+            queries_per_second applies to each key
+        :param directions_quota: daily Directions requests allowed per pooled key (default = None, unlimited)
+        :param places_quota: daily Places requests allowed per pooled key (default = None, unlimited)
+        :param retention_profile: parts of each result to keep as it arrives - name in retention_profiles ('summary',
+            'transit'), list of paths to keep (see RetentionProfile), or None/'full' to keep full results (default); the
+            results journaled and written to pickle are the pruned ones, see run_pipeline(archive_raw=...)
+        :param quota_share: fraction of each key's quotas and of places_query_limit this miner may use, for processes
+            that share keys (default = 1., the whole quota)
         :return: None
         """
-        if api_key_file:
-            if not password:
-                password = raw_input("Type API key decoding password and press Enter...")
+        key_files = ([api_key_file] if api_key_file else []) + (pool_api_key_files if pool_api_key_files else [])
+        if key_files and not password:
+            password = raw_input("Type API key decoding password and press Enter...")
+        if pool_api_key_files:
+            keys = [protect.decode(key=password, string=open(kf, 'r').read()) for kf in key_files]
+            quotas = {'directions': directions_quota, 'places': places_quota}
+            self.gmaps = KeyPool(keys=keys, queries_per_second=queries_per_second,
+                                 quotas={k: int(v * quota_share) if v is not None else None
+                                         for k, v in quotas.iteritems()})
+            print "Loaded pool of", len(keys), "API keys."
+        elif api_key_file:
             mykey = protect.decode(key=password, string=open(api_key_file, 'r').read())
             self.gmaps = googlemaps.Client(key=mykey, queries_per_second=queries_per_second)
         else:
             self.gmaps = None
         self.places_query_count = 0
+        # limit for the run, from the limit per key
+        if places_query_limit is not None:
+            self.places_query_limit = int(places_query_limit * max(len(key_files), 1) * quota_share)
+        else:
+            self.places_query_limit = None
         self.directions_query_count = 0
+        self.distance_matrix = distance_matrix
+        self.distance_matrix_query_count = 0
+        # shared by all request threads so that concurrent execution stays within the query quota
+        self.concurrent_requests = max(int(concurrent_requests), 1)
+        # with a key pool, each key also has its own bucket and the total rate scales with the number of keys
+        self.rate_limiter = TokenBucket(rate=queries_per_second * max(len(key_files), 1))
+        self.count_lock = threading.Lock()
         self.execute_in_time = execute_in_time
         self.split_transit = split_transit
         self.results = []
         self.queries = None
+        # generator of input queries not yet loaded into self.queries when streaming input
+        self.pending_queries = None
+        self.input_query_count = 0
+        # parsed input rows, from which any input query can be built again by its id (see input_query(...))
+        self.input_specs = None
+        # when streaming, executed input queries are dropped and the ids of results (unless split) are kept instead
+        self.streaming = False
+        self.result_ids = None
+        # id lookups kept alongside self.queries and self.results - query id -> query, id stub -> result group
+        self.query_index = {}
+        self.result_index = {}
+        # append-only record of results for resuming, opened by run_pipeline(...); ids restored from it are skipped
+        self.journal = None
+        self.completed_ids = set()
         self.input_header = None
         self.saved_input_filename = None
         self.start_time = dt.datetime.now()
@@ -51,9 +133,27 @@ class GooglemapsAPIMiner:
         self.split_cache = {}
         # keys are (long, lat) locations
         self.split_reverse_cache = {}
+        # spatial index over the keys of split_reverse_cache, brought up to date by find_split_point(...)
+        self.split_index = None
+        self.split_index_source = None
+        # stations found on earlier runs or by other processes, keyed on polyline and station type
+        if station_cache_file:
+            self.station_cache = StationCache(station_cache_file)
+        else:
+            self.station_cache = None
+        if retention_profile and retention_profile != 'full':
+            self.retention = RetentionProfile(retention_profile)
+        else:
+            self.retention = None
+        # full responses of pruned results, written as journal records by run_pipeline(archive_raw=True)
+        self.raw_archive = None
+        # pickled bytes of results received and retained for memory_report(), taken from the records written to the raw
+        #   archive and journal, or measured on one in size_sample_interval results where they aren't written
+        self.pruned_result_count = 0
+        self.result_bytes = {'raw': [0, 0], 'retained': [0, 0]}
         return
 
-    def read_input_queries(self, input_filename, verbose=False):
+    def read_input_queries(self, input_filename, verbose=False, lazy=False):
         """
         Reads CSV file with header to get list of queries. Some columns are direct and some are range parameters.
         See README.txt for more information on each and tips on formatting input documents.
@@ -73,8 +173,12 @@ class GooglemapsAPIMiner:
             - departure_time (departure_time_min, departure_time_max, departure_time_delta)
             - origin [must be in lat/long] (origin_min, origin_max, origin_delta)
             - destination [must be in lat/long] (destination_min, destination_max, destination_delta]
+        Each row is validated once and its range parameters are expanded by a generator, so the number of queries is
+            known without building them and ids are assigned in a fixed order.
         :param input_filename: absolute or relative path for input file (will be saved for possible use in output)
         :param verbose: T/F to print loaded queries
+        :param lazy: T/F leave queries in a generator that run_queries() draws from as it executes, instead of building
+            the full list up front (not available when executing in time, which needs every query to order them)
         :return: None
         """
         # Valid range parameters
@@ -91,17 +195,17 @@ class GooglemapsAPIMiner:
             if not all([h in valid_args for h in self.input_header]):
                 print "Invalid:", set(self.input_header).difference(set(valid_args))
                 raise IOError("Header contains invalid columns/arguments.")
-            self.queries = [{h: v for h, v in zip(self.input_header, [re.strip() for re in row])
-                             if v is not None and v != ''}
-                            for row in input_reader if not row[0].startswith('#')]
+            rows = [{h: v for h, v in zip(self.input_header, [re.strip() for re in row])
+                     if v is not None and v != ''}
+                    for row in input_reader if not row[0].startswith('#')]
 
         # make sure all required parameters are present
-        assert all(['origin' in q or 'origin_min' in q for q in self.queries]), \
+        assert all(['origin' in q or 'origin_min' in q for q in rows]), \
             "Origin point must be supplied for all queries."
-        assert all(['destination' in q or 'destination_min' in q for q in self.queries]), \
+        assert all(['destination' in q or 'destination_min' in q for q in rows]), \
             "Destination point must be supplied for all queries."
-        assert all(['mode' in q for q in self.queries]), "Mode must be supplied for all queries."
-        assert all(['timezone' in q for q in self.queries]), "Timezone must be supplied for all queries."
+        assert all(['mode' in q for q in rows]), "Mode must be supplied for all queries."
+        assert all(['timezone' in q for q in rows]), "Timezone must be supplied for all queries."
 
         # Keep input filename in case output filename goes to default ('output_' + input filename).
         if os.path.split(input_filename)[0] == '':
@@ -109,135 +213,35 @@ class GooglemapsAPIMiner:
         else:
             self.saved_input_filename = input_filename
 
-        # Parse out '|'-delimited waypoints, if supplied.
-        # Also assign 'id' field to each
-        for q in self.queries:
-            if 'waypoints' in q:
-                q['waypoints'] = q['waypoints'].split('|')
+        # Parse direct parameters and range specifications, dropping invalid rows.
+        specs = [spec for spec in (self._parse_input_row(q) for q in rows) if spec is not None]
+        self.input_specs = specs
+        self.input_query_count = sum([reduce(lambda a, b: a * b, [len(v) for p, v in axes], 1)
+                                      for stage, base, axes in specs])
 
-        # Track the list indices of queries with range parameters for removal later.
-        remove_indices = []
-        # Change range parameters to direct parameters.
-        for r in date_rp[0]:
-            rs = [r + suf for suf in date_rp[1]]
-            for q in self.queries:
-                if any([ri in q for ri in rs]):
-                    # make sure all required range parameters are present
-                    if not all([ri in q for ri in rs]):
-                        print "Range param", r, "needs", date_rp[1]
-                        print q
-                        remove_indices.append(self.queries.index(q))
-                        continue
+        # Redefine input header to remove columns that are unused or no longer needed (e.g., range parameters)
+        # This will be used later in output files.
+        self.input_header = [ihi for ihi in list(set(chain(*[tuple(base.keys()) + tuple([p for p, v in axes])
+                                                               for stage, base, axes in specs]))) if ihi != 'id']
 
-                    try:
-                        rmin = dt.datetime.strptime(q[r + '_min'], '%m/%d/%Y %H:%M')
-                        rmax = dt.datetime.strptime(q[r + '_max'], '%m/%d/%Y %H:%M')
-                        rdel = dt.timedelta(minutes=int(q[r + '_delta']))
-                    except ValueError:
-                        print "Problem with query format on a range parameter (couldn't convert to datetime)."
-                        print q
-                        remove_indices.append(self.queries.index(q))
-                        continue
-                    assert rmax > rmin, "Max time is not greater than min time."
-
-                    i = 0
-                    while rmin + i * rdel <= rmax:
-                        qn = {}
-                        for k, v in q.items():
-                            if k not in [r] + rs:
-                                qn[k] = v
-                        qn[r] = rmin + i * rdel
-                        self.queries.append(qn)
-                        i += 1
-                    remove_indices.append(self.queries.index(q))
-
-                # now parse out non-range parameters
-                elif r in q:
-                    if not self.execute_in_time:
-                        # wait until execution time to put datetime.now() in for 'now' if not executing in time
-                        # doesn't matter because sorting doesn't occur when not executing in time
-                        if type(q[r]) is str and q[r].lower() != 'now':
-                            try:
-                                q[r] = dt.datetime.strptime(q[r], '%m/%d/%Y %H:%M')
-                            except ValueError:
-                                print "Problem with query format on", r, "(couldn't convert to datetime)"
-                                print q
-                                remove_indices.append(self.queries.index(q))
-                        elif type(q[r]) is str and q[r].lower() == 'now':
-                            pass
-                    else:
-                        # if executing in time, then put datetime.now() in for the moment
-                        # later it will get caught as slightly in the past and moved up to datetime.now() again
-                        if type(q[r]) is str and q[r].lower() == 'now':
-                            q[r] = dt.datetime.now()
-                            # assign local timezone
-                            q['timezone'] = mytz
-
-        # Remove queries that contained range parameters.
-        if remove_indices:
-            self.queries = [self.queries[j] for j in range(len(self.queries)) if j not in remove_indices]
-        remove_indices = []
-
-        # add timezone to all datetime query parameters
-        for q in self.queries:
-            qtz = q['timezone']
-            for r in date_rp[0] + [ri[0] + ri[1] for ri in product(date_rp[0], date_rp[1])]:
-                if r in q and type(q[r]) is dt.datetime:
-                    q[r] = convert_to_my_timezone(localize_to_query_timezone(time_in_query=q[r], timezone_in_query=qtz))
+        if lazy and self.execute_in_time:
+            print "Queries executed in time must all be loaded to be ordered; not streaming input."
+            lazy = False
+        self.streaming = lazy
+        self.result_ids = [] if lazy and not self.split_transit else None
+        if lazy:
+            self.queries = []
+            self.pending_queries = self._expand_input_rows(specs)
+            self.index_queries()
+            print "Streaming", self.input_query_count, "API queries."
+            return
 
-        for l in loc_rp[0]:
-            rs = [l + suf for suf in loc_rp[1]]
-            for q in self.queries:
-                if any([ri in q for ri in rs]):
-                    if not all([ri in q for ri in rs]):
-                        print "Range param", l, "needs", loc_rp[1]
-                        print q
-                        remove_indices.append(self.queries.index(q))
-                        continue
-                    rmin = (float(q[l + '_min'].split(';')[0]), float(q[l + '_min'].split(';')[1]))
-                    rmax = (float(q[l + '_max'].split(';')[0]), float(q[l + '_max'].split(';')[1]))
-                    rdiv = (int(q[l + '_count'].split(';')[0]), int(q[l + '_count'].split(';')[1]))
-                    rarr = q[l + '_arrange']
-                    rdel = ((rmax[0] - rmin[0]) / (rdiv[0] - 1), (rmax[1] - rmin[1]) / (rdiv[1] - 1))
-                    rvals = ([rmin[0] + i * rdel[0] for i in range(rdiv[0])],
-                             [rmin[1] + i * rdel[1] for i in range(rdiv[1])])
-                    if rarr == 'line':
-                        rq = zip(rvals[0], rvals[1])
-                    elif rarr == 'grid':
-                        rq = [i for i in product(rvals[0], rvals[1])]
-                    else:
-                        print "Invalid arrangement argument. Use 'line' or 'grid'."
-                        print q
-                        remove_indices.append(self.queries.index(q))
-                        continue
-                    for rv in rq:
-                        qn = {}
-                        for k, v in q.items():
-                            if k not in [l] + rs:
-                                qn[k] = v
-                        qn[l] = rv
-                        self.queries.append(qn)
-                    remove_indices.append(self.queries.index(q))
-                else:
-                    if ';' in q[l]:
-                        try:
-                            q[l] = tuple([float(i) for i in q[l].split(';')])
-                        except ValueError:
-                            print "Problem with query format on", l, "(';' included but couldn't convert to lat/long)"
-                            print q
-                            remove_indices.append(self.queries.index(q))
-        # Remove queries that contained range parameters.
-        if remove_indices:
-            self.queries = [self.queries[j] for j in range(len(self.queries)) if j not in remove_indices]
-        for q in self.queries:
-            q['id'] = "{0:0>4}0000-0".format(self.queries.index(q))
+        self.queries = list(self._expand_input_rows(specs))
+        self.pending_queries = None
+        self.index_queries()
         if verbose:
             for i in self.queries:
                 print i
-
-        # Redefine input header to remove columns that are unused or no longer needed (e.g., range parameters)
-        # This will be used later in output files.
-        self.input_header = [ihi for ihi in list(set(chain(*[tuple(q.keys()) for q in self.queries]))) if ihi != 'id']
         # Sort queries for execution in order.
         if self.execute_in_time:
             assert not any(['arrival_time' in q for q in self.queries]), "Can't use arrival_time with execute_in_time."
@@ -245,9 +249,191 @@ class GooglemapsAPIMiner:
         print "Loaded", len(self.queries), "API queries."
         return
 
+    def _parse_input_row(self, q):
+        """
+        Validate one input row, convert its direct parameters and turn its range parameters into value sequences.
+        :param q: dictionary of (string) values from one row of the input file
+        :return: tuple of (ordering stage, base query, list of (parameter, values) ranges), None if the row is invalid
+        """
+        date_rp = (['arrival_time', 'departure_time'], ['_min', '_max', '_delta'])
+        loc_rp = (['origin', 'destination'], ['_min', '_max', '_count', '_arrange'])
+        q = dict(q)
+        # Parse out '|'-delimited waypoints, if supplied.
+        if 'waypoints' in q:
+            q['waypoints'] = q['waypoints'].split('|')
+
+        date_axes = []
+        date_stage = 0
+        for ri, r in enumerate(date_rp[0]):
+            rs = [r + suf for suf in date_rp[1]]
+            if any([rsi in q for rsi in rs]):
+                # make sure all required range parameters are present
+                if not all([rsi in q for rsi in rs]):
+                    print "Range param", r, "needs", date_rp[1]
+                    print q
+                    return None
+                try:
+                    rmin = dt.datetime.strptime(q[r + '_min'], '%m/%d/%Y %H:%M')
+                    rmax = dt.datetime.strptime(q[r + '_max'], '%m/%d/%Y %H:%M')
+                    rdel = dt.timedelta(minutes=int(q[r + '_delta']))
+                except ValueError:
+                    print "Problem with query format on a range parameter (couldn't convert to datetime)."
+                    print q
+                    return None
+                assert rmax > rmin, "Max time is not greater than min time."
+                rvals = []
+                i = 0
+                while rmin + i * rdel <= rmax:
+                    rvals.append(convert_to_my_timezone(localize_to_query_timezone(time_in_query=rmin + i * rdel,
+                                                                                   timezone_in_query=q['timezone'])))
+                    i += 1
+                date_axes.append((r, rvals))
+                date_stage = ri + 1
+                for k in [r] + rs:
+                    q.pop(k, None)
+            # now parse out non-range parameters
+            elif r in q and type(q[r]) is str:
+                if q[r].lower() == 'now':
+                    if self.execute_in_time:
+                        # if executing in time, then put datetime.now() in for the moment
+                        # later it will get caught as slightly in the past and executed immediately
+                        q[r] = dt.datetime.now()
+                        # assign local timezone
+                        q['timezone'] = mytz.zone
+                    # otherwise wait until execution time to put datetime.now() in for 'now'
+                else:
+                    try:
+                        q[r] = dt.datetime.strptime(q[r], '%m/%d/%Y %H:%M')
+                    except ValueError:
+                        print "Problem with query format on", r, "(couldn't convert to datetime)"
+                        print q
+                        return None
+                if type(q[r]) is dt.datetime:
+                    q[r] = convert_to_my_timezone(localize_to_query_timezone(time_in_query=q[r],
+                                                                             timezone_in_query=q['timezone']))
+
+        loc_axes = []
+        loc_stage = 0
+        for li, l in enumerate(loc_rp[0]):
+            rs = [l + suf for suf in loc_rp[1]]
+            if any([rsi in q for rsi in rs]):
+                if not all([rsi in q for rsi in rs]):
+                    print "Range param", l, "needs", loc_rp[1]
+                    print q
+                    return None
+                rmin = (float(q[l + '_min'].split(';')[0]), float(q[l + '_min'].split(';')[1]))
+                rmax = (float(q[l + '_max'].split(';')[0]), float(q[l + '_max'].split(';')[1]))
+                rdiv = (int(q[l + '_count'].split(';')[0]), int(q[l + '_count'].split(';')[1]))
+                rarr = q[l + '_arrange']
+                rdel = ((rmax[0] - rmin[0]) / (rdiv[0] - 1), (rmax[1] - rmin[1]) / (rdiv[1] - 1))
+                rvals = ([rmin[0] + i * rdel[0] for i in range(rdiv[0])],
+                         [rmin[1] + i * rdel[1] for i in range(rdiv[1])])
+                if rarr == 'line':
+                    loc_axes.append((l, zip(rvals[0], rvals[1])))
+                elif rarr == 'grid':
+                    loc_axes.append((l, [i for i in product(rvals[0], rvals[1])]))
+                else:
+                    print "Invalid arrangement argument. Use 'line' or 'grid'."
+                    print q
+                    return None
+                loc_stage += li + 1
+                for k in [l] + rs:
+                    q.pop(k, None)
+            elif ';' in q[l]:
+                try:
+                    q[l] = tuple([float(i) for i in q[l].split(';')])
+                except ValueError:
+                    print "Problem with query format on", l, "(';' included but couldn't convert to lat/long)"
+                    print q
+                    return None
+        # queries expanded from a location range came after those expanded only on time, which came after direct
+        #   queries - this order is kept so that ids match those given by earlier versions
+        return (loc_stage, date_stage), q, date_axes + loc_axes
+
+    def _expand_input_rows(self, specs):
+        """
+        Generate the queries of parsed input rows in order, expanding range parameters and assigning ids.
+        :param specs: list of (ordering stage, base query, ranges) from _parse_input_row(...)
+        :return: generator of query dictionaries
+        """
+        qi = 0
+        for stage in sorted(set([s[0] for s in specs])):
+            for st, base, axes in specs:
+                if st != stage:
+                    continue
+                params = [p for p, v in axes]
+                for values in product(*[v for p, v in axes]):
+                    qn = dict(base)
+                    qn.update(zip(params, values))
+                    qn['id'] = "{0:0>4}0000-0".format(qi)
+                    qi += 1
+                    yield qn
+
+    def input_query(self, qid):
+        """
+        Build an input query again from the parsed input rows, as _expand_input_rows(...) gave it, for an executed
+            query that wasn't kept in memory when streaming input.
+        :param qid: id of the input query
+        :return: query dictionary
+        """
+        qi = query_id_key(qid)[0]
+        specs = self.input_specs if self.input_specs else []
+        for stage in sorted(set([s[0] for s in specs])):
+            for st, base, axes in specs:
+                if st != stage:
+                    continue
+                count = reduce(lambda a, b: a * b, [len(v) for p, v in axes], 1)
+                if qi >= count:
+                    qi -= count
+                    continue
+                qn = dict(base)
+                # the last range varies fastest in itertools.product(...)
+                for p, v in reversed(axes):
+                    qn[p] = v[qi % len(v)]
+                    qi //= len(v)
+                qn['id'] = qid
+                return qn
+        raise KeyError("Query %s is not in the input." % qid)
+
+    def _load_pending(self, n):
+        """
+        Move up to n queries from a streamed input into self.queries (skipping any completed in a resumed run).
+        :param n: number of queries to load
+        :return: number of queries loaded
+        """
+        if self.pending_queries is None:
+            return 0
+        loaded = 0
+        for q in self.pending_queries:
+            if q['id'] in self.completed_ids:
+                continue
+            self.queries.append(q)
+            self.query_index[q['id']] = q
+            loaded += 1
+            if loaded >= n:
+                break
+        else:
+            self.pending_queries = None
+        return loaded
+
+    def index_queries(self):
+        """
+        Rebuild the id lookups (query id -> query, id stub -> result group) from self.queries and self.results. Called
+            by read_input_queries(...); call again after assigning queries or results directly (e.g., from a pickle).
+        :return: None
+        """
+        self.query_index = {q['id']: q for q in self.queries if 'id' in q} if self.queries else {}
+        if self.split_transit:
+            self.result_index = {res[0]: res for res in self.results if res}
+        else:
+            self.result_index = {}
+        return
+
     def run_queries(self, verbose=False, verbose_split=False, here_are_the_queries=None):
         """
-        Sequentially executes previously-loaded queries stored in class variable self.queries.
+        Executes previously-loaded queries stored in class variable self.queries. When executing in time, queries are
+            released from a time-ordered scheduler as they come due; otherwise they are executed in list order. Up to
+            concurrent_requests queries are in flight at once and results are stored in query order.
         :param verbose: runs recursive print (for legible indention) on each query result
         :param verbose_split:
         :param here_are_the_queries: list of queries for execution - will return results instead of storing
@@ -261,193 +447,745 @@ class GooglemapsAPIMiner:
         else:
             queries = self.queries
 
+        if self.execute_in_time:
+            successes = self._run_queries_in_time(queries=queries, local_results=local_results, verbose=verbose,
+                                                  verbose_split=verbose_split,
+                                                  store_locally=bool(here_are_the_queries))
+        else:
+            successes = self._run_queries_in_waves(queries=queries, local_results=local_results, verbose=verbose,
+                                                   verbose_split=verbose_split,
+                                                   store_locally=bool(here_are_the_queries))
+        print "Executed", successes, "queries successfully."
+        if here_are_the_queries:
+            return local_results
+        else:
+            return
+
+    def run_queries_on_workers(self, workers, task_size=10, verbose=False, verbose_split=False):
+        """
+        Execute previously-loaded queries on a set of worker processes, each with its own miner (and API key), and merge
+            their results here as though they were executed in this process. Queries are handed out from a shared queue
+            in tasks of task_size, so faster workers take more of them; the pair queries of a split transit trip are
+            always in the same task, and a full query's split queries are executed by the worker that split it.
+            Results are journaled as they arrive and put in query id order at the end.
+        :param workers: list of dictionaries, one per worker process, with 'init_args' for its GooglemapsAPIMiner and
+            optionally 'queries_per_second' to override its rate (e.g., for workers sharing a key)
+        :param task_size: number of queries (or split pairs) per task
+        :param verbose: runs recursive print on each query result
+        :param verbose_split: T/F to print transit split process
+        :return: None
+        """
+        assert not self.execute_in_time, "Can't execute in time on worker processes."
+        tasks = multiprocessing.Queue(2 * len(workers))
+        records = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=coordinated_worker,
+                                             args=(w, tasks, records, verbose, verbose_split)) for w in workers]
+        for p in processes:
+            p.daemon = True
+            p.start()
+        print "Started", len(processes), "worker processes."
+        # ids of stored results in the order they are stored (results of a resumed run come first)
+        if self.result_ids is not None:
+            result_ids = self.result_ids
+        else:
+            result_ids = [q['id'] for q in self.queries[:len(self.results)]] if not self.split_transit else []
+        task_gen = self._worker_tasks(task_size)
+        next_task = next(task_gen, None)
+        stops_sent = 0
+        finished = 0
+        try:
+            while finished < len(processes):
+                # keep the task queue topped up, then tell each worker to stop once the tasks run out
+                while next_task is not None and not tasks.full():
+                    tasks.put(next_task)
+                    next_task = next(task_gen, None)
+                while next_task is None and stops_sent < len(processes) and not tasks.full():
+                    tasks.put(None)
+                    stops_sent += 1
+                try:
+                    record = records.get(True, 0.1)
+                except Queue.Empty:
+                    if not any([p.is_alive() for p in processes]) and records.empty():
+                        print "Worker processes stopped before reporting completion."
+                        break
+                    continue
+                if record[0] == 'done':
+                    finished += 1
+                    self.directions_query_count += record[1]['directions']
+                    self.distance_matrix_query_count += record[1]['distance_matrix']
+                    self.places_query_count += record[1]['places']
+                    print "Worker", record[1]['pid'], "finished:", record[1]['directions'], "Directions queries."
+                elif record[0] == 'failed':
+                    finished += 1
+                    print "Worker", record[1], "failed:"
+                    print record[2]
+                else:
+                    self._merge_worker_record(record, result_ids)
+                if self.journal is not None:
+                    self.journal.sync()
+        finally:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+        # put results in query id order, as a single process would have (split queries after all input queries)
+        if self.split_transit:
+            self.results.sort(key=lambda r: (query_id_key(r[0])[1] != 0, query_id_key(r[0])))
+            self.queries.sort(key=lambda q: (query_id_key(q['id'])[1] != 0, query_id_key(q['id'])))
+        else:
+            order = sorted(range(len(result_ids)), key=lambda i: query_id_key(result_ids[i]))
+            self.results = [self.results[i] for i in order]
+            if self.result_ids is not None:
+                self.result_ids = [result_ids[i] for i in order]
+                self.queries = []
+            else:
+                self.queries = [self.query_index[result_ids[i]] for i in order]
+        self.index_queries()
+        print "Merged results of", len(self.results), "queries from", len(processes), "workers."
+        return
+
+    def _worker_tasks(self, task_size):
+        """
+        Group queries not yet completed into tasks for worker processes, keeping split pairs together.
+        :param task_size: number of queries (or split pairs) per task
+        :return: generator of lists of queries
+        """
+        # split queries only come up when resuming - group them on their id without the '-1'/'-2'
+        units = {}
+        order = []
+        for q in self.queries:
+            if q['id'] in self.completed_ids:
+                continue
+            if q['id'][:-2] not in units:
+                units[q['id'][:-2]] = []
+                order.append(q['id'][:-2])
+            units[q['id'][:-2]].append(q)
+        streamed = []
+        if self.pending_queries is not None:
+            streamed = ([q] for q in self.pending_queries if q['id'] not in self.completed_ids)
+        task = []
+        for unit in chain((units[u] for u in order), streamed):
+            task.extend(unit)
+            if len(task) >= task_size:
+                yield task
+                task = []
+        if task:
+            yield task
+
+    def _merge_worker_record(self, record, result_ids):
+        """
+        Apply a journal record received from a worker process: store results, add or update split queries, and
+            cache stations, journaling each as in a single-process run.
+        :param record: journal record tuple (see ResultJournal)
+        :param result_ids: ids of stored results in order, appended to for each result
+        :return: None
+        """
+        if record[0] == 'result':
+            qid, query, q_result = record[1:]
+            self._restore_query(query)
+            self._store_result(qid=qid, q_result=q_result, local_results=None, store_locally=False)
+            # (stored results' ids are already kept when streaming)
+            if not self.split_transit and result_ids is not self.result_ids:
+                result_ids.append(qid)
+        elif record[0] == 'query':
+            self._restore_query(record[1])
+            if self.journal is not None:
+                self.journal.write_query(record[1])
+        elif record[0] == 'remove':
+            removed = self.query_index.pop(record[1], None)
+            if removed is not None:
+                self.queries = [q for q in self.queries if q is not removed]
+            if self.journal is not None:
+                self.journal.write_removal(record[1])
+        elif record[0] == 'stations':
+            polyline, stations, rev_lookup, places_count = record[1:]
+            self.split_cache[polyline] = stations
+            self.split_reverse_cache.update(rev_lookup)
+            if self.journal is not None:
+                self.journal.write_stations(polyline=polyline, stations=stations, reverse_lookup=rev_lookup,
+                                            places_queries=places_count)
+        return
+
+    def _run_queries_in_waves(self, queries, local_results, verbose, verbose_split, store_locally):
+        """
+        Executes queries in list order. With concurrent_requests > 1, waves of up to 4 * concurrent_requests queries
+            are executed on a thread pool; every request takes a token from the shared rate limiter, so throughput is
+            bound by queries_per_second rather than by round-trip latency. Results are handled in query order on the
+            calling thread. Split queries added during execution are appended and run in later waves, and a wave never
+            holds the second query of a split pair together with the first (its time depends on the first). Streamed
+            input is drawn into self.queries a wave at a time as the list runs out. With distance_matrix, consecutive
+            queries that can share a Distance Matrix request are packed into one request of the wave.
+        :return: number of successful queries
+        """
         successes = 0
-        # run while loop with index, emulating for loop, so that items can be added to the list during looping
-        # persistent sorting of list and nature of query additions ensures that additions happen after the current index
-        qi = 0
-        while qi < len(queries):
-            # dump results to file if it has been more than 24 hours since last start time
-            if dt.datetime.now() > self.start_time + dt.timedelta(hours=1):
-                print "Dumping results to file before continuing."
-                self.output_results()
-                self.start_time = dt.datetime.now()
-
-            q = queries[qi]
-            # the query that gets executed can't have an invalid column - 'id' will be handled later
-            # the departure_time will get changed temporarily here so that sorting will not be broken
-            qe = {k: v for k, v in q.items() if k not in ['timezone', 'split_on_leg', 'drive_leg', 'id']}
-            qi += 1
-
-            # if substituting dt.datetime.now() then it can't be put into query, bc sort will break
-            # proxy_time = None
-
-            # handle 'now' value in departure_time
-            if 'departure_time' in q:
-                # q[tt] should have already been converted to dt.datetime unless it is 'now' (and execute_in_time False)
-                if type(q['departure_time']) is str and q['departure_time'].lower() == 'now':
-                    qe['departure_time'] = localize_to_my_timezone(dt.datetime.now())
-                    # proxy_time = localize_to_my_timezone(dt.datetime.now())
-                # if 'now' was in departure_time and execute_in_time was True, then the parameter will be slightly in
-                #   the past since it was put in as datetime.now() at the time of query input processing
-                if q['departure_time'] < localize_to_my_timezone(dt.datetime.now() - dt.timedelta(minutes=10)):
-                    raise AssertionError("Query departure time too far in past. Will tolerate up to 10 minutes.")
-                elif q['departure_time'] < localize_to_my_timezone(dt.datetime.now()):
-                    # might get a bit behind departure time if queries have same time
-                    qe['departure_time'] = localize_to_my_timezone(dt.datetime.now())
-                    # proxy_time = localize_to_my_timezone(dt.datetime.now())
+        # only the main query list is fed from a streamed input
+        streamed = not store_locally and queries is self.queries
+        if self.concurrent_requests > 1:
+            pool = ThreadPool(self.concurrent_requests)
+            wave_size = 4 * self.concurrent_requests
+        else:
+            pool = None
+            wave_size = 1
+        try:
+            qi = 0
+            while qi < len(queries) or (streamed and self._load_pending(wave_size)):
+                self._periodic_dump()
+                wave = []
+                wave_ids = set()
+                # each request of the wave is (Distance Matrix batch key or None, indices of its queries in the wave)
+                requests = []
+                while qi < len(queries) or (streamed and self._load_pending(wave_size)):
+                    q = queries[qi]
+                    if not store_locally and q['id'] in self.completed_ids:
+                        qi += 1
+                        continue
+                    if self.split_transit and not store_locally and q['id'].endswith('-2') \
+                            and q['id'][:-1] + '1' in wave_ids:
+                        break
+                    key = self._matrix_key(q) if self.distance_matrix and not store_locally else None
+                    if key is not None and requests and requests[-1][0] == key \
+                            and self._matrix_fits([wave[i] for i in requests[-1][1]] + [q]):
+                        requests[-1][1].append(len(wave))
+                    elif len(requests) < wave_size:
+                        requests.append((key, [len(wave)]))
+                    else:
+                        break
+                    wave.append(q)
+                    if not store_locally:
+                        wave_ids.add(q['id'])
+                    qi += 1
+                if any([key is not None for key, indices in requests]):
+                    requests = self._matrix_requests(wave, requests)
+                prepared = [self._prepare_query(q) for q in wave]
+                if any([key is not None for key, indices in requests]):
+                    wave_results = self._dispatch_matrix(pool=pool, prepared=prepared, requests=requests,
+                                                         verbose=verbose)
                 else:
-                    pass
-            # arrival time queries must be 90 minutes in the future (to allow for travel time)
-            if 'arrival_time' in q:
-                assert q['arrival_time'] > localize_to_my_timezone(dt.datetime.now() + dt.timedelta(hours=1.5))
-
-            # handle waiting or in-time execution
-            if self.execute_in_time:
-                # All queries were checked that they were in the future during ingestion, but if queries multiple
-                #   were given the same departure_time, then time.sleep() would be for negative number of seconds.
-                # Therefore, just skip sleeping and execute at 'now'.
-                print "Query departure_time:", qe['departure_time']
-                print "Now:", localize_to_my_timezone(dt.datetime.now())
-                t = qe['departure_time'] - localize_to_my_timezone(dt.datetime.now())
+                    wave_results = self._dispatch(pool=pool, prepared=prepared, verbose=verbose)
+                successes += self._handle_results(queries=wave, prepared=prepared, results=wave_results,
+                                                  local_results=local_results, verbose_split=verbose_split,
+                                                  store_locally=store_locally, all_queries=queries)
+                if self.journal is not None:
+                    self.journal.sync()
+                if streamed and self.streaming:
+                    # executed queries are dropped so that memory doesn't grow with the input
+                    del queries[:qi]
+                    qi = 0
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return successes
+
+    def _run_queries_in_time(self, queries, local_results, verbose, verbose_split, store_locally):
+        """
+        Executes queries at their departure times. Queries are held in a heap-based scheduler; the loop sleeps until
+            the earliest is due, then releases every query due by that instant and dispatches them together on a thread
+            pool sized to the query quota. Split queries are admitted to the scheduler as they are built (the second
+            query of a pair once the first has returned). The lag between each query's departure time and its dispatch
+            is reported instead of failing on late queries.
+        :return: number of successful queries
+        """
+        assert not any(['arrival_time' in q for q in queries]), "Can't use arrival_time with execute_in_time."
+        scheduler = QueryScheduler()
+        for q in queries:
+            if store_locally:
+                scheduler.push(self._due_time(q), q)
+            elif q['id'] in self.completed_ids:
+                continue
+            # second query of a split pair is admitted once the first returns (which may be from a resumed journal)
+            elif not q['id'].endswith('-2') or q['id'][:-1] + '1' in self.completed_ids:
+                scheduler.push(self._due_time(q), q)
+
+        successes = 0
+        # requests can't go faster than the quota, so more threads than that would just wait on the rate limiter
+        workers = max(self.concurrent_requests, int(math.ceil(self.rate_limiter.rate)))
+        pool = ThreadPool(workers) if workers > 1 else None
+        try:
+            while scheduler:
+                self._periodic_dump()
+                t = scheduler.next_time() - localize_to_my_timezone(dt.datetime.now())
                 if t > dt.timedelta(0):
-                    print "Waiting for next query at", q['departure_time'].strftime("%m/%d/%Y %H:%M")
+                    print "Waiting for next query at", scheduler.next_time().strftime("%m/%d/%Y %H:%M")
                     print "Sleep for", str(t).split('.')[0]
                     time.sleep(t.total_seconds())
-                # Put in the exact current time for precision as indicated by googlemaps package documentation.
-                qe['departure_time'] = localize_to_my_timezone(dt.datetime.now())
-                # proxy_time = localize_to_my_timezone(dt.datetime.now())
-                print "Executing now (%s)." % qe['departure_time'].strftime("%m/%d/%Y %H:%M")
+                due = scheduler.pop_due(localize_to_my_timezone(dt.datetime.now()))
+                if not due:
+                    continue
+                due_times, group = zip(*due)
+                print "Executing", len(group), "queries due at", due_times[-1].strftime("%m/%d/%Y %H:%M")
+                prepared = [self._prepare_query(q, in_time=True) for q in group]
+                group_results = self._dispatch(pool=pool, prepared=prepared, verbose=verbose, in_time=True)
+                for q, due_time, qe in zip(group, due_times, prepared):
+                    lag = scheduler.record_lag(due_time=due_time, dispatch_time=qe['departure_time'])
+                    print "Dispatched", q.get('id', ''), "at", qe['departure_time'].strftime("%m/%d/%Y %H:%M:%S"), \
+                        "lag %.1f seconds" % lag
+                successes += self._handle_results(queries=group, prepared=prepared, results=group_results,
+                                                  local_results=local_results, verbose_split=verbose_split,
+                                                  store_locally=store_locally, all_queries=queries,
+                                                  admit=lambda aq: scheduler.push(self._due_time(aq), aq))
+                if self.journal is not None:
+                    self.journal.sync()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        n, mean_lag, max_lag = scheduler.lag_summary()
+        print "Dispatch lag over %d queries: mean %.1f seconds, max %.1f seconds." % (n, mean_lag, max_lag)
+        return successes
+
+    def _due_time(self, q):
+        """
+        Time at which a query is due for in-time execution ('now' queries are due immediately).
+        :param q: query dictionary
+        :return: timezone-aware datetime
+        """
+        if type(q['departure_time']) is str and q['departure_time'].lower() == 'now':
+            return localize_to_my_timezone(dt.datetime.now())
+        return q['departure_time']
+
+    def _dispatch(self, pool, prepared, verbose=False, in_time=False):
+        """
+        Execute prepared queries, on the thread pool if one is given, otherwise in the calling thread.
+        :return: list of (query result, T/F success) in the same order as prepared
+        """
+        execute = lambda qe: self._execute_query_safely(qe, verbose=verbose, in_time=in_time)
+        if pool is None:
+            return [execute(qe) for qe in prepared]
+        # get() with timeout so that a KeyboardInterrupt still reaches the main thread
+        return pool.map_async(execute, prepared).get(0xFFFFF)
+
+    def _dispatch_matrix(self, pool, prepared, requests, verbose=False):
+        """
+        Execute a wave of Directions queries and Distance Matrix batches, on the thread pool if one is given.
+        :param prepared: parameters for each query of the wave
+        :param requests: list of (batch key or None, indices into prepared) - one request each
+        :return: list of (query result, T/F success) in the same order as prepared
+        """
+        def execute(request):
+            key, indices = request
+            # a batch of one gets the full Directions result
+            if key is None or len(indices) == 1:
+                return [self._execute_query_safely(prepared[indices[0]], verbose=verbose)]
+            return self._execute_matrix_safely([prepared[i] for i in indices], verbose=verbose)
+        if pool is None:
+            request_results = [execute(request) for request in requests]
+        else:
+            request_results = pool.map_async(execute, requests).get(0xFFFFF)
+        results = [None] * len(prepared)
+        for (key, indices), r_results in zip(requests, request_results):
+            for i, r in zip(indices, r_results):
+                results[i] = r
+        return results
+
+    def _matrix_key(self, q):
+        """
+        Key shared by queries that can go in the same Distance Matrix request (all parameters but origin/destination).
+        :param q: query dictionary
+        :return: hashable key, or None if the query needs the Directions API
+        """
+        # queries built by splitting transit trips keep their Directions results for the split point
+        if q.get('mode') not in self.matrix_modes or not q['id'].endswith('-0'):
+            return None
+        # split queries, waypoints, alternatives, etc. aren't supported by Distance Matrix
+        matrix_args = getargspec(googlemaps.distance_matrix.distance_matrix)[0]
+        params = [(k, v) for k, v in q.items() if k not in ['id', 'timezone', 'origin', 'destination']]
+        if not all([k in matrix_args for k, v in params]):
+            return None
+        return tuple(sorted(params))
+
+    def _matrix_fits(self, batch):
+        """
+        Check that a batch of queries is within the Distance Matrix limits on locations and elements per request.
+        :param batch: list of queries
+        :return: T/F
+        """
+        origins = len(set([q['origin'] for q in batch]))
+        destinations = len(set([q['destination'] for q in batch]))
+        return origins <= self.matrix_max_locations and destinations <= self.matrix_max_locations \
+            and origins * destinations <= self.matrix_max_elements
 
-            # grab id value
-            if here_are_the_queries:
+    def _matrix_requests(self, wave, requests):
+        """
+        Break each Distance Matrix batch of a wave into requests that are whole rectangles of origins x destinations,
+            since a request is billed for every element of its matrix. Queries of a batch are grouped by origin and
+            consecutive origins with the same destinations are merged, so a grid stays one request while unrelated
+            origin/destination pairs become requests of one query (executed with Directions).
+        :param wave: queries of the wave
+        :param requests: list of (batch key or None, indices into wave)
+        :return: list of (batch key or None, indices into wave)
+        """
+        blocks = []
+        for key, indices in requests:
+            if key is None:
+                blocks.append((key, indices))
+                continue
+            origins = []
+            by_origin = {}
+            for i in indices:
+                if wave[i]['origin'] not in by_origin:
+                    origins.append(wave[i]['origin'])
+                    by_origin[wave[i]['origin']] = []
+                by_origin[wave[i]['origin']].append(i)
+            last = None
+            for o in origins:
+                destinations = frozenset([wave[i]['destination'] for i in by_origin[o]])
+                if destinations == last:
+                    blocks[-1][1].extend(by_origin[o])
+                else:
+                    blocks.append((key, list(by_origin[o])))
+                last = destinations
+        return blocks
+
+    def _execute_matrix(self, batch, verbose=False):
+        """
+        Execute a batch of prepared queries as one Distance Matrix request, once a token is available from the shared
+            rate limiter. Each element is returned in the shape of a Directions result with one route and one leg, so
+            results are stored and output like any other query.
+        :param batch: list of dictionaries of googlemaps.directions arguments, differing only in origin/destination
+        :param verbose: runs recursive print on the request result
+        :return: list of query results, in the order of batch
+        """
+        origins = []
+        destinations = []
+        for qe in batch:
+            if qe['origin'] not in origins:
+                origins.append(qe['origin'])
+            if qe['destination'] not in destinations:
+                destinations.append(qe['destination'])
+        # 'now' is resolved per query, so the departure time of the first query is used for the batch
+        params = {k: v for k, v in batch[0].items() if k not in ['origin', 'destination']}
+        self.rate_limiter.acquire()
+        with self.count_lock:
+            self.distance_matrix_query_count += 1
+            print "Distance Matrix count:", self.distance_matrix_query_count, "(%i elements)" % \
+                                                                              (len(origins) * len(destinations))
+        m_result = self.gmaps.distance_matrix(origins, destinations, **params)
+
+        if verbose:
+            print "Result:"
+            recursive_print(m_result)
+            print '\n\n'
+        q_results = []
+        for qe in batch:
+            oi = origins.index(qe['origin'])
+            di = destinations.index(qe['destination'])
+            element = m_result['rows'][oi]['elements'][di]
+            if element.get('status') != 'OK':
+                print "Empty query result on", qe
+                q_results.append([])
+                continue
+            leg = {'distance': element['distance'], 'duration': element['duration'],
+                   'start_address': m_result['origin_addresses'][oi],
+                   'end_address': m_result['destination_addresses'][di]}
+            if 'duration_in_traffic' in element:
+                leg['duration_in_traffic'] = element['duration_in_traffic']
+            # Distance Matrix doesn't return locations, so use the query's own if given in lat/long
+            if type(qe['origin']) is tuple:
+                leg['start_location'] = {'lat': qe['origin'][0], 'lng': qe['origin'][1]}
+            if type(qe['destination']) is tuple:
+                leg['end_location'] = {'lat': qe['destination'][0], 'lng': qe['destination'][1]}
+            q_results.append([{'legs': [leg], 'summary': 'Distance Matrix'}])
+        return q_results
+
+    def _execute_matrix_safely(self, batch, verbose=False):
+        """
+        Version of _execute_matrix(...) that never raises; a failed request fails every query in its batch.
+        :return: list of tuples of (query result or [] on exception, T/F success)
+        """
+        try:
+            return [(q_result, True) for q_result in self._execute_matrix(batch, verbose=verbose)]
+        except (googlemaps.exceptions.ApiError, googlemaps.exceptions.HTTPError,
+                googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError,
+                BaseException):
+            traceback.print_exc()
+            return [([], False)] * len(batch)
+
+    def _handle_results(self, queries, prepared, results, local_results, verbose_split, store_locally, all_queries,
+                        admit=None):
+        """
+        Split bookkeeping and storage for a group of executed queries, in the order given. When the first query of a
+            split pair fails, its second query is stored as failed too (an empty result) rather than left unexecuted.
+        :param queries: queries that were executed
+        :param prepared: parameters each query was executed with
+        :param results: (query result, T/F success) for each query
+        :param all_queries: list of all queries being executed (for finding split pairs)
+        :param admit: function taking a query to schedule, for split queries when executing in time
+        :return: number of successful queries
+        """
+        successes = 0
+        for q, qe, (q_result, succeeded) in zip(queries, prepared, results):
+            if store_locally:
                 qid = '00000000-0'
             else:
                 qid = q['id']
-
-            try:
-                # execute full query and add result
-                self.directions_query_count += 1
-                print "Directions count:", self.directions_query_count
-                q_result = self.gmaps.directions(**qe)
+            partner = None
+            if succeeded:
                 successes += 1
+                if self.split_transit:
+                    try:
+                        self._handle_split_result(q=q, qe=qe, qid=qid, q_result=q_result, queries=all_queries,
+                                                  verbose_split=verbose_split, admit=admit)
+                    except BaseException:
+                        traceback.print_exc()
+                        q_result = []
+            elif self.split_transit and not store_locally and qid.endswith('-1'):
+                # the second query of the pair takes its time from the first, so it can't be executed either
+                partner = self.query_index.get(qid[:-1] + '2')
+            self._store_result(qid=qid, q_result=q_result, local_results=local_results, store_locally=store_locally)
+            if partner is not None:
+                print "First query of split pair failed, recording complementary query as failed:", partner['id']
+                self.completed_ids.add(partner['id'])
+                self._store_result(qid=partner['id'], q_result=[], local_results=local_results,
+                                   store_locally=store_locally)
+        return successes
 
-                if verbose:
-                    print "Result:"
-                    recursive_print(q_result)
-                    print '\n\n'
-                if not q_result:
-                    print "Empty query result on", qe
-
-                # if this was the first query to execute - populate the pair query with the departure/arrival
-                if self.split_transit and qid.split('-')[1] == '1':
-                    q_index = [True if rq['id'] == qid.split('-')[0] + '-2' else False for rq in queries].index(True)
-                    if q_result:
-                        if recursive_get(q_result, (0, 'legs', 0, 'duration_in_traffic', 'value')) == 'n/a':
-                            leg1_time = int(recursive_get(q_result, (0, 'legs', 0, 'duration', 'value'))) / 60.
-                        else:
-                            leg1_time = int(recursive_get(q_result, (0, 'legs', 0, 'duration_in_traffic', 'value'))) / 60.
-                        print "Found index of query to change:", q_index
-                        print "Adding", leg1_time, "minutes"
-                        if 'departure_time' in queries[q_index]:
-                            queries[q_index]['departure_time'] = qe['departure_time'] + dt.timedelta(minutes=leg1_time)
-                        elif 'arrival_time' in queries[q_index]:
-                            queries[q_index]['arrival_time'] = qe['arrival_time'] - dt.timedelta(minutes=leg1_time)
-                        else:
-                            pass
-                    else:
-                        print "Removing complementary query at index:", q_index
-                        queries.remove(queries[q_index])
-                    queries.sort(key=lambda x: x['departure_time'] if 'departure_time' in x else x['arrival_time'])
-
-                # then get any applicable split queries
-                if self.split_transit and 'split_on_leg' in q and q_result:
-                    add_queries = self.build_intermediate_queries(full_query_to_split=q, result_to_split=q_result,
-                                                                  verbose=verbose_split)
-                    ####################
-                    # print "ID stub:", "{0:0>4}".format(successes)
-                    # print "Adding", len(add_queries), "sets of queries:"
-                    # for aq in add_queries:
-                    #     print aq
-                    ####################
-                    self.queries += list(chain(*add_queries))
-                    # make sure all queries will get put in after the current one (strictly greater than)
-                    assert all([aq1['departure_time'] > q['departure_time'] for aq1, aq2 in add_queries
-                                if 'departure_time' in aq1 and aq1['departure_time'] is not None]), \
-                        "Departure times need to be in future."
-                    assert all([aq2['departure_time'] > q['departure_time'] for aq1, aq2 in add_queries
-                                if 'departure_time' in aq2 and aq2['departure_time'] is not None]), \
-                        "Departure times need to be in future."
-                    # resort queries
-                    #   put 'now' queries at very beginning
-                    #   prefer to use 'departure_time' but will resort to 'arrival_time'
-                    queries.sort(key=lambda x: (dt.datetime.min if x['departure_time'] == 'now' else
-                                                x['departure_time']) if 'departure_time' in x else x['arrival_time'])
-                ##################
-                # print "All queries:"
-                # print "\tThis was number", queries.index(q)
-                # for alq in queries:
-                #     print alq
-                ##################
-            # Catch any exception so that no matter what happens, process will proceed.
-            except (googlemaps.exceptions.ApiError, googlemaps.exceptions.HTTPError,
-                    googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError,
-                    BaseException):
-                traceback.print_exc()
-                # append empty result to keep number of queries and number of results in sync
-                q_result = []
-            if here_are_the_queries:
-                # save results in function instead of in class variable
-                local_results.append(q_result)
+    def _periodic_dump(self):
+        """
+        Dump results to file if it has been more than an hour since last start time (not needed when results are
+            being journaled as they complete), and report memory use.
+        :return: None
+        """
+        if dt.datetime.now() > self.start_time + dt.timedelta(hours=1):
+            if self.journal is None:
+                print "Dumping results to file before continuing."
+                self.output_results()
+            for line in self.memory_report():
+                print line
+            self.start_time = dt.datetime.now()
+        return
+
+    def memory_report(self):
+        """
+        :return: list of lines describing the results held in memory and the peak resident memory of this process
+        """
+        lines = ["Results held: %d" % len(self.results)]
+        if self.retention is not None:
+            # totals scaled up from the results measured
+            raw, retained = [float(b) / n * self.pruned_result_count if n else 0.
+                             for b, n in [self.result_bytes['raw'], self.result_bytes['retained']]]
+            lines[0] += ", pruned with '%s' retention profile to %.1f MB pickled of %.1f MB received (%.0f%%)" % \
+                (self.retention.name, retained / 1048576., raw / 1048576., 100. * retained / raw if raw else 100.)
+            measured = min([n for _, n in self.result_bytes.values()])
+            if measured < self.pruned_result_count:
+                lines[0] += " estimated from %d of %d results" % (measured, self.pruned_result_count)
+            if self.raw_archive is not None:
+                lines[0] += ", full responses archived to " + self.raw_archive.filename
+        # ru_maxrss is in KB on Linux and in bytes on Mac OS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1048576. if sys.platform == 'darwin' else 1024.)
+        lines.append("Peak resident memory: %.1f MB" % max_rss)
+        return lines
+
+    def _prepare_query(self, q, in_time=False):
+        """
+        Build the parameters for a Directions call from a query, resolving 'now' and slightly-past departure times.
+        :param q: query dictionary
+        :param in_time: T/F query is released by the in-time scheduler (departure time is set at dispatch instead)
+        :return: dictionary of valid googlemaps.directions arguments
+        """
+        # the query that gets executed can't have an invalid column - 'id' will be handled later
+        qe = {k: v for k, v in q.items() if k not in ['timezone', 'split_on_leg', 'drive_leg', 'id']}
+        if in_time:
+            # placeholder until dispatch, lateness is reported by the scheduler rather than treated as an error
+            qe['departure_time'] = localize_to_my_timezone(dt.datetime.now())
+            return qe
+
+        # handle 'now' value in departure_time
+        if 'departure_time' in q:
+            # q[tt] should have already been converted to dt.datetime unless it is 'now' (and execute_in_time False)
+            if type(q['departure_time']) is str and q['departure_time'].lower() == 'now':
+                qe['departure_time'] = localize_to_my_timezone(dt.datetime.now())
+            # if 'now' was in departure_time and execute_in_time was True, then the parameter will be slightly in
+            #   the past since it was put in as datetime.now() at the time of query input processing
+            elif q['departure_time'] < localize_to_my_timezone(dt.datetime.now() - dt.timedelta(minutes=10)):
+                raise AssertionError("Query departure time too far in past. Will tolerate up to 10 minutes.")
+            elif q['departure_time'] < localize_to_my_timezone(dt.datetime.now()):
+                # might get a bit behind departure time if queries have same time
+                qe['departure_time'] = localize_to_my_timezone(dt.datetime.now())
             else:
-                if self.split_transit:
-                    if qid.split('-')[0] in [i[0] for i in self.results]:
-                        for res in self.results:
-                            if res[0] == qid.split('-')[0]:
-                                self.results[self.results.index(res)].append(q_result)
-                                print "Added a result to an existing ID:", qid.split('-')[0]
-                    else:
-                        self.results.append([qid.split('-')[0], q_result])
-                        print "Added a result under a new ID:", qid.split('-')[0]
+                pass
+        # arrival time queries must be 90 minutes in the future (to allow for travel time)
+        if 'arrival_time' in q:
+            assert q['arrival_time'] > localize_to_my_timezone(dt.datetime.now() + dt.timedelta(hours=1.5))
+        return qe
+
+    def _execute_query(self, qe, verbose=False, in_time=False):
+        """
+        Execute one Directions query once a token is available from the shared rate limiter.
+        :param qe: dictionary of googlemaps.directions arguments
+        :param verbose: runs recursive print on the query result
+        :param in_time: T/F set departure_time to the moment of execution (updates qe)
+        :return: query result
+        """
+        self.rate_limiter.acquire()
+        if in_time:
+            # Put in the exact current time for precision as indicated by googlemaps package documentation.
+            qe['departure_time'] = localize_to_my_timezone(dt.datetime.now())
+        with self.count_lock:
+            self.directions_query_count += 1
+            print "Directions count:", self.directions_query_count
+        q_result = self.gmaps.directions(**qe)
+
+        if verbose:
+            print "Result:"
+            recursive_print(q_result)
+            print '\n\n'
+        if not q_result:
+            print "Empty query result on", qe
+        return q_result
+
+    def _execute_query_safely(self, qe, verbose=False, in_time=False):
+        """
+        Version of _execute_query(...) that never raises, so one failure does not stop the rest of a group.
+        :return: tuple of (query result or [] on exception, T/F success)
+        """
+        try:
+            return self._execute_query(qe, verbose=verbose, in_time=in_time), True
+        # Catch any exception so that no matter what happens, process will proceed.
+        except (googlemaps.exceptions.ApiError, googlemaps.exceptions.HTTPError,
+                googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError,
+                BaseException):
+            traceback.print_exc()
+            # empty result keeps number of queries and number of results in sync
+            return [], False
+
+    def _handle_split_result(self, q, qe, qid, q_result, queries, verbose_split=False, admit=None):
+        """
+        Split transit bookkeeping after a query executes: populate the time of the second query of a split pair, or
+            build the split pairs for a full query that is to be split.
+        :param q: query that was executed
+        :param qe: parameters the query was executed with
+        :param qid: id of the executed query
+        :param q_result: result of the query
+        :param queries: list of queries being executed
+        :param verbose_split: T/F to print transit split process
+        :param admit: function taking a query to schedule, used when executing in time
+        :return: None
+        """
+        # if this was the first query to execute - populate the pair query with the departure/arrival
+        if qid.split('-')[1] == '1':
+            partner = self.query_index[qid.split('-')[0] + '-2']
+            if q_result:
+                if recursive_get(q_result, (0, 'legs', 0, 'duration_in_traffic', 'value')) in ('', 'n/a'):
+                    leg1_time = int(recursive_get(q_result, (0, 'legs', 0, 'duration', 'value'))) / 60.
                 else:
-                    self.results.append(q_result)
-            ###################
-            # print "Results:"
-            # for r in self.results:
-            #     print r[0], len(r) - 1
-            ###################
-            # use for debugging...
-            # raw_input("Press Enter to continue")
-        print "Executed", successes, "queries successfully."
-        if here_are_the_queries:
-            return local_results
+                    leg1_time = int(recursive_get(q_result, (0, 'legs', 0, 'duration_in_traffic', 'value'))) / 60.
+                print "Found query to change:", partner['id']
+                print "Adding", leg1_time, "minutes"
+                if 'departure_time' in partner:
+                    partner['departure_time'] = qe['departure_time'] + dt.timedelta(minutes=leg1_time)
+                elif 'arrival_time' in partner:
+                    partner['arrival_time'] = qe['arrival_time'] - dt.timedelta(minutes=leg1_time)
+                else:
+                    pass
+                if self.journal is not None:
+                    self.journal.write_query(partner)
+                if admit is not None:
+                    admit(partner)
+            else:
+                print "Removing complementary query:", partner['id']
+                # rare (empty result), so the list scan is acceptable here
+                queries.remove(partner)
+                del self.query_index[partner['id']]
+                if self.journal is not None:
+                    self.journal.write_removal(partner['id'])
+
+        # then get any applicable split queries
+        if 'split_on_leg' in q and q_result:
+            add_queries = self.build_intermediate_queries(full_query_to_split=q, result_to_split=q_result,
+                                                          verbose=verbose_split)
+            self.queries += list(chain(*add_queries))
+            # make sure all queries will get put in after the current one (strictly greater than)
+            assert all([aq1['departure_time'] > q['departure_time'] for aq1, aq2 in add_queries
+                        if 'departure_time' in aq1 and aq1['departure_time'] is not None]), \
+                "Departure times need to be in future."
+            assert all([aq2['departure_time'] > q['departure_time'] for aq1, aq2 in add_queries
+                        if 'departure_time' in aq2 and aq2['departure_time'] is not None]), \
+                "Departure times need to be in future."
+            if admit is not None:
+                # second query of each pair is admitted once the first returns with its travel time
+                for aq1, aq2 in add_queries:
+                    admit(aq1)
+        return
+
+    def _count_result_bytes(self, kind, n_bytes):
+        """
+        Add a measured result size ('raw' or 'retained') to those reported by memory_report(), if it was measured.
+        :return: None
+        """
+        if n_bytes is not None:
+            self.result_bytes[kind][0] += n_bytes
+            self.result_bytes[kind][1] += 1
+        return
+
+    def _store_result(self, qid, q_result, local_results, store_locally):
+        """
+        Store a query result locally or in self.results (grouped by id stub when splitting transit), pruned to the
+            retention profile if there is one (the full response goes to the raw archive if it is open).
+        :return: None
+        """
+        if store_locally:
+            # save results in function instead of in class variable
+            local_results.append(q_result)
         else:
-            return
+            retained_bytes = None
+            if self.retention is not None:
+                sample = self.pruned_result_count % self.size_sample_interval == 0
+                self.pruned_result_count += 1
+                raw_bytes = None
+                if self.raw_archive is not None:
+                    raw_bytes = self.raw_archive.write_result(qid=qid, query=self.query_index.get(qid), result=q_result)
+                elif sample:
+                    raw_bytes = len(cPickle.dumps(q_result, cPickle.HIGHEST_PROTOCOL))
+                q_result = self.retention.prune(q_result)
+                self._count_result_bytes('raw', raw_bytes)
+            if self.journal is not None:
+                retained_bytes = self.journal.write_result(qid=qid, query=self.query_index.get(qid), result=q_result)
+            if self.retention is not None:
+                if retained_bytes is None and sample:
+                    retained_bytes = len(cPickle.dumps(q_result, cPickle.HIGHEST_PROTOCOL))
+                self._count_result_bytes('retained', retained_bytes)
+            if self.streaming and qid.endswith('-0'):
+                # executed input queries aren't kept when streaming, output builds them again from the input rows
+                self.query_index.pop(qid, None)
+            if self.result_ids is not None:
+                self.result_ids.append(qid)
+            if self.split_transit:
+                id_stub = qid.split('-')[0]
+                if id_stub in self.result_index:
+                    self.result_index[id_stub].append(q_result)
+                    print "Added a result to an existing ID:", id_stub
+                else:
+                    self.result_index[id_stub] = [id_stub, q_result]
+                    self.results.append(self.result_index[id_stub])
+                    print "Added a result under a new ID:", id_stub
+            else:
+                self.results.append(q_result)
+        return
 
-    def output_results(self, output_filename=None, write_csv=True, write_pickle=True, get_outputs=None):
+    def output_results(self, output_filename=None, write_csv=True, write_pickle=True, get_outputs=None,
+                       write_columnar=False, outputs_where=None):
         """
         Write previously-gathered query results to file(s).
         :param output_filename: (optional) override 'output_' + input_filename for output files (no extension needed)
         :param write_csv: write output as CSV file (distance, duration, start(x, y), end(x, y))
         :param write_pickle: write results to pickle file, full query returns in list
         :param get_outputs: dict of column headers (keys) with tuples of the depth-wise calls to make to the list-dict
-            results gathered; already defined within function, but these may not be valid depending on queries
+            results gathered; already defined within function, but these may not be valid depending on queries; a '*' in
+            the tuples gives long output with a row for each element there, e.g., each step (see OutputSpec)
+        :param write_columnar: write the CSV output's columns as typed, memory-mappable arrays in a '_columns'
+            directory (see ColumnarWriter)
+        :param outputs_where: dict of tuples of depth-wise calls to the values rows of long output must have to be kept
         :return: None
         """
         if not self.results:
             return
-        if output_filename is None:
-            output_stub = os.path.split(self.saved_input_filename)[0]
-            output_fn = 'output_' + os.path.splitext(os.path.split(self.saved_input_filename)[-1])[0]
-        else:
-            output_stub = os.path.split(output_filename)[0]
-            if not output_stub:
-                output_stub = '.'
-            output_fn = os.path.splitext(os.path.split(output_filename)[-1])[0]
+        output_stub, output_fn = self._output_path(output_filename)
         if write_pickle:
             try:
                 with open(output_stub + '/' + output_fn + '.cpkl', 'wb') as f:
                     cPickle.dump({'results': self.results, 'split_cache': self.split_reverse_cache,
-                                  'queries': self.queries}, f)
+                                  'queries': self._recorded_queries()}, f)
             except (cPickle.PicklingError, RuntimeError, ImportError, AttributeError):
                 traceback.print_exc()
                 print "Problem with output as pickle."
@@ -460,100 +1198,20 @@ class GooglemapsAPIMiner:
                     print "Failed pickle output again."
                     print traceback.format_exc(pe)
                     pass
+        # define output parameters and the appropriate depth-wise calls to list-dict combinations to get each
+        if get_outputs:
+            outputs = get_outputs
+        else:
+            outputs = self.default_outputs
+        spec = OutputSpec(outputs, where=outputs_where)
         if write_csv:
+            line = []
             try:
-                # define output parameters and the appropriate depth-wise calls to list-dict combinations to get each
-                if get_outputs:
-                    outputs = get_outputs
-                else:
-                    outputs = {'distance_m': (0, 'legs', 0, 'distance', 'value'),
-                               'duration-sec': (0, 'legs', 0, 'duration', 'value'),
-                               'duration_in_traffic-sec': (0, 'legs', 0, 'duration_in_traffic', 'value'),
-                               'start_x': (0, 'legs', 0, 'start_location', 'lng'),
-                               'start_y': (0, 'legs', 0, 'start_location', 'lat'),
-                               'end_x': (0, 'legs', 0, 'end_location', 'lng'),
-                               'end_y': (0, 'legs', 0, 'end_location', 'lat')}
                 with open(output_stub + '/' + output_fn + '.csv', 'w') as f:
                     writer = csv.writer(f, delimiter='|')
-                    outputs_keys, outputs_values = zip(*outputs.items())
-                    if self.split_transit:
-                        output_header = self.input_header + ['split_point'] + list(outputs_keys) * 2
-                        writer.writerow(output_header)
-                        for res in self.results:
-                            # get full query portion of the output row
-                            try:
-                                q = self.queries[[True if qry['id'] == res[0][:4] + '0000-0' else False
-                                                  for qry in self.queries].index(True)]
-                            except ValueError:
-                                print "Couldn't find full source query."
-                                q = [''] * len(self.input_header)
-                            line = [q[ih] if ih in q else '' for ih in self.input_header]
-                            if len(res) > 2:
-                                try:
-                                    q1 = self.queries[[True if qry['id'] == res[0] + '-1' else False
-                                                       for qry in self.queries].index(True)]
-                                    q2 = self.queries[[True if qry['id'] == res[0] + '-2' else False
-                                                       for qry in self.queries].index(True)]
-                                    # get split point of the query
-                                    if q1['destination'] == q2['origin']:
-                                        # query was made on departure time
-                                        try:
-                                            line += [self.split_reverse_cache[q1['destination']]]
-                                        except KeyError:
-                                            line += [q1['destination']]
-                                    elif q1['origin'] == q2['destination']:
-                                        # query was made on arrival time
-                                        try:
-                                            line += [self.split_reverse_cache[q1['origin']]]
-                                        except KeyError:
-                                            line += [q1['origin']]
-                                    else:
-                                        print "Couldn't discern split point - no origin/destination match in results."
-                                except ValueError:
-                                    print "Couldn't find source query for split query pair.", res[0]
-                                    try:
-                                        qex = self.queries[[True if qry['id'] == res[0][:4] + '0000-0' else False
-                                                            for qry in self.queries].index(True)]
-                                        if 'departure_time' in qex:
-                                            endpt = 'end_location'
-                                        elif 'arrival_time' in qex:
-                                            endpt = 'start_location'
-                                        else:
-                                            raise ValueError
-                                        # pull likely split point from first query destination
-                                        el = (recursive_get(res[1], (0, 'legs', 0, endpt, 'lat')),
-                                              recursive_get(res[1], (0, 'legs', 0, endpt, 'lng')))
-                                        candidates = [(haversine(el[1], el[0], src[1], src[0]) * 5280., loc)
-                                                      for src, loc in self.split_reverse_cache.items()]
-                                        if any([c[0] < 150. for c in candidates]):
-                                            m = min(candidates, key=lambda x: x[0])
-                                            print "\tBut found likely candidate location in cache, distance =", m[0]
-                                            end_loc = m[1]
-                                        else:
-                                            print "\tResorted to lat/long."
-                                            end_loc = "{}/{}".format(el[0], el[1])
-                                        line += [str(end_loc).strip('(').strip(')')]
-                                    except ValueError:
-                                        print "- Could not discern alignment of query time."
-                                        line += ['']
-
-                                line += [recursive_get(res[1], oh) for oh in outputs_values]
-                                line += [recursive_get(res[2], oh) for oh in outputs_values]
-                            else:
-                                # for query split point
-                                line += ['']
-                                line += [recursive_get(res[1], oh) for oh in outputs_values]
-                                # for nonexistent second leg
-                                line += [''] * len(outputs_values)
-                            # output the line
-                            writer.writerow([li if type(li) not in (str, unicode) else li.encode('ascii', 'ignore') for li in line])
-                    else:
-                        output_header = self.input_header + list(outputs_keys)
-                        writer.writerow(output_header)
-                        for q, res in zip(self.queries, self.results):
-                            line = [q[ih] if ih in q else '' for ih in self.input_header]
-                            line += [recursive_get(res, oh) for oh in outputs_values]
-                            writer.writerow([li if type(li) not in (str, unicode) else li.encode('ascii', 'ignore') for li in line])
+                    for line in self._output_rows(spec):
+                        writer.writerow([li if type(li) not in (str, unicode) else li.encode('ascii', 'ignore')
+                                         for li in line])
             except (KeyError, ValueError, IOError, IndexError) as csv_exc:
                 # traceback.print_exc() might be getting around the logging Tee somehow.
                 print traceback.format_exc(csv_exc)
@@ -566,10 +1224,241 @@ class GooglemapsAPIMiner:
                     cPickle.dump(self.results, f)
                 with open("./exception_dump_queries.cpkl", 'wb') as f:
                     cPickle.dump(self.queries, f)
+        if write_columnar:
+            columnar_dir = output_stub + '/' + output_fn + '_columns'
+            rows = self._output_rows(spec)
+            writer = ColumnarWriter(columnar_dir, header=next(rows), n_rows=self._output_row_count(spec))
+            for line in rows:
+                writer.write_row(line)
+            writer.close()
+            print "Columnar output written to", columnar_dir
+        return
+
+    def _output_rows(self, spec):
+        """
+        Rows of output for the gathered results, as written to the CSV output.
+        :param spec: OutputSpec of the output columns
+        :return: generator of lists, the header first and then one row per result (or split result group), or for long
+            output one row per element matched in each result (and each part of a split result group)
+        """
+        if self.split_transit and spec.long:
+            yield self.input_header + ['split_point', 'split_part'] + spec.header
+            for res in self.results:
+                line = self._split_output_prefix(res)
+                for part, part_res in enumerate(res[1:]):
+                    for row in spec.rows(part_res):
+                        yield line + [part + 1 if len(res) > 2 else 0] + row
+        elif self.split_transit:
+            yield self.input_header + ['split_point'] + spec.header * 2
+            for res in self.results:
+                line = self._split_output_prefix(res)
+                if len(res) > 2:
+                    line += spec.rows(res[1])[0]
+                    line += spec.rows(res[2])[0]
+                else:
+                    line += spec.rows(res[1])[0]
+                    # for nonexistent second leg
+                    line += [''] * len(spec.header)
+                yield line
+        else:
+            yield self.input_header + spec.header
+            for q, res in zip(self._result_queries(), self.results):
+                line = [q[ih] if ih in q else '' for ih in self.input_header]
+                for row in spec.rows(res):
+                    yield line + row
+
+    def _query(self, qid):
+        """
+        :return: query with the id, built again from the input rows if it isn't held (executed when streaming)
+        """
+        if qid in self.query_index:
+            return self.query_index[qid]
+        return self.input_query(qid)
+
+    def _result_queries(self):
+        """
+        :return: iterable of the query of each result in self.results (not splitting transit)
+        """
+        if self.result_ids is None:
+            return self.queries
+        return (self._query(qid) for qid in self.result_ids)
+
+    def _recorded_queries(self):
+        """
+        :return: list of the queries to record in the output pickle - those of the results (not splitting transit) or
+            every query held (splitting transit; split queries are kept in the id lookup when streaming)
+        """
+        if not self.streaming:
+            return self.queries
+        if self.split_transit:
+            return sorted(self.query_index.values(), key=lambda q: q['id'])
+        return list(self._result_queries())
+
+    def _output_row_count(self, spec):
+        """
+        :return: number of rows (not counting the header) _output_rows(spec) will give
+        """
+        if not spec.long:
+            return len(self.results)
+        if self.split_transit:
+            return sum([len(spec.rows(r)) for res in self.results for r in res[1:]])
+        return sum([len(spec.rows(res)) for res in self.results])
+
+    def _split_output_prefix(self, res):
+        """
+        Start of the output row of a split result group: the full query's input values and the split point.
+        :param res: split result group ([id stub, result] or [id stub, first part result, second part result])
+        :return: list of values
+        """
+        # get full query portion of the output row
+        try:
+            q = self._query(res[0][:-4] + '0000-0')
+        except KeyError:
+            print "Couldn't find full source query."
+            q = [''] * len(self.input_header)
+        line = [q[ih] if ih in q else '' for ih in self.input_header]
+        if len(res) > 2:
+            try:
+                q1 = self.query_index[res[0] + '-1']
+                q2 = self.query_index[res[0] + '-2']
+                # get split point of the query
+                if q1['destination'] == q2['origin']:
+                    # query was made on departure time
+                    try:
+                        line += [self.split_reverse_cache[q1['destination']]]
+                    except KeyError:
+                        line += [q1['destination']]
+                elif q1['origin'] == q2['destination']:
+                    # query was made on arrival time
+                    try:
+                        line += [self.split_reverse_cache[q1['origin']]]
+                    except KeyError:
+                        line += [q1['origin']]
+                else:
+                    print "Couldn't discern split point - no origin/destination match in results."
+            except KeyError:
+                print "Couldn't find source query for split query pair.", res[0]
+                try:
+                    qex = self.query_index.get(res[0][:-4] + '0000-0', {})
+                    if 'departure_time' in qex:
+                        endpt = 'end_location'
+                    elif 'arrival_time' in qex:
+                        endpt = 'start_location'
+                    else:
+                        raise ValueError
+                    # pull likely split point from first query destination
+                    el = (recursive_get(res[1], (0, 'legs', 0, endpt, 'lat')),
+                          recursive_get(res[1], (0, 'legs', 0, endpt, 'lng')))
+                    m = self.find_split_point(lat=el[0], lng=el[1])
+                    if m is not None:
+                        print "\tBut found likely candidate location in cache, distance =", m[0]
+                        end_loc = m[1]
+                    else:
+                        print "\tResorted to lat/long."
+                        end_loc = "{}/{}".format(el[0], el[1])
+                    line += [str(end_loc).strip('(').strip(')')]
+                except ValueError:
+                    print "- Could not discern alignment of query time."
+                    line += ['']
+        else:
+            # for query split point
+            line += ['']
+        return line
+
+    def find_split_point(self, lat, lng, radius=150.):
+        """
+        Find the nearest station in split_reverse_cache to a location, using a spatial index that is extended as
+            stations are added to the cache (and rebuilt if the cache is replaced).
+        :param lat: latitude of the location
+        :param lng: longitude of the location
+        :param radius: search radius in feet
+        :return: tuple of (distance in feet, station name), None if no station is within the radius
+        """
+        if self.split_index is None or self.split_index_source is not self.split_reverse_cache:
+            self.split_index = LocationIndex()
+            self.split_index_source = self.split_reverse_cache
+        if len(self.split_index) != len(self.split_reverse_cache):
+            for loc in self.split_reverse_cache:
+                self.split_index.add(loc)
+        found = self.split_index.nearest(lat=lat, lng=lng, radius=radius / 5280.)
+        if found is None:
+            return None
+        return found[0] * 5280., self.split_reverse_cache[found[1]]
+
+    def _output_path(self, output_filename=None):
+        """
+        Directory and extension-less file name for output files.
+        :param output_filename: (optional) override 'output_' + input_filename
+        :return: tuple of (directory, file name without extension)
+        """
+        if output_filename is None:
+            output_stub = os.path.split(self.saved_input_filename)[0]
+            output_fn = 'output_' + os.path.splitext(os.path.split(self.saved_input_filename)[-1])[0]
+        else:
+            output_stub = os.path.split(output_filename)[0]
+            if not output_stub:
+                output_stub = '.'
+            output_fn = os.path.splitext(os.path.split(output_filename)[-1])[0]
+        return output_stub, output_fn
+
+    def resume_from_journal(self, journal_filename):
+        """
+        Restore results, split queries and station caches from the journal of an interrupted run so that only the
+            remaining queries are executed. Must be called after read_input_queries(...) on the same input file, since
+            query ids are matched against it.
+        :param journal_filename: path of the journal written by the interrupted run
+        :return: None
+        """
+        completed = []
+        removed = set()
+        for record in ResultJournal(journal_filename).replay():
+            if record[0] == 'result':
+                qid, query, q_result = record[1:]
+                self._restore_query(query)
+                completed.append((qid, q_result))
+            elif record[0] == 'query':
+                self._restore_query(record[1])
+            elif record[0] == 'remove':
+                removed.add(record[1])
+            elif record[0] == 'stations':
+                polyline, stations, rev_lookup, places_count = record[1:]
+                self.split_cache[polyline] = stations
+                self.split_reverse_cache.update(rev_lookup)
+                self.places_query_count += places_count
+        self.completed_ids = set([qid for qid, q_result in completed])
+        # split pairs of a full query without a recorded result will be built again when it is re-executed
+        pending = [q for q in self.queries if q['id'] not in self.completed_ids and q['id'] not in removed
+                   and (q['id'].endswith('-0') or q['id'][:-6] + '0000-0' in self.completed_ids)]
+        # completed queries go first in the order they were executed, so results stay aligned with queries (when
+        #   streaming, completed input queries aren't kept and results are aligned with their ids instead)
+        self.queries = [self.query_index[qid] for qid, q_result in completed
+                        if not (self.streaming and qid.endswith('-0'))] + pending
+        self.index_queries()
+        for qid, q_result in completed:
+            self._store_result(qid=qid, q_result=q_result, local_results=None, store_locally=False)
+        self.directions_query_count += len(completed)
+        print "Resumed", len(completed), "completed queries from journal,", len(pending), "remaining."
+        return
+
+    def _restore_query(self, query):
+        """
+        Apply a query recorded in a journal, updating the loaded query with the same id or adding a split query.
+        :return: None
+        """
+        if query is None:
+            return
+        if query['id'] in self.query_index:
+            self.query_index[query['id']].update(query)
+        else:
+            # input queries are only indexed when streaming, until their results are stored
+            if not (self.streaming and query['id'].endswith('-0')):
+                self.queries.append(query)
+            self.query_index[query['id']] = query
         return
 
     def run_pipeline(self, input_filename, output_filename=None, verbose_input=False, verbose_execute=False,
-                     verbose_split=False, write_csv=True, write_pickle=True):
+                     verbose_split=False, write_csv=True, write_pickle=True, write_journal=True, journal_fsync='batch',
+                     resume=False, lazy_input=False, workers=None, write_columnar=False, archive_raw=False):
         """
         Executes read_input_queries(...), run_queries(...), and output_results(...) with their relevant parameters
         :param input_filename: absolute or relative path for input file (will be saved for possible use in output)
@@ -579,23 +1468,70 @@ class GooglemapsAPIMiner:
         :param verbose_split: T/F to print transit split process
         :param write_csv: write output as CSV file (distance, duration, start(x, y), end(x, y))
         :param write_pickle: write results to pickle file, full query returns in list
+        :param write_journal: append each result to a '.journal' file next to the output as it completes (replaces the
+            hourly dump of all results)
+        :param journal_fsync: when to force journal records to disk ['always', 'batch', 'never']
+        :param resume: skip queries already recorded in the journal from an interrupted run with the same input/output
+        :param lazy_input: T/F expand input queries as they are executed instead of loading them all first
+        :param workers: list of worker specifications to execute the queries on worker processes instead of in this one
+            (see run_queries_on_workers(...))
+        :param write_columnar: also write output columns as typed, memory-mappable arrays (see ColumnarWriter)
+        :param archive_raw: with a retention profile, append the full response of each result to a '.raw_journal' file
+            next to the output (journal records, see ResultJournal) before it is pruned; otherwise full responses are
+            dropped
         :return: None
         """
         original_stdout = sys.stdout
-        log = open(os.path.splitext(input_filename)[0] + "_log.txt", 'w')
+        # keep the log of the interrupted run when resuming
+        log = open(os.path.splitext(input_filename)[0] + "_log.txt", 'a' if resume else 'w')
         sys.stdout = PrintLogTee(original_stdout, log)
         try:
-            self.read_input_queries(input_filename=input_filename, verbose=verbose_input)
-            self.run_queries(verbose=verbose_execute, verbose_split=verbose_split)
-            self.output_results(output_filename=output_filename, write_csv=write_csv, write_pickle=write_pickle)
+            self.read_input_queries(input_filename=input_filename, verbose=verbose_input, lazy=lazy_input)
+            journal_filename = '/'.join(self._output_path(output_filename)) + '.journal'
+            if resume:
+                if os.path.exists(journal_filename):
+                    self.resume_from_journal(journal_filename=journal_filename)
+                else:
+                    print "No journal found at", journal_filename, "- executing all queries."
+            if write_journal or resume:
+                self.journal = ResultJournal(journal_filename, fsync=journal_fsync)
+                self.journal.open(append=resume)
+            if archive_raw and self.retention is not None:
+                self.raw_archive = ResultJournal(os.path.splitext(journal_filename)[0] + '.raw_journal',
+                                                 fsync=journal_fsync)
+                self.raw_archive.open(append=resume)
+            if workers:
+                self.run_queries_on_workers(workers=workers, verbose=verbose_execute, verbose_split=verbose_split)
+            else:
+                self.run_queries(verbose=verbose_execute, verbose_split=verbose_split)
+            if isinstance(self.gmaps, KeyPool):
+                for line in self.gmaps.summary():
+                    print line
+            if self.station_cache is not None:
+                print "Station cache:", self.station_cache.hits, "hits,", self.station_cache.misses, "misses,", \
+                    self.places_query_count, "Places queries."
+            for line in self.memory_report():
+                print line
+            self.output_results(output_filename=output_filename, write_csv=write_csv, write_pickle=write_pickle,
+                                write_columnar=write_columnar)
         except BaseException as rpe:
             # catch any exception raised and make sure the log gets closed before re-raising
             # try to get this exception into the log befor closing
             print traceback.format_exc(rpe)
+            if self.journal is not None:
+                self.journal.close()
+            if self.raw_archive is not None:
+                self.raw_archive.close()
             log.close()
             sys.stdout = original_stdout
             # re-raise: don't want to do anything with e, or the traceback stack gets lost
             raise
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.raw_archive is not None:
+            self.raw_archive.close()
+            self.raw_archive = None
         log.close()
         sys.stdout = original_stdout
         return
@@ -609,7 +1545,7 @@ class GooglemapsAPIMiner:
         :param verbose: runs recursive print for primary/full queries and prints information about intermediate stations
         :return: None
         """
-        id_stub = full_query_to_split['id'][:4]
+        id_stub = full_query_to_split['id'][:-6]
         # find intermediate transit stations
         if full_query_to_split['split_on_leg'] == 'begin':
             steps = result_to_split[0]['legs'][0]['steps']
@@ -636,19 +1572,38 @@ class GooglemapsAPIMiner:
         ky = (full_query_to_split['origin'], full_query_to_split['destination'], full_query_to_split['split_on_leg'])
         leg = steps[[1 if st['travel_mode'] == 'TRANSIT' else 0 for st in steps].index(1)]
         polyline = leg['polyline']['points']
+        station_type = leg['transit_details']['line']['vehicle']['type'].lower() + '_station'
         # if ky in self.split_cache:
         if polyline in self.split_cache:
             # stations = self.split_cache[ky]
             stations = self.split_cache[polyline]
             if verbose:
                 print "Using cached station list."
-        elif self.places_query_count * 10 > 900:
-            print "Hit limit for places queries."
-            stations = {}
         else:
-            stations, rev_lookup = self.find_intermediate_transit_stations(transit_leg=leg, verbose=verbose)
-            self.split_cache[polyline] = stations
-            self.split_reverse_cache.update(rev_lookup)
+            places_count = self.places_query_count
+            found = None
+            if self.station_cache is not None:
+                found = self.station_cache.get(polyline=polyline, station_type=station_type)
+                if found is not None and verbose:
+                    print "Using station list from station cache file."
+            if found is None:
+                if self.places_query_limit is not None and self.places_query_count > self.places_query_limit:
+                    print "Hit limit for places queries."
+                else:
+                    found = self.find_intermediate_transit_stations(transit_leg=leg, verbose=verbose)
+                    if self.station_cache is not None:
+                        self.station_cache.put(polyline=polyline, station_type=station_type, stations=found[0],
+                                               reverse_lookup=found[1],
+                                               places_queries=self.places_query_count - places_count)
+            if found is None:
+                stations = {}
+            else:
+                stations, rev_lookup = found
+                self.split_cache[polyline] = stations
+                self.split_reverse_cache.update(rev_lookup)
+                if self.journal is not None:
+                    self.journal.write_stations(polyline=polyline, stations=stations, reverse_lookup=rev_lookup,
+                                                places_queries=self.places_query_count - places_count)
         station_keys = stations.keys()
 
         # build queries to and from intermediate transit stations
@@ -712,6 +1667,10 @@ class GooglemapsAPIMiner:
                     cp2['mode'] = 'driving'
                 sq.append(cp2)
             secondary_queries.append(copy(sq))
+            for sqi in sq:
+                self.query_index[sqi['id']] = sqi
+                if self.journal is not None:
+                    self.journal.write_query(sqi)
             if verbose:
                 print name, '\n', sq[0], '\n', sq[1]
         # return secondary queries so they can get added to query execution list, which will then get sorted
@@ -735,16 +1694,17 @@ class GooglemapsAPIMiner:
             print "n_stations:", n_stations
             print "station_type:", station_type
             print "raw polyline:", transit_leg['polyline']['points']
-        # returned in list of (latitude, longitude) tuples
+        # returned in (n, 2) array of (latitude, longitude) rows
         pline = decode_polyline(transit_leg['polyline']['points'])
         if verbose:
             print "decoded polyline:", pline
         # arrange for n_stations across fractional length [0.0, 1.0] of polyline, then interpolate points
         linspace = [(j+1) * (1./n_stations) for j in range(n_stations-1)]
-        # interpolation done in cartesian coordinates
+        # fractions are of great circle length, and points are placed linearly within the segment they fall on
         # also add in start and end points of polyline to get those stations as well
         #   they are listed first so those station names will be used to rule out erroneous top results
-        interp = [pline[0], pline[-1]] + line_interpolate_points(points=pline, fracs=linspace)
+        interp = [tuple(pline[0]), tuple(pline[-1])] + \
+            [tuple(itp) for itp in line_interpolate_points(points=pline, fracs=linspace).tolist()]
         if verbose:
             print "interpolating points at:", linspace
             print "found interpolated points:", interp
@@ -776,16 +1736,14 @@ class GooglemapsAPIMiner:
                 print "found point:", top_result_loc
                 print "name:", top_result['name']
                 recursive_print(top_result)
-            # calculate minimum cartesian distance from station found at interpolation point to polyline
-            dist_to_pline = min([dist_to_segment(p1[1], p1[0], p2[1], p2[0], top_result_loc[1], top_result_loc[0])
-                                 for p1, p2 in zip(pline[:-1], pline[1:])])
+            # calculate minimum distance from station found at interpolation point to polyline
+            dist_to_pline = point_to_polyline_distance(points=[top_result_loc], polyline=pline)[0][0] / meters_per_mile
             if verbose:
-                print "minimum distance from top result to polyline (approx miles):", (dist_to_pline * 55.)
+                print "minimum distance from top result to polyline (miles):", dist_to_pline
             # make sure minimum distance is less than threshold (miles)
-            # cartesian distance approximation for lat/lon is, for short distances, about 1/55 of haversine mileage
-            if dist_to_pline > (dist_threshold / 55.):
-                print "Distance from station found to polyline is approximately greater than %s miles." % dist_threshold
-                print "Found minimum distance of approximately %s miles." % (dist_to_pline * 55.)
+            if dist_to_pline > dist_threshold:
+                print "Distance from station found to polyline is greater than %s miles." % dist_threshold
+                print "Found minimum distance of %s miles." % dist_to_pline
                 print "Skipping this station -", top_result['name']
                 continue
             intermed[top_result['name']] = top_result_loc
@@ -793,6 +1751,39 @@ class GooglemapsAPIMiner:
         return intermed, reverse_lookup
 
 
+def coordinated_worker(worker, tasks, records, verbose=False, verbose_split=False):
+    """
+    Worker process of GooglemapsAPIMiner.run_queries_on_workers(...). Executes tasks of queries from the task queue
+        until it gets None, sending results, split queries and stations back as journal records.
+    :param worker: dictionary with 'init_args' for the worker's GooglemapsAPIMiner, and optionally 'queries_per_second'
+    :param tasks: queue of lists of queries
+    :param records: queue for journal records, followed by ('done', counts) or ('failed', pid, traceback)
+    :return: None
+    """
+    try:
+        # results are pruned (and full responses archived) by the coordinating miner as it stores them
+        g = GooglemapsAPIMiner(**dict(worker['init_args'], retention_profile=None))
+        if worker.get('queries_per_second'):
+            g.rate_limiter = TokenBucket(rate=worker['queries_per_second'])
+        g.journal = QueueJournal(records)
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            g.queries = task
+            g.results = []
+            g.index_queries()
+            g.run_queries(verbose=verbose, verbose_split=verbose_split)
+        records.put(('done', {'pid': os.getpid(), 'directions': g.directions_query_count,
+                              'distance_matrix': g.distance_matrix_query_count, 'places': g.places_query_count}))
+    except KeyboardInterrupt:
+        pass
+    except BaseException as e:
+        traceback.print_exc(e)
+        records.put(('failed', os.getpid(), traceback.format_exc(e)))
+    return
+
+
 def parallel_run_pipeline(all_args):
     """
     Wrapper method used in parallel execution to run class pipeline method.
@@ -860,11 +1851,14 @@ if __name__ == '__main__':
 
     usage = """
     usage: googlemaps_api_mining.py -k <api_key_file> -i <input_filename>
-            --[execute_in_time, split_transit, queries_per_second, output_filename, write_csv, write_pickle,
-                parallel_input_files, parallel_api_key_files]
+            --[execute_in_time, split_transit, queries_per_second, concurrent_requests, distance_matrix,
+                station_cache_file, places_query_limit, pool_api_key_files, directions_quota, places_quota,
+                retention_profile, output_filename, write_csv, write_pickle, write_columnar, write_journal,
+                journal_fsync, archive_raw, resume, lazy_input, workers, parallel_input_files, parallel_api_key_files]
     ex: python googlemaps_api_mining.py -k "./api_key.txt" -i "./test_queries.csv" --output_file "./output_test.csv"
     note: it is advised that the query input filenames be given as an absolute path
     note: using --parallel_input_files overrides output_filename and other parameters will be used for all tasks
+    note: --workers shares one input among worker processes, using -k and --parallel_api_key_files keys in turn
     note: to check number of allowable parallel processes use... googlemaps_api_mining.py -c
     """
     # Collect command line arguments/options.
@@ -880,11 +1874,16 @@ if __name__ == '__main__':
     # Make space for additional input file names and API key file names for parallel execution.
     add_inputs = []
     add_keys = []
+    n_workers = 0
 
     try:
         opts, args = getopt.getopt(command_line_arguments, "hck:i:",
-                                   ["execute_in_time=", "split_transit=", "queries_per_second=", "output_filename=",
-                                    "write_csv=", "write_pickle=", "parallel_input_files=", "parallel_api_key_files="])
+                                   ["execute_in_time=", "split_transit=", "queries_per_second=", "concurrent_requests=",
+                                    "distance_matrix=", "station_cache_file=", "places_query_limit=",
+                                    "pool_api_key_files=", "directions_quota=", "places_quota=", "retention_profile=",
+                                    "output_filename=", "write_csv=", "write_pickle=", "write_columnar=",
+                                    "write_journal=", "journal_fsync=", "archive_raw=", "resume=", "lazy_input=",
+                                    "workers=", "parallel_input_files=", "parallel_api_key_files="])
     except getopt.GetoptError:
         print usage
         sys.exit(2)
@@ -905,6 +1904,37 @@ if __name__ == '__main__':
             initspec['api_key_file'] = arg
         elif opt == "--queries_per_second":
             initspec['queries_per_second'] = int(arg)
+        elif opt == "--concurrent_requests":
+            initspec['concurrent_requests'] = int(arg)
+        elif opt == "--distance_matrix":
+            if arg.lower() == 'true':
+                initspec['distance_matrix'] = True
+            elif arg.lower() == 'false':
+                initspec['distance_matrix'] = False
+            else:
+                print "--distance_matrix should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
+        elif opt == "--station_cache_file":
+            initspec['station_cache_file'] = arg
+        elif opt == "--places_query_limit":
+            if arg.lower() == 'none':
+                initspec['places_query_limit'] = None
+            else:
+                initspec['places_query_limit'] = int(arg)
+        elif opt == "--pool_api_key_files":
+            initspec['pool_api_key_files'] = arg.split('|')
+        elif opt == "--directions_quota":
+            initspec['directions_quota'] = int(arg)
+        elif opt == "--places_quota":
+            initspec['places_quota'] = int(arg)
+        elif opt == "--retention_profile":
+            if arg.lower() in ['full', 'none']:
+                initspec['retention_profile'] = None
+            elif arg.lower() in retention_profiles:
+                initspec['retention_profile'] = arg.lower()
+            else:
+                print "--retention_profile should be one of", ['full'] + sorted(retention_profiles)
+                sys.exit(2)
         elif opt == "--execute_in_time":
             if arg.lower() == 'true':
                 initspec['execute_in_time'] = True
@@ -943,6 +1973,52 @@ if __name__ == '__main__':
             else:
                 print "--write_pickle should be [True/False/TRUE/FALSE/true/false]"
                 sys.exit(2)
+        elif opt == "--write_columnar":
+            if arg.lower() == 'true':
+                rpspec['write_columnar'] = True
+            elif arg.lower() == 'false':
+                rpspec['write_columnar'] = False
+            else:
+                print "--write_columnar should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
+        elif opt == "--archive_raw":
+            if arg.lower() == 'true':
+                rpspec['archive_raw'] = True
+            elif arg.lower() == 'false':
+                rpspec['archive_raw'] = False
+            else:
+                print "--archive_raw should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
+        elif opt == "--write_journal":
+            if arg.lower() == 'true':
+                rpspec['write_journal'] = True
+            elif arg.lower() == 'false':
+                rpspec['write_journal'] = False
+            else:
+                print "--write_journal should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
+        elif opt == "--journal_fsync":
+            if arg.lower() in ResultJournal.fsync_policies:
+                rpspec['journal_fsync'] = arg.lower()
+            else:
+                print "--journal_fsync should be one of", ResultJournal.fsync_policies
+                sys.exit(2)
+        elif opt == "--resume":
+            if arg.lower() == 'true':
+                rpspec['resume'] = True
+            elif arg.lower() == 'false':
+                rpspec['resume'] = False
+            else:
+                print "--resume should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
+        elif opt == "--lazy_input":
+            if arg.lower() == 'true':
+                rpspec['lazy_input'] = True
+            elif arg.lower() == 'false':
+                rpspec['lazy_input'] = False
+            else:
+                print "--lazy_input should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
 
         # Parallel execution arguments.
         elif opt == "--parallel_input_files":
@@ -952,8 +2028,38 @@ if __name__ == '__main__':
                 "Exceeded number of allowable processes. Use -c for info on processor availability."
         elif opt == "--parallel_api_key_files":
             add_keys = arg.split('|')
+        elif opt == "--workers":
+            n_workers = int(arg)
+            assert n_workers <= multiprocessing.cpu_count(), \
+                "Exceeded number of allowable processes. Use -c for info on processor availability."
 
-    if add_inputs:
+    if n_workers:
+        assert not add_inputs, "Use either --workers or --parallel_input_files."
+        # Worker processes take the keys in turn (-k last, as with parallel input files); workers sharing a key share
+        #   its query rate and quotas, and with a key pool every worker uses all keys and has its share of each.
+        worker_keys = add_keys + [initspec['api_key_file']]
+        pswd = raw_input("Type API key decoding password and press Enter...")
+        if pswd:
+            initspec['password'] = pswd
+        workers = []
+        for wi in range(n_workers):
+            winit = copy(initspec)
+            winit['api_key_file'] = worker_keys[wi % len(worker_keys)]
+            if initspec['pool_api_key_files']:
+                share = 1. / n_workers
+            else:
+                share = 1. / len([wj for wj in range(n_workers) if wj % len(worker_keys) == wi % len(worker_keys)])
+            winit['quota_share'] = share
+            workers.append({'init_args': winit, 'queries_per_second': initspec['queries_per_second'] * share})
+        print "Built", len(workers), "worker specs for", len(set(worker_keys)), "API keys."
+        # The coordinating miner makes no API calls.
+        coordinator_spec = copy(initspec)
+        coordinator_spec['api_key_file'] = None
+        coordinator_spec['pool_api_key_files'] = None
+        rpspec['workers'] = workers
+        g = GooglemapsAPIMiner(**coordinator_spec)
+        g.run_pipeline(**rpspec)
+    elif add_inputs:
         # Assemble full list of inputs. Then 'input_filename' in rpspec can be overwritten.
         add_inputs.append(copy(rpspec['input_filename']))
         # Assemble full list of API keys. Then 'api_key_file' in initspec can be overwritten.
@@ -2,8 +2,12 @@ import pytz
 import traceback
 import time
 import multiprocessing
+import threading
+import heapq
+import itertools
 import os
-from math import radians, cos, sin, sqrt, asin
+import numpy as np
+from math import radians, degrees, cos, sin, sqrt, asin, floor
 
 
 class PrintLogTee(object):
@@ -20,6 +24,178 @@ class PrintLogTee(object):
             fl.flush()
 
 
+class TokenBucket(object):
+    """
+    Thread-safe token bucket used to hold concurrent API calls to a queries-per-second quota. Tokens refill
+        continuously at 'rate' per second up to 'capacity'; acquire() blocks until a token is available.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens added per second (i.e., queries per second)
+        :param capacity: maximum number of tokens held, which bounds the size of a burst (default = rate)
+        :return: None
+        """
+        assert rate > 0, "Token bucket rate must be positive."
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(self.rate, 1.)
+        self.tokens = self.capacity
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, sleeping (outside of the lock) until enough have accumulated.
+        :param tokens: number of tokens to take
+        :return: seconds spent waiting
+        """
+        waited = 0.
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def available(self):
+        """
+        :return: number of tokens in the bucket right now
+        """
+        with self.lock:
+            return min(self.capacity, self.tokens + (time.time() - self.last_refill) * self.rate)
+
+
+class QueryScheduler(object):
+    """
+    Min-heap of queries keyed on the time they are due for execution. Queries are admitted in O(log n) while the
+        scheduler is running, and all queries due at the same instant are released together. Ties are broken by
+        admission order, so queries sharing a time come out in the order they were put in.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        # running totals of dispatch lag (seconds behind schedule) for released items
+        self.lag_count = 0
+        self.lag_total = 0.
+        self.lag_max = 0.
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, due_time, item):
+        """
+        Admit an item for execution at due_time.
+        :param due_time: comparable time (e.g., timezone-aware datetime) at which the item is due
+        :param item: query to be executed
+        :return: None
+        """
+        heapq.heappush(self.heap, (due_time, next(self.counter), item))
+
+    def next_time(self):
+        """
+        :return: due time of the earliest item, None if the scheduler is empty
+        """
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """
+        Release every item due at or before now.
+        :param now: current time, comparable to the due times
+        :return: list of (due_time, item) tuples in due order
+        """
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due_time, _, item = heapq.heappop(self.heap)
+            due.append((due_time, item))
+        return due
+
+    def record_lag(self, due_time, dispatch_time):
+        """
+        Record when a released item was actually dispatched.
+        :param due_time: time the item was due
+        :param dispatch_time: time the item was dispatched
+        :return: lag in seconds (negative if early)
+        """
+        lag = (dispatch_time - due_time).total_seconds()
+        self.lag_count += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        return lag
+
+    def lag_summary(self):
+        """
+        :return: (count, mean lag, max lag) in seconds over all recorded dispatches
+        """
+        if not self.lag_count:
+            return 0, 0., 0.
+        return self.lag_count, self.lag_total / self.lag_count, self.lag_max
+
+
+class LocationIndex(object):
+    """
+    Grid hash of (latitude, longitude) points for finding the nearest point within a radius without scanning all of
+        them. Points fall in square cells of cell_size degrees; a query checks only the cells its radius overlaps,
+        using haversine distance over all points in them at once. Points can be added at any time.
+    """
+    def __init__(self, points=(), cell_size=0.002):
+        """
+        :param points: iterable of (latitude, longitude) tuples to start with
+        :param cell_size: width of grid cells in degrees (default is roughly 700 feet of latitude)
+        :return: None
+        """
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.count = 0
+        for p in points:
+            self.add(p)
+
+    def __len__(self):
+        return self.count
+
+    def _cell(self, lat, lng):
+        return int(floor(lat / self.cell_size)), int(floor(lng / self.cell_size))
+
+    def add(self, point):
+        """
+        Add a point to the index (points already indexed are ignored).
+        :param point: (latitude, longitude) tuple
+        :return: None
+        """
+        cell = self.cells.setdefault(self._cell(point[0], point[1]), set())
+        if point not in cell:
+            cell.add(point)
+            self.count += 1
+
+    def nearest(self, lat, lng, radius):
+        """
+        Find the indexed point closest to a location, if any is within the radius.
+        :param lat: latitude of the location
+        :param lng: longitude of the location
+        :param radius: search radius in miles
+        :return: tuple of (distance in miles, (latitude, longitude) point), None if no point is within the radius
+        """
+        # degrees of latitude spanned by the radius, and of longitude at the most poleward latitude searched
+        dlat = degrees(radius / 3956.)
+        max_lat = min(abs(lat) + dlat, 89.9)
+        dlng = min(dlat / cos(radians(max_lat)), 180.)
+        lat_lo, lng_lo = self._cell(lat - dlat, lng - dlng)
+        lat_hi, lng_hi = self._cell(lat + dlat, lng + dlng)
+        candidates = [p for ci in xrange(lat_lo, lat_hi + 1) for cj in xrange(lng_lo, lng_hi + 1)
+                      for p in self.cells.get((ci, cj), ())]
+        if not candidates:
+            return None
+        cand = np.array(candidates, dtype=float)
+        d = haversine_array(lng, lat, cand[:, 1], cand[:, 0])
+        nearest = d.argmin()
+        if d[nearest] > radius:
+            return None
+        return float(d[nearest]), candidates[nearest]
+
+
 tzmap = {'p': 'US/Pacific', 'pst': 'US/Pacific', 'pdt': 'US/Pacific',
          'pacific': 'US/Pacific', 'us/pacific': 'US/Pacific',
          'm': 'US/Mountain', 'mst': 'US/Mountain', 'mdt': 'US/Mountain',
@@ -77,6 +253,189 @@ def recursive_get(obj, gets):
         return ''
 
 
+def compile_getter(gets):
+    """
+    Compile a tuple of depth-wise calls into a function that reaches down them, as recursive_get(...) does, without
+        the recursion and slicing of each call.
+    :param gets: Tuple of successive depths to reach into nested structure (keys and indices).
+    :return: function of the nested structure returning the value, or '' on Key, Index or Type exception
+    """
+    gets = tuple(gets)
+    if all([isinstance(g, (int, long, basestring)) for g in gets]):
+        source = "def getter(obj):\n    try:\n        return obj%s\n    except (KeyError, IndexError, TypeError):\n" \
+                 "        return ''\n" % ''.join(['[%r]' % (g,) for g in gets])
+        namespace = {}
+        exec source in namespace
+        return namespace['getter']
+
+    def getter(obj):
+        try:
+            for g in gets:
+                obj = obj[g]
+            return obj
+        except (KeyError, IndexError, TypeError):
+            return ''
+    return getter
+
+
+class OutputSpec(object):
+    """
+    Output columns (get_outputs of GooglemapsAPIMiner.output_results(...)) compiled once into getter functions.
+    Paths are tuples of depth-wise calls as for recursive_get(...). A '*' in a path takes every element of the list at
+        that depth, which makes the output long: one row for each element found, e.g., for each step of each leg with
+        (0, 'legs', '*', 'steps', '*', 'duration', 'value'). Every '*' path must follow the same elements as the
+        deepest one up to its last '*' (columns of legs can be mixed with columns of their steps, and paths without '*'
+        are repeated on every row), and index columns for each '*' (e.g., 'leg_index', 'step_index') come first.
+    Rows can be kept only where other paths have given values, e.g., {(0, 'legs', '*', 'steps', '*', 'travel_mode'):
+        'TRANSIT'} for one row per transit step. A result with no rows kept (or no result) still gets one row, of
+        empty values.
+    """
+    def __init__(self, outputs, where=None):
+        """
+        :param outputs: dict of column headers (keys) with tuples of the depth-wise calls to make to each result
+        :param where: dict of tuples of depth-wise calls to the value a row must have there to be kept (long output)
+        :return: None
+        """
+        self.names = list(outputs.keys())
+        paths = [tuple(p) for p in outputs.values()]
+        conditions = [(tuple(p), v) for p, v in (where.items() if where else [])]
+        # deepest '*' path, which every other '*' path must follow
+        prefixes = [p[:len(p) - p[::-1].index('*')] for p in paths + [c[0] for c in conditions] if '*' in p]
+        self.prefix = max(prefixes, key=len) if prefixes else ()
+        for pre in prefixes:
+            if self.prefix[:len(pre)] != pre:
+                raise ValueError("Paths with '*' must follow the same elements: %s and %s" % (pre, self.prefix))
+        self.long = bool(self.prefix)
+        assert self.long or not conditions, "Rows can only be selected in long output (paths with '*')."
+        # getters between each '*' of the prefix, and for each column from the object at its last '*'
+        segments = [[]]
+        for g in self.prefix:
+            if g == '*':
+                segments.append([])
+            else:
+                segments[-1].append(g)
+        self.level_getters = [compile_getter(seg) for seg in segments[:-1]]
+        self.index_names = []
+        for li in range(len(self.level_getters)):
+            before = [g for g in segments[li] if isinstance(g, basestring)]
+            stem = before[-1][:-1] if before and before[-1].endswith('s') else (before[-1] if before else 'route')
+            name, n = stem + '_index', 1
+            while name in self.index_names:
+                n += 1
+                name = "%s%d_index" % (stem, n)
+            self.index_names.append(name)
+
+        def compile_column(path):
+            level = path.count('*')
+            return level, compile_getter(path[len(path) - path[::-1].index('*'):] if level else path)
+
+        self.columns = [compile_column(p) for p in paths]
+        self.conditions = [compile_column(p) + (v,) for p, v in conditions]
+        self.header = self.index_names + self.names
+
+    def _levels(self, result):
+        """
+        :return: list of (indices, objects at each '*' level) for every element matched by the prefix
+        """
+        matches = [((), (result,))]
+        for getter in self.level_getters:
+            deeper = []
+            for indices, objs in matches:
+                elements = getter(objs[-1])
+                if isinstance(elements, (list, tuple)):
+                    deeper += [(indices + (i,), objs + (el,)) for i, el in enumerate(elements)]
+            matches = deeper
+        return matches
+
+    def rows(self, result):
+        """
+        :param result: query result (list of routes)
+        :return: list of rows (lists of values in header order): one row for wide output, one per match for long
+            output, or one row of empty values if nothing matches (e.g., a failed query), so every result has a row
+        """
+        if not self.long:
+            return [[getter(result) for _, getter in self.columns]]
+        rows = [list(indices) + [getter(objs[level]) for level, getter in self.columns]
+                for indices, objs in self._levels(result)
+                if all([getter(objs[level]) == value for level, getter, value in self.conditions])]
+        return rows if rows else [[''] * len(self.header)]
+
+
+# fields of each leg kept by every retention profile (all of the default CSV output and the split transit bookkeeping)
+_leg_summary = ['distance', 'duration', 'duration_in_traffic', 'start_location', 'end_location', 'start_address',
+                'end_address', 'departure_time', 'arrival_time']
+_step_summary = ['travel_mode', 'distance', 'duration', 'start_location', 'end_location', 'transit_details']
+# named retention profiles for GooglemapsAPIMiner(retention_profile=...), as lists of paths to keep
+retention_profiles = {
+    # route and leg totals, locations and times, and the overview polyline
+    'summary': [('*', f) for f in ['summary', 'fare', 'overview_polyline']] +
+               [('*', 'legs', '*', f) for f in _leg_summary],
+    # summary, plus each step's mode, totals, locations and transit details (lines, stops, times, headsigns)
+    'transit': [('*', f) for f in ['summary', 'fare', 'overview_polyline']] +
+               [('*', 'legs', '*', f) for f in _leg_summary] +
+               [('*', 'legs', '*', 'steps', '*', f) for f in _step_summary]}
+
+
+class RetentionProfile(object):
+    """
+    Parts of a query result to keep, applied to each result as it arrives to cut what is held in memory (HTML
+        instructions, step polylines, sub-steps, warnings... are dropped unless kept). Paths are tuples of depth-wise
+        calls as for recursive_get(...), with '*' taking every element at that depth. Pruned results keep the nesting
+        and list positions of the original, so the same paths (and output columns) reach the same values.
+    """
+    def __init__(self, keep):
+        """
+        :param keep: name of a profile in retention_profiles, or list of tuples of depth-wise calls to keep
+        :return: None
+        """
+        if isinstance(keep, basestring):
+            assert keep in retention_profiles, "Retention profile must be one of %s." % sorted(retention_profiles)
+            self.name = keep
+            keep = retention_profiles[keep]
+        else:
+            self.name = 'custom'
+        self.keep = [tuple(p) for p in keep]
+        self.tree = self._build(self.keep)
+
+    def _build(self, paths):
+        """
+        :return: True to keep everything below, otherwise dict of key or index -> subtree ('*' for every element)
+        """
+        if () in paths:
+            return True
+        groups = {}
+        for p in paths:
+            groups.setdefault(p[0], []).append(p[1:])
+        if '*' in groups:
+            # specific elements also get what is kept for every element
+            for g in groups:
+                if g != '*':
+                    groups[g] += groups['*']
+        return {g: self._build(sub) for g, sub in groups.items()}
+
+    def prune(self, result):
+        """
+        :param result: query result (list of routes)
+        :return: new nested structure holding only the kept paths (values kept whole are shared with result)
+        """
+        return self._prune(result, self.tree)
+
+    def _prune(self, obj, tree):
+        if tree is True:
+            return obj
+        if isinstance(obj, dict):
+            if '*' in tree:
+                return {k: self._prune(v, tree.get(k, tree['*'])) for k, v in obj.items()}
+            return {k: self._prune(obj[k], sub) for k, sub in tree.items() if k in obj}
+        if isinstance(obj, list):
+            if '*' in tree:
+                return [self._prune(el, tree.get(i, tree['*'])) for i, el in enumerate(obj)]
+            # elements before the last one kept stay as None so that list positions don't move
+            last = max([g for g in tree if isinstance(g, (int, long)) and g >= 0] + [-1])
+            return [self._prune(el, tree[i]) if i in tree else None for i, el in enumerate(obj[:last + 1])]
+        return obj
+
+
 def localize_to_query_timezone(time_in_query, timezone_in_query):
     if timezone_in_query.lower() in tzmap:
         query_tz = pytz.timezone(tzmap[timezone_in_query.lower()])
@@ -100,34 +459,74 @@ def decode_polyline(polyline_str):
     """
     Uses Google Maps polyline encoding to take polyline string back to lat/long coordinates.
     :param polyline_str: Google Maps encoded polyline
-    :return: list of lat/long tuples
-    """
-    index, lat, lng = 0, 0, 0
-    coordinates = []
-    changes = {'latitude': 0, 'longitude': 0}
-
-    # Coordinates have variable length when encoded, so just keep
-    # track of whether we've hit the end of the string. In each
-    # while loop iteration, a single coordinate is decoded.
-    while index < len(polyline_str):
-        # Gather lat/lon changes, store them in a dictionary to apply them later
-        for unit in ['latitude', 'longitude']:
-            shift, result = 0, 0
-            while True:
-                byte = ord(polyline_str[index]) - 63
-                index += 1
-                result |= (byte & 0x1f) << shift
-                shift += 5
-                if not byte >= 0x20:
-                    break
-            if (result & 1):
-                changes[unit] = ~(result >> 1)
-            else:
-                changes[unit] = (result >> 1)
-        lat += changes['latitude']
-        lng += changes['longitude']
-        coordinates.append((lat / 100000.0, lng / 100000.0))
-    return coordinates
+    :return: (n, 2) array of lat/long rows
+    """
+    return decode_polylines([polyline_str])[0]
+
+
+def decode_polylines(polyline_strs):
+    """
+    Decode many Google Maps encoded polylines at once into one array of coordinates, e.g., every transit leg of a
+        results pickle (see gather_step_polylines(...)).
+    Each character carries 5 bits of a value and a flag for whether the value continues into the next character, so
+        the values are found by their terminating characters and summed from their 5-bit chunks in one pass over all
+        polylines. Values alternate latitude/longitude changes in units of 1e-5 degrees, accumulated from the start of
+        each polyline.
+    :param polyline_strs: list of Google Maps encoded polylines
+    :return: tuple of ((n, 2) array of lat/long rows of all polylines, array of len(polyline_strs) + 1 offsets into
+        it), so polyline i is coordinates[offsets[i]:offsets[i + 1]]
+    """
+    char_offsets = np.cumsum([0] + [len(ps) for ps in polyline_strs])
+    if not char_offsets[-1]:
+        return np.zeros((0, 2)), np.zeros(len(char_offsets), dtype=np.int64)
+    # polylines from the API are unicode, but only use printable ASCII
+    chars = np.frombuffer(str(''.join(polyline_strs)), dtype=np.uint8).astype(np.int64) - 63
+    value_ends = np.flatnonzero(chars < 0x20)
+    # number of values before the start of each polyline, which must each end with a complete lat/long pair
+    value_offsets = np.searchsorted(value_ends, char_offsets)
+    ended = char_offsets[1:] > 0
+    if not len(value_ends) or np.any(value_offsets % 2) or \
+            np.any(value_ends[value_offsets[1:][ended] - 1] != char_offsets[1:][ended] - 1):
+        raise ValueError("Incomplete encoded polyline.")
+    value_starts = np.concatenate(([0], value_ends[:-1] + 1))
+    # position of each character within its value, giving the shift of its 5 bits
+    chunk = np.arange(len(chars)) - np.repeat(value_starts, value_ends - value_starts + 1)
+    values = np.add.reduceat((chars & 0x1f) << (5 * chunk), value_starts)
+    # zig-zag sign: odd values are negative
+    deltas = ((values >> 1) ^ -(values & 1)).reshape(-1, 2)
+    coordinates = np.cumsum(deltas, axis=0)
+    # restart the running sum at each polyline
+    offsets = value_offsets // 2
+    restart = np.zeros((len(polyline_strs), 2), dtype=np.int64)
+    started = offsets[:-1] > 0
+    restart[started] = coordinates[offsets[:-1][started] - 1]
+    coordinates -= np.repeat(restart, np.diff(offsets), axis=0)
+    return coordinates / 100000.0, offsets
+
+
+def gather_step_polylines(results, travel_mode='TRANSIT'):
+    """
+    Collect the encoded polylines of the route steps in a list of results, for decoding together.
+    :param results: list of query results, or of split result groups ([id stub, result, result, ...])
+    :param travel_mode: only steps of this travel mode (all steps if None)
+    :return: list of encoded polylines, and list of (result index, result index within group, step index) of each
+    """
+    polylines = []
+    keys = []
+    for ri, res in enumerate(results):
+        group = res[1:] if res and isinstance(res[0], basestring) else [res]
+        for gi, r in enumerate(group):
+            steps = recursive_get(r, (0, 'legs', 0, 'steps'))
+            for si, st in enumerate(steps if steps else []):
+                if travel_mode is None or st['travel_mode'] == travel_mode:
+                    polylines.append(st['polyline']['points'])
+                    keys.append((ri, gi, si))
+    return polylines, keys
+
+
+# mean radius of the earth in meters
+earth_radius_m = 6371008.8
+meters_per_mile = 1609.344
 
 
 def haversine(lon1, lat1, lon2, lat2):
@@ -151,30 +550,108 @@ def haversine(lon1, lat1, lon2, lat2):
     return c * r
 
 
+def haversine_array(lon1, lat1, lon2, lat2):
+    """
+    Calculate the great circle distance between arrays of points (specified in decimal degrees), elementwise with
+        NumPy broadcasting (e.g., one point against many).
+    :param lon1: longitude(s) of point(s) 1
+    :param lat1: latitude(s) of point(s) 1
+    :param lon2: longitude(s) of point(s) 2
+    :param lat2: latitude(s) of point(s) 2
+    :return: array of distances in miles
+    """
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(v, dtype=float)) for v in (lon1, lat1, lon2, lat2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    # radius of earth in miles, as in haversine(...)
+    return 2 * np.arcsin(np.minimum(np.sqrt(a), 1.)) * 3956
+
+
+def haversine_matrix(lon1, lat1, lon2, lat2, chunk_size=1000000):
+    """
+    Calculate the great circle distance from every point of one set to every point of another, a chunk of rows at a
+        time so that intermediate arrays hold at most chunk_size distances.
+    :param lon1: array of m longitudes of the first set
+    :param lat1: array of m latitudes of the first set
+    :param lon2: array of n longitudes of the second set
+    :param lat2: array of n latitudes of the second set
+    :param chunk_size: largest number of distances to compute at once
+    :return: (m, n) array of distances in miles
+    """
+    lon1, lat1 = np.asarray(lon1, dtype=float), np.asarray(lat1, dtype=float)
+    lon2, lat2 = np.asarray(lon2, dtype=float)[np.newaxis, :], np.asarray(lat2, dtype=float)[np.newaxis, :]
+    dist = np.empty((len(lon1), lon2.shape[1]))
+    step = max(chunk_size // max(lon2.shape[1], 1), 1)
+    for ci in range(0, len(lon1), step):
+        dist[ci:ci + step] = haversine_array(lon1[ci:ci + step, np.newaxis], lat1[ci:ci + step, np.newaxis], lon2, lat2)
+    return dist
+
+
+def haversine_nearest(lon1, lat1, lon2, lat2, chunk_size=1000000):
+    """
+    Find the nearest point of a second set to every point of a first set, without holding the full distance matrix.
+    :param lon1: array of m longitudes of the first set
+    :param lat1: array of m latitudes of the first set
+    :param lon2: array of n longitudes of the second set (n > 0)
+    :param lat2: array of n latitudes of the second set
+    :param chunk_size: largest number of distances to compute at once
+    :return: tuple of ((m,) array of distances in miles, (m,) array of indices into the second set)
+    """
+    lon1, lat1 = np.asarray(lon1, dtype=float), np.asarray(lat1, dtype=float)
+    dist = np.empty(len(lon1))
+    index = np.empty(len(lon1), dtype=np.int64)
+    step = max(chunk_size // max(len(lon2), 1), 1)
+    for ci in range(0, len(lon1), step):
+        d = haversine_matrix(lon1[ci:ci + step], lat1[ci:ci + step], lon2, lat2, chunk_size=chunk_size)
+        index[ci:ci + step] = d.argmin(axis=1)
+        dist[ci:ci + step] = d[np.arange(len(d)), index[ci:ci + step]]
+    return dist, index
+
+
 def line_interpolate_points(points, fracs):
     """
     Using a series of points that make up connected line segments, interpolate the location of fractional lengths.
-    :param points: list of point tuples defining connected line segments (i.e., polyline)
-    :param fracs: list of fractional lengths at which to interpolate the location in cartesian space
-    :return: list of point tuples with dimension the same as fracs
-    """
-    dist = [haversine(p1[0], p1[1], p2[0], p2[1]) for p1, p2 in zip(points[:-1], points[1:])]
-    dist_sum = sum(dist)
-    assert all([fr <= 1. for fr in fracs]), "Can only interpolate up to 100% of length (fracs = 1.0)."
-    interp = []
-    for fr in fracs:
-        frd = dist_sum * fr
-        dist_cumul = 0.
-        for i in range(len(dist)):
-            if dist_cumul + dist[i] > frd:
-                p1 = points[i]
-                p2 = points[i+1]
-                break
-            else:
-                dist_cumul += dist[i]
-        fp = 1. - ((frd - dist_cumul) / dist[i])
-        pi = (p1[0] + (p2[0] - p1[0]) * fp, p1[1] + (p2[1] - p1[1]) * fp)
-        interp.append(pi)
+    :param points: (n, 2) array or list of (latitude, longitude) points defining connected line segments (polyline)
+    :param fracs: list of fractional lengths [0.0, 1.0] at which to interpolate the location, measured along the
+        great circle length of the polyline and placed linearly within the segment they fall on
+    :return: (len(fracs), 2) array of (latitude, longitude) points
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return line_interpolate_points_batch(points, [0, len(points)], fracs)[0]
+
+
+def line_interpolate_points_batch(coordinates, offsets, fracs):
+    """
+    Interpolate the location of fractional lengths along many polylines at once, e.g., as decoded by
+        decode_polylines(...). The cumulative length of all polylines is computed once, and every fraction is located
+        on its segment with a single binary search.
+    :param coordinates: (n, 2) array of (latitude, longitude) rows of all polylines
+    :param offsets: array of k + 1 offsets into coordinates, so polyline i is coordinates[offsets[i]:offsets[i + 1]]
+    :param fracs: list of m fractional lengths [0.0, 1.0] for every polyline, or (k, m) array of them per polyline
+    :return: (k, m, 2) array of (latitude, longitude) points (NaN for empty polylines)
+    """
+    coordinates = np.asarray(coordinates, dtype=float)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_lines = len(offsets) - 1
+    fracs = np.broadcast_to(np.asarray(fracs, dtype=float), (n_lines, np.shape(fracs)[-1]))
+    assert np.all((fracs >= 0.) & (fracs <= 1.)), "Can only interpolate 0% to 100% of length (fracs in [0.0, 1.0])."
+    if not len(coordinates):
+        return np.full(fracs.shape + (2,), np.nan)
+    # great circle length of each segment, with the segments joining one polyline to the next counted as zero
+    seg_dist = haversine_array(coordinates[:-1, 1], coordinates[:-1, 0], coordinates[1:, 1], coordinates[1:, 0])
+    seg_dist[offsets[1:-1][offsets[1:-1] > 0] - 1] = 0.
+    cumul = np.concatenate(([0.], np.cumsum(seg_dist)))
+    first = np.minimum(offsets[:-1], len(coordinates) - 1)[:, np.newaxis]
+    last = np.maximum(offsets[1:, np.newaxis] - 1, first)
+    target = cumul[first] + fracs * (cumul[last] - cumul[first])
+    # segment holding each target (from point seg to point seg + 1), kept within its own polyline
+    seg = np.clip(np.searchsorted(cumul, target, side='right') - 1, first, np.maximum(last - 1, first))
+    nxt = np.minimum(seg + 1, last)
+    seg_len = cumul[nxt] - cumul[seg]
+    t = np.clip((target - cumul[seg]) / np.where(seg_len > 0., seg_len, 1.), 0., 1.)
+    # a fraction of 1.0 is the last point, even after zero-length segments
+    t[(target >= cumul[last]) & (nxt > seg)] = 1.
+    interp = coordinates[seg] + (coordinates[nxt] - coordinates[seg]) * t[..., np.newaxis]
+    interp[offsets[1:] == offsets[:-1]] = np.nan
     return interp
 
 
@@ -205,27 +682,141 @@ def dist_to_segment(ax, ay, bx, by, cx, cy):
         return min(sqrt((ax - cx)**2 + (ay - cy)**2), sqrt((bx - cx)**2 + (by - cy)**2))
 
 
-def reprocess_csv(query_filename, results_pickle_filename, split_transit, cache_included=True, queries_included=True):
+def point_to_polyline_distance(points, polyline, chunk_size=1000000):
+    """
+    Computes, for many points at once, the minimum distance in meters from each point to a polyline and how far along
+        the polyline the nearest spot is. Points and polyline are projected to a local equirectangular plane centered
+        on the polyline (meters east and north), which is accurate to well under a percent over the tens of miles of a
+        transit leg, and every point is measured against every segment in chunks of at most chunk_size pairs.
+    :param points: (m, 2) array or list of (latitude, longitude) points
+    :param polyline: (n, 2) array or list of (latitude, longitude) points defining connected line segments
+    :param chunk_size: largest number of point-segment pairs to hold in memory at once
+    :return: tuple of ((m,) array of distances in meters, (m,) array of along-track positions in meters from the start
+        of the polyline)
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    polyline = np.asarray(polyline, dtype=float).reshape(-1, 2)
+    assert len(polyline), "Polyline needs at least one point."
+    lat0 = radians(polyline[:, 0].mean())
+
+    def project(latlng):
+        return np.column_stack((np.radians(latlng[:, 1]) * cos(lat0), np.radians(latlng[:, 0]))) * earth_radius_m
+
+    pl = project(polyline)
+    pt = project(points)
+    if len(pl) == 1:
+        return np.hypot(pt[:, 0] - pl[0, 0], pt[:, 1] - pl[0, 1]), np.zeros(len(pt))
+    a = pl[:-1]
+    ab = pl[1:] - a
+    ab_sq = (ab ** 2).sum(axis=1)
+    cumul = np.concatenate(([0.], np.cumsum(np.sqrt(ab_sq))))
+    dist = np.empty(len(pt))
+    along = np.empty(len(pt))
+    step = max(chunk_size // len(a), 1)
+    for ci in range(0, len(pt), step):
+        p = pt[ci:ci + step, np.newaxis, :]
+        # position of the foot of the perpendicular along each segment, kept on the segment
+        t = np.clip(((p - a) * ab).sum(axis=2) / np.where(ab_sq > 0., ab_sq, 1.), 0., 1.)
+        d_sq = ((a + t[..., np.newaxis] * ab - p) ** 2).sum(axis=2)
+        nearest = d_sq.argmin(axis=1)
+        rows = np.arange(len(nearest))
+        dist[ci:ci + step] = np.sqrt(d_sq[rows, nearest])
+        along[ci:ci + step] = cumul[nearest] + t[rows, nearest] * (cumul[nearest + 1] - cumul[nearest])
+    return dist, along
+
+
+def recorded_format(recorded):
+    """
+    Tell how results were recorded in an output pickle, which has changed over versions of GooglemapsAPIMiner.
+    :param recorded: object loaded from an output pickle
+    :return: tuple of T/F (split transit result groups, split cache included, queries included)
+    """
+    if isinstance(recorded, dict):
+        results = recorded['results']
+        cache_included, queries_included = 'split_cache' in recorded, bool(recorded.get('queries'))
+    else:
+        results, cache_included, queries_included = recorded, False, False
+    # split transit results are grouped as [id stub, result, result, ...]
+    split = any([isinstance(res, list) and res and isinstance(res[0], basestring) for res in results])
+    return split, cache_included, queries_included
+
+
+def query_id_key(qid):
+    """
+    Numbers in a query id of GooglemapsAPIMiner, '<input query number><split station number, 4 digits>-<part>' (part
+        0, or 1/2 of a split pair), to put ids in order: input query numbers have 4 digits or more, so ids of inputs
+        over 9,999 queries don't sort as strings.
+    :param qid: query id, or its stub before the '-' (as in split result groups)
+    :return: tuple of integers (input query number, split station number, part)
+    """
+    stub, _, part = qid.partition('-')
+    return int(stub[:-4]), int(stub[-4:]), int(part) if part else 0
+
+
+def reprocess_csv(query_filename, results_pickle_filename, split_transit=None, cache_included=None,
+                  queries_included=None, output_filename=None, get_outputs=None, outputs_where=None,
+                  write_columnar=False, retention_profile=None):
+    """
+    Write the output of recorded results again (e.g., with different output columns) without executing any queries.
+    :param query_filename: input file the results were gathered for
+    :param results_pickle_filename: output pickle of the results, or the '.journal' of the run, which is replayed a
+        record at a time so that only the retained parts of each result are held (see retention_profile); a pickle is
+        loaded whole, so it needs memory for all of its results until they are pruned
+    :param split_transit: T/F results are split transit result groups (None to tell from the recorded results)
+    :param cache_included: T/F pickle is a dictionary with the split cache (None to tell from the pickle)
+    :param queries_included: T/F pickle is a dictionary with the executed queries (None to tell from the pickle)
+    :param output_filename: (optional) override 'output_' + query_filename for output files
+    :param get_outputs: output columns, see GooglemapsAPIMiner.output_results(...)
+    :param outputs_where: row conditions of long output, see GooglemapsAPIMiner.output_results(...)
+    :param write_columnar: also write output columns as typed, memory-mappable arrays (see ColumnarWriter)
+    :param retention_profile: prune results as they are replayed from a journal, or each in place as soon as a pickle
+        is loaded (see RetentionProfile)
+    :return: number of results (result groups when splitting transit)
+    """
     from googlemaps_api_mining import GooglemapsAPIMiner
+    from result_journal import ResultJournal
     import cPickle
-    pkl = cPickle.load(open(results_pickle_filename, 'rb'))
-    rp = GooglemapsAPIMiner(api_key_file=None, split_transit=split_transit)
-
-    # need to load queries regardless of whether the full list is included in results - for the header and filename
-    rp.read_input_queries(input_filename=query_filename, verbose=False)
-    if queries_included:
-        rp.queries = pkl['queries']
-
-    if cache_included:
-        res = sorted(pkl['results'], key=lambda x: x[0])
-        cache = pkl['split_cache']
-        rp.split_reverse_cache = cache
+    if results_pickle_filename.endswith('.journal'):
+        if split_transit is None:
+            # queries of split pairs have ids ending in '-1' and '-2'
+            split_transit = any([r[0] == 'result' and not r[1].endswith('-0')
+                                 for r in ResultJournal(results_pickle_filename).replay()])
+        rp = GooglemapsAPIMiner(api_key_file=None, split_transit=split_transit, retention_profile=retention_profile)
+        rp.read_input_queries(input_filename=query_filename, verbose=False)
+        rp.resume_from_journal(journal_filename=results_pickle_filename)
+        if split_transit:
+            rp.results.sort(key=lambda x: query_id_key(x[0]))
     else:
-        res = sorted(pkl, key=lambda x: x[0])
-
-    rp.results = res
-    rp.output_results(write_csv=True, write_pickle=False)
-    return
+        with open(results_pickle_filename, 'rb') as f:
+            pkl = cPickle.load(f)
+        split, cache, queries = recorded_format(pkl)
+        split_transit = split if split_transit is None else split_transit
+        cache_included = cache if cache_included is None else cache_included
+        queries_included = queries if queries_included is None else queries_included
+        rp = GooglemapsAPIMiner(api_key_file=None, split_transit=split_transit, retention_profile=retention_profile)
+
+        # need to load queries regardless of whether the full list is included in results - for the header and filename
+        rp.read_input_queries(input_filename=query_filename, verbose=False)
+        if queries_included:
+            rp.queries = pkl['queries']
+
+        res = pkl['results'] if isinstance(pkl, dict) else pkl
+        if cache_included:
+            rp.split_reverse_cache = pkl['split_cache']
+        if rp.retention is not None:
+            # each full result is freed as its pruned copy replaces it
+            for ri, r in enumerate(res):
+                res[ri] = [r[0]] + [rp.retention.prune(part) for part in r[1:]] if split_transit \
+                    else rp.retention.prune(r)
+        # result groups are put in id order (in place), results of unsplit queries stay aligned with the queries
+        if split_transit:
+            res.sort(key=lambda x: query_id_key(x[0]))
+        rp.results = res
+        del pkl, res
+        rp.index_queries()
+    rp.output_results(output_filename=output_filename, write_csv=True, write_pickle=False, get_outputs=get_outputs,
+                      write_columnar=write_columnar, outputs_where=outputs_where)
+    return len(rp.results)
 
 
 # Multiprocessing testing
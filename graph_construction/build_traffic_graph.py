@@ -1,37 +1,33 @@
 import networkx as nx
-from tv_edge import TVEdge
-import csv
+from tv_edge import TVEdgeStore
+from traffic_graph import save_graph
+from network_csv import load_nodes, load_links, load_travel_times
+from travel_time_join import join_travel_times
 import datetime as dt
+import numpy as np
 
 # get nodes
 # nodes_file = '/Users/wbarbour1/Downloads/nodes.csv'
 # nodes_file = '/Users/wbarbour1/Google Drive/Classes/CEE_418/final_project/selected_nodes.csv'
 nodes_file = '/sata_ssd1/multimodal_graph/selected_nodes.csv'
-with open(nodes_file, 'r') as nf:
-    take_cols = [(0, long), (2, int), (3, int), (5, float), (6, float), (10, int)]
-    # if using selected nodes taken from QGIS, the (X, Y) coordinates will be added at the beginning of the columns
-    # activate the following to shift the indices of columns to take from the file and use the ';' delimiter
-    if True:
-        take_cols = [(tc[0] + 2, tc[1]) for tc in take_cols]
-        reader = csv.reader(nf, delimiter=';')
-    else:
-        reader = csv.reader(nf, delimiter=',')
-    nodes_h = reader.next()
-    nodes_h = [nodes_h[c] for c, ty in take_cols]
-    nodes = [[ty(line[c]) for c, ty in take_cols] for line in reader]
-    print len(nodes), "nodes loaded."
+take_cols = [(0, np.int64), (2, np.int64), (3, np.int64), (5, np.float64), (6, np.float64), (10, np.int64)]
+# if using selected nodes taken from QGIS, the (X, Y) coordinates will be added at the beginning of the columns
+# activate the following to shift the indices of columns to take from the file and use the ';' delimiter
+if True:
+    take_cols = [(tc[0] + 2, tc[1]) for tc in take_cols]
+    delimiter = ';'
+else:
+    delimiter = ','
+nodes_h, nodes = load_nodes(nodes_file, take_cols, delimiter=delimiter)
+# sorted node ids, for filtering links and hourly records by binary search
+node_ids = np.unique(nodes[0])
 
-# get links
+# get links (both nodes in the graph)
 # links_file = '/Users/wbarbour1/Downloads/links.csv'
 links_file = '/sata_ssd1/multimodal_graph/links.csv'
-with open(links_file, 'r') as lf:
-    reader = csv.reader(lf, delimiter=',')
-    take_cols = [(1, long), (2, long), (5, float), (6, str), (7, str),
-                 (9, float), (10, float), (11, float), (12, float)]
-    links_h = reader.next()
-    links_h = [links_h[c] for c, ty in take_cols]
-    links = [[ty(line[c]) for c, ty in take_cols] for line in reader]
-    print len(links), "links loaded."
+take_cols = [(1, np.int64), (2, np.int64), (5, np.float64), (6, str), (7, str),
+             (9, np.float64), (10, np.float64), (11, np.float64), (12, np.float64)]
+links_h, links = load_links(links_file, take_cols, node_ids)
 
 year = '2013'
 day0 = dt.datetime.strptime('01/01/%s 00:00:00' % year, '%m/%d/%Y %H:%M:%S').date()
@@ -40,32 +36,37 @@ dayf = dt.datetime.strptime('03/31/%s 23:00:00' % year, '%m/%d/%Y %H:%M:%S').dat
 
 G = nx.DiGraph(name='Multimodal Routing Graph')
 
-for n in nodes:
+for n in zip(*[col.tolist() for col in nodes]):
     G.add_node(n=n[0], attr_dict=dict(zip(nodes_h[1:], n[1:])))
 print "Nodes added.\n"
 print nx.info(G), '\n'
 
+# hourly records of links in the graph, over the days held by the edge weights
 # hourly_data_file = '/Users/wbarbour1/Downloads/'
 hourly_data_file = '/sata_ssd1/multimodal_graph/travel_times_%s.csv' % year
-with open(hourly_data_file, 'r') as hf:
-    reader = csv.reader(hf, delimiter=',')
-    take_cols = [(0, long), (1, long), (2, str), (3, float)]
-    hourly_h = reader.next()
-    hourly_h = [hourly_h[c] for c, ty in take_cols]
-    hourly = [[ty(line[c]) for c, ty in take_cols] for line in reader]
-    print len(hourly), "hourly records loaded."
-    hourly = [h for h in hourly if h[0] and h[1] in G.nodes()]
-    print len(hourly), "hourly records retained."
+hourly_h, hourly = load_travel_times(hourly_data_file, node_ids, start=day0, stop=dayf)
 
-for l in links:
-    if l[0] and l[1] in G.nodes():
-        d = {day0 + dt.timedelta(days=i): {h: 10. for h in range(0, 24)} for i in range((dayf - day0).days)}
-        tve = TVEdge(data_map=d, tv_type='day:hour')
-        G.add_edge(u=l[0], v=l[1], attr_dict=dict(zip(links_h[2:], l[2:])), tve=tve)
+# hourly weights of all edges are held in one (edges, days, 24) float32 array, with each edge's TVEdge a handle into it
+tv_store = TVEdgeStore(n_edges=len(links[0]), day0=day0, n_days=(dayf - day0).days)
+for l in zip(*[col.tolist() for col in links]):
+    G.add_edge(u=l[0], v=l[1], attr_dict=dict(zip(links_h[2:], l[2:])), tve=tv_store.add_edge())
 print "Links added.\n"
+
+# hourly records into the edge weights (row i of the store is link i); hours without a record are filled from the
+#   previous hours, then from the edge's profile for the weekday, and edges with no records at all get the link's
+#   street_length (m) at 25 mph
+coverage = join_travel_times(tv_store, edge_sources=links[0], edge_targets=links[1], begin=hourly[0], end=hourly[1],
+                             hours=hourly[2], travel_times=hourly[3], impute=('previous_hour', 'day_of_week'),
+                             max_carry_hours=2, default=links[links_h.index('street_length')] / 11.176)
+print "Hourly travel times joined:"
+for k, v in coverage.items():
+    print "\t%s: %d" % (k, v)
+print "Edge weights: %d edges x %d days x %d hours, %.1f MB" % \
+      (tv_store.weights.shape + (tv_store.weights.nbytes / 1048576.,))
 print nx.info(G), '\n'
 
-# graph_dest_path = '/Users/wbarbour1/Downloads/graph_test1.gpkl'
-graph_dest_path = '/sata_ssd1/multimodal_graph/graph_test_full.gpkl'
-nx.write_gpickle(G, graph_dest_path)
-print "Graph written to file:", graph_dest_path
+# graph_dest_path = '/Users/wbarbour1/Downloads/graph_test1'
+# binary graph directory, opened with TrafficGraph(graph_dest_path) by memory-mapping instead of unpickling
+graph_dest_path = '/sata_ssd1/multimodal_graph/graph_test_full'
+save_graph(G, graph_dest_path)
+print "Graph written to directory:", graph_dest_path
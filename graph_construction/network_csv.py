@@ -0,0 +1,113 @@
+import csv
+import time
+import numpy as np
+
+
+def read_columns(filename, take_cols, delimiter=',', keep=None, chunk_rows=500000, name=None):
+    """
+    Stream a CSV file with a header into typed column arrays, a chunk of rows at a time. Each chunk is converted to
+        arrays and filtered before the next is read, so only the retained rows are held (as arrays, not Python lists).
+    :param filename: path of the CSV file
+    :param take_cols: list of (column index, numpy dtype) to take, e.g., (0, np.int64), (2, 'datetime64[s]'), (6, str)
+    :param delimiter: field delimiter
+    :param keep: function of a chunk's list of column arrays returning a boolean array of the rows to keep (all if None)
+    :param chunk_rows: rows converted at a time
+    :param name: what the rows are, for the report printed at the end (default = file name)
+    :return: tuple of (list of header names of the taken columns, list of column arrays)
+    """
+    t0 = time.time()
+    n_read = 0
+    chunks = [[] for _ in take_cols]
+    with open(filename, 'r') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = reader.next()
+        header = [header[c] for c, ty in take_cols]
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) >= chunk_rows:
+                _add_chunk(rows, take_cols, keep, chunks)
+                n_read += len(rows)
+                rows = []
+        if rows:
+            _add_chunk(rows, take_cols, keep, chunks)
+            n_read += len(rows)
+    columns = [np.concatenate(ch) if ch else np.array([], dtype=ty) for ch, (c, ty) in zip(chunks, take_cols)]
+    seconds = time.time() - t0
+    print "%d %s read, %d retained in %.1f sec (%.0f rows/sec)." % \
+          (n_read, name if name else filename, len(columns[0]) if columns else 0, seconds,
+           n_read / seconds if seconds else 0.)
+    return header, columns
+
+
+def _add_chunk(rows, take_cols, keep, chunks):
+    arrays = [np.array([r[c] for r in rows], dtype=ty) for c, ty in take_cols]
+    if keep is not None:
+        mask = keep(arrays)
+        arrays = [a[mask] for a in arrays]
+    for ch, a in zip(chunks, arrays):
+        ch.append(a)
+    return
+
+
+def isin_sorted(values, sorted_ids):
+    """
+    Membership of values in a sorted array of ids, by binary search (no per-row set or list lookups).
+    :param values: array of ids
+    :param sorted_ids: sorted array of ids
+    :return: boolean array
+    """
+    if not len(sorted_ids):
+        return np.zeros(len(values), dtype=bool)
+    pos = np.searchsorted(sorted_ids, values)
+    pos[pos >= len(sorted_ids)] = 0
+    return sorted_ids[pos] == values
+
+
+def load_nodes(nodes_file, take_cols, delimiter=',', chunk_rows=500000):
+    """
+    :param nodes_file: CSV of nodes (network_topo.nodes, node_id taken first)
+    :param take_cols: list of (column index, numpy dtype), the node id first
+    :return: tuple of (header names, column arrays)
+    """
+    return read_columns(nodes_file, take_cols, delimiter=delimiter, chunk_rows=chunk_rows, name='nodes')
+
+
+def load_links(links_file, take_cols, node_ids, delimiter=',', chunk_rows=500000):
+    """
+    Links whose begin and end nodes are both among the nodes.
+    :param links_file: CSV of links (network_topo.links)
+    :param take_cols: list of (column index, numpy dtype), begin and end node ids first
+    :param node_ids: sorted array of node ids
+    :return: tuple of (header names, column arrays)
+    """
+    def keep(arrays):
+        return isin_sorted(arrays[0], node_ids) & isin_sorted(arrays[1], node_ids)
+    return read_columns(links_file, take_cols, delimiter=delimiter, keep=keep, chunk_rows=chunk_rows, name='links')
+
+
+def load_travel_times(hourly_file, node_ids, start=None, stop=None, take_cols=None, delimiter=',',
+                      chunk_rows=1000000):
+    """
+    Hourly link travel times (travel_times.link_travel_times) of links between the nodes, within a time range.
+    :param hourly_file: CSV of begin node id, end node id, date_time and travel_time
+    :param node_ids: sorted array of node ids
+    :param start: (optional) first hour kept, as a datetime, date or numpy datetime64
+    :param stop: (optional) hours kept are before this
+    :param take_cols: list of (column index, numpy dtype) of the begin node id, end node id, hour and travel time
+    :return: tuple of (header names, column arrays)
+    """
+    if take_cols is None:
+        take_cols = [(0, np.int64), (1, np.int64), (2, 'datetime64[h]'), (3, np.float32)]
+    start = np.datetime64(start, 'h') if start is not None else None
+    stop = np.datetime64(stop, 'h') if stop is not None else None
+
+    def keep(arrays):
+        mask = isin_sorted(arrays[0], node_ids) & isin_sorted(arrays[1], node_ids)
+        if start is not None:
+            mask &= arrays[2] >= start
+        if stop is not None:
+            mask &= arrays[2] < stop
+        return mask
+    return read_columns(hourly_file, take_cols, delimiter=delimiter, keep=keep, chunk_rows=chunk_rows,
+                        name='hourly records')
@@ -0,0 +1,240 @@
+import datetime as dt
+import heapq
+import time
+import numpy as np
+from math import radians, cos, sin, asin, sqrt
+
+earth_radius_m = 6371008.8
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    """
+    Great circle distance in meters between points given in decimal degrees (elementwise over arrays).
+    """
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(a, dtype=np.float64)) for a in (lon1, lat1, lon2, lat2)]
+    a = np.sin((lat2 - lat1) / 2.) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return 2. * earth_radius_m * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+class TimeDependentRouter(object):
+    """
+    Time-dependent shortest paths over a TrafficGraph, with each edge's travel time (seconds) taken from its hourly
+        weights at the moment the edge is entered. Arrival times are made FIFO - entering an edge later never gets to
+        its end sooner - by taking, for each edge, the earliest arrival over entering now or at any later hour boundary
+        before that (i.e., waiting at the node if traffic clears), so label-setting search is exact.
+    With a heuristic, the search is A*: the remaining time is bounded below by the straight-line distance to the
+        destination at the fastest speed of any edge (its node-to-node distance over its least travel time), which is
+        admissible and consistent for these arrival times.
+    """
+    def __init__(self, graph, how='last', x_column='xcoord', y_column='ycoord', max_speed=None, chunk_edges=20000):
+        """
+        :param graph: TrafficGraph with weights and node coordinate columns
+        :param how: 'last' (each hour's weight holds for the whole hour) or 'linear' (interpolated to the next hour)
+        :param x_column: node column of longitude
+        :param y_column: node column of latitude
+        :param max_speed: fastest speed of any edge in m/s for the A* heuristic (default = None, found from the graph
+            the first time it is needed, which reads all of the weights once)
+        :param chunk_edges: edges' weights read at a time when finding max_speed
+        :return: None
+        """
+        assert how in ['last', 'linear'], "Argument 'how' must be 'last' or 'linear'."
+        assert graph.tv_store is not None, "Graph has no time-variant weights."
+        self.graph = graph
+        self.how = how
+        self.weights = graph.tv_store.weights
+        self.n_days = self.weights.shape[1]
+        self.epoch = dt.datetime.combine(graph.tv_store.day0, dt.time())
+        self.lng = np.asarray(graph.node_columns[x_column], dtype=np.float64)
+        self.lat = np.asarray(graph.node_columns[y_column], dtype=np.float64)
+        self.max_speed = max_speed
+        self.chunk_edges = chunk_edges
+
+    def find_max_speed(self):
+        """
+        :return: fastest speed of any edge in m/s (distance between its nodes over its least travel time)
+        """
+        sources, targets = self.graph.sources, self.graph.indices
+        fastest = 0.
+        for start in range(0, self.graph.n_edges, self.chunk_edges):
+            stop = min(start + self.chunk_edges, self.graph.n_edges)
+            chunk = np.asarray(self.weights[start:stop], dtype=np.float64).reshape(stop - start, -1)
+            with np.errstate(invalid='ignore'):
+                least = np.nanmin(np.where(chunk > 0, chunk, np.nan), axis=1)
+            d = haversine_m(self.lng[sources[start:stop]], self.lat[sources[start:stop]],
+                            self.lng[targets[start:stop]], self.lat[targets[start:stop]])
+            ok = np.isfinite(least)
+            if ok.any():
+                fastest = max(fastest, float((d[ok] / least[ok]).max()))
+        return fastest
+
+    def nearest_node(self, lat, lng):
+        """
+        :return: tuple of (node id, distance in meters) of the node closest to a location
+        """
+        d = haversine_m(lng, lat, self.lng, self.lat)
+        ni = int(np.nanargmin(d))
+        return self.graph.node_ids[ni].item(), float(d[ni])
+
+    def _arrivals(self, start, stop, t):
+        """
+        FIFO arrival times at the ends of edges start:stop (the edges out of one node) reached at t.
+        :param t: seconds since the first day of the weights
+        :return: tuple of arrays of arrival times (NaN where an edge has no weight) and the times each edge is entered
+            for them (t, or the later hour boundary waited for)
+        """
+        day, hour = int(t // 86400), int(t % 86400 // 3600)
+        if not 0 <= day < self.n_days:
+            raise ValueError("Time %s is outside of the graph's weights." % (self.epoch + dt.timedelta(seconds=t)))
+        arrive = t + self._weights_at(start, stop, day, hour, t)
+        entered = np.full(arrive.shape, t)
+        # entering at a later hour boundary may arrive sooner when traffic clears (non-FIFO weights)
+        boundary = (day * 24 + hour + 1) * 3600.
+        later = arrive > boundary
+        while later.any() and boundary < self.n_days * 86400:
+            bd, bh = int(boundary // 86400), int(boundary % 86400 // 3600)
+            waited = np.where(later, boundary + self._weights_at(start, stop, bd, bh, boundary), np.nan)
+            with np.errstate(invalid='ignore'):
+                sooner = waited < arrive
+            arrive = np.where(sooner, waited, arrive)
+            entered = np.where(sooner, boundary, entered)
+            boundary += 3600.
+            later = arrive > boundary
+        return arrive, entered
+
+    def _weights_at(self, start, stop, day, hour, t):
+        w = np.asarray(self.weights[start:stop, day, hour], dtype=np.float64)
+        if self.how == 'linear':
+            nd, nh = (day, hour + 1) if hour < 23 else (min(day + 1, self.n_days - 1), 0)
+            w = w + (np.asarray(self.weights[start:stop, nd, nh], dtype=np.float64) - w) * ((t % 3600.) / 3600.)
+        return w
+
+    def route(self, origin, destination, departure_time, heuristic=True):
+        """
+        Earliest arrival route between two nodes for a departure time.
+        :param origin: node id of the origin
+        :param destination: node id of the destination
+        :param departure_time: naive datetime (in the time of the travel time records)
+        :param heuristic: T/F use the A* heuristic (otherwise Dijkstra)
+        :return: dictionary of 'nodes' (node ids), 'edges' (edge numbers), 'departure_time', 'arrival_time',
+            'travel_time' (seconds), 'edge_times' (list of (edge number, from node id, to node id, entry datetime,
+            seconds waited at the from node before entering, seconds on the edge)), 'settled' (nodes searched) and
+            'seconds' (search time); None if unreachable
+        """
+        t0 = time.time()
+        g = self.graph
+        src, dst = g.node_index(origin), g.node_index(destination)
+        start_t = (departure_time - self.epoch).total_seconds()
+        if heuristic and self.max_speed is None:
+            self.max_speed = self.find_max_speed()
+        if heuristic and self.max_speed > 0:
+            # seconds to the destination at the fastest speed, worked out for nodes as they are reached
+            lat_d, lng_d, scale = radians(self.lat[dst]), radians(self.lng[dst]), 2. * earth_radius_m / self.max_speed
+            cos_d = cos(lat_d)
+
+            def h(v):
+                lat_v, lng_v = radians(self.lat[v]), radians(self.lng[v])
+                a = sin((lat_d - lat_v) / 2.) ** 2 + cos(lat_v) * cos_d * sin((lng_d - lng_v) / 2.) ** 2
+                return scale * asin(sqrt(min(a, 1.))) if a == a else 0.
+        else:
+            def h(v):
+                return 0.
+        best = {src: start_t}
+        previous = {}
+        settled = set()
+        heap = [(start_t + h(src), start_t, src)]
+        while heap:
+            _, t, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            if u == dst:
+                break
+            start, stop = int(g.indptr[u]), int(g.indptr[u + 1])
+            if start == stop:
+                continue
+            arrive, entered = self._arrivals(start, stop, t)
+            for ei, v, a, e in zip(xrange(start, stop), g.indices[start:stop].tolist(), arrive.tolist(),
+                                   entered.tolist()):
+                if a == a and v not in settled and a < best.get(v, float('inf')):
+                    best[v] = a
+                    previous[v] = (u, ei, t, e)
+                    heapq.heappush(heap, (a + h(v), a, v))
+        if dst not in settled:
+            return None
+        nodes, edge_times = [dst], []
+        v = dst
+        while v != src:
+            u, ei, t, e = previous[v]
+            edge_times.append((ei, g.node_ids[u].item(), g.node_ids[v].item(), self.epoch + dt.timedelta(seconds=e),
+                               e - t, best[v] - e))
+            nodes.append(u)
+            v = u
+        nodes.reverse()
+        edge_times.reverse()
+        return {'nodes': [g.node_ids[ni].item() for ni in nodes], 'edges': [e[0] for e in edge_times],
+                'departure_time': departure_time, 'arrival_time': self.epoch + dt.timedelta(seconds=best[dst]),
+                'travel_time': best[dst] - start_t, 'edge_times': edge_times, 'settled': len(settled),
+                'seconds': time.time() - t0}
+
+
+if __name__ == '__main__':
+    import getopt
+    import sys
+    usage = """
+    usage: td_router.py -g <graph_directory> -t <departure_time> -o <origin_node> -d <destination_node>
+            --[origin_location, destination_location, how, dijkstra]
+    ex: python td_router.py -g "/sata_ssd1/multimodal_graph/graph_test_full" -t "2013-02-05 08:30"
+            --origin_location "40.7128,-74.0060" --destination_location "40.7580,-73.9855"
+    note: locations are given as "lat,lng" and matched to the nearest node
+    """
+    graph_directory = None
+    departure = None
+    origin = destination = None
+    locations = {}
+    how = 'last'
+    use_heuristic = True
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hg:t:o:d:", ["origin_location=", "destination_location=", "how=",
+                                                               "dijkstra="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print usage
+            sys.exit(0)
+        elif opt == "-g":
+            graph_directory = arg
+        elif opt == "-t":
+            departure = dt.datetime.strptime(arg, '%Y-%m-%d %H:%M')
+        elif opt == "-o":
+            origin = long(arg)
+        elif opt == "-d":
+            destination = long(arg)
+        elif opt in ["--origin_location", "--destination_location"]:
+            locations[opt[2:]] = [float(x) for x in arg.split(',')]
+        elif opt == "--how":
+            how = arg
+        elif opt == "--dijkstra":
+            use_heuristic = arg.lower() != 'true'
+
+    from traffic_graph import TrafficGraph
+    t_open = time.time()
+    router = TimeDependentRouter(TrafficGraph(graph_directory), how=how)
+    print "Graph opened in %.1f ms." % ((time.time() - t_open) * 1000.)
+    if 'origin_location' in locations:
+        origin, off = router.nearest_node(*locations['origin_location'])
+        print "Origin node %d is %.0f m from the location." % (origin, off)
+    if 'destination_location' in locations:
+        destination, off = router.nearest_node(*locations['destination_location'])
+        print "Destination node %d is %.0f m from the location." % (destination, off)
+    found = router.route(origin, destination, departure, heuristic=use_heuristic)
+    if found is None:
+        print "No route from", origin, "to", destination
+        sys.exit(1)
+    print "Travel time %.1f min, arriving %s (%d edges, %d nodes searched in %.1f ms)" % \
+          (found['travel_time'] / 60., found['arrival_time'], len(found['edges']), found['settled'],
+           found['seconds'] * 1000.)
+    for ei, u, v, entered, wait, seconds in found['edge_times']:
+        print "\t%s  %d -> %d  %.1f sec%s" % (entered.strftime('%H:%M:%S'), u, v, seconds,
+                                              "  (after waiting %.1f sec)" % wait if wait else "")
@@ -0,0 +1,218 @@
+import datetime as dt
+import json
+import os
+import numpy as np
+from tv_edge import TVEdgeStore
+
+
+def _save_column(directory, name, values):
+    """
+    Save one node or edge attribute as a .npy file. Columns of integers are int64, other numbers are float64 with NaN
+        where missing, and anything else is int32 codes into a vocabulary file of the distinct values (code 0 is '').
+    :return: dictionary describing the column for graph.json
+    """
+    present = [v for v in values if v is not None and v != '']
+    col = {'name': name, 'file': name + '.npy'}
+    if present and all([isinstance(v, (int, long)) for v in present]) and len(present) == len(values):
+        col['kind'] = 'int'
+        array = np.array(values, dtype=np.int64)
+    elif present and all([isinstance(v, (int, long, float)) for v in present]):
+        col['kind'] = 'float'
+        array = np.array([v if v is not None and v != '' else np.nan for v in values], dtype=np.float64)
+    else:
+        col['kind'] = 'string'
+        vocabulary = {u'': 0}
+        array = np.zeros(len(values), dtype=np.int32)
+        for vi, v in enumerate(values):
+            if v is None or v == '':
+                continue
+            if isinstance(v, str):
+                v = v.decode('utf-8', 'replace')
+            elif not isinstance(v, unicode):
+                v = unicode(v)
+            array[vi] = vocabulary.setdefault(v, len(vocabulary))
+        col['vocabulary_file'] = name + '_vocabulary.npy'
+        np.save(os.path.join(directory, col['vocabulary_file']),
+                np.array([v for v, _ in sorted(vocabulary.items(), key=lambda x: x[1])], dtype=np.unicode_))
+    np.save(os.path.join(directory, col['file']), array)
+    return col
+
+
+def save_graph(G, directory, tve_attribute='tve', chunk_edges=10000):
+    """
+    Write a NetworkX DiGraph of the traffic network as a directory of .npy files that TrafficGraph opens by memory-
+        mapping them: sorted node ids, CSR adjacency (edges ordered by source, then target node), a file per node and
+        edge attribute, and the hourly weights of the edges' TVEdge handles as one (edges, days, 24) float32 array in
+        the same edge order. graph.json describes them.
+    :param G: networkx.DiGraph with integer node ids; 'day:hour' TVEdge handles of one TVEdgeStore in tve_attribute
+    :param directory: directory to write to (created if it doesn't exist)
+    :param tve_attribute: edge attribute holding each edge's TVEdge
+    :param chunk_edges: edges' weights copied at a time into the weights file
+    :return: None
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    node_data = dict(G.nodes(data=True))
+    node_ids = np.array(sorted(node_data.keys()), dtype=np.int64)
+    edges = list(G.edges(data=True))
+    src = np.searchsorted(node_ids, np.array([u for u, v, d in edges], dtype=np.int64))
+    dst = np.searchsorted(node_ids, np.array([v for u, v, d in edges], dtype=np.int64))
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(node_ids)), out=indptr[1:])
+    index_type = np.int32 if len(node_ids) < 2 ** 31 else np.int64
+    np.save(os.path.join(directory, 'node_ids.npy'), node_ids)
+    np.save(os.path.join(directory, 'indptr.npy'), indptr)
+    np.save(os.path.join(directory, 'indices.npy'), dst[order].astype(index_type))
+    meta = {'nodes': len(node_ids), 'edges': len(edges), 'node_columns': [], 'edge_columns': []}
+
+    node_names = sorted(set([k for d in node_data.values() for k in d]))
+    for name in node_names:
+        meta['node_columns'].append(_save_column(directory, 'node_' + name,
+                                                 [node_data[nid].get(name) for nid in node_ids.tolist()]))
+    edge_names = sorted(set([k for u, v, d in edges for k in d if k != tve_attribute]))
+    for name in edge_names:
+        meta['edge_columns'].append(_save_column(directory, 'edge_' + name,
+                                                 [edges[ei][2].get(name) for ei in order.tolist()]))
+
+    handles = [edges[ei][2].get(tve_attribute) for ei in order.tolist()]
+    if any([h is not None for h in handles]):
+        assert all([h is not None and h.tv_type == 'day:hour' for h in handles]), \
+            "Every edge needs a 'day:hour' TVEdge to save weights."
+        store = handles[0].store
+        assert all([h.store is store for h in handles]), "Edges' TVEdge handles must share one TVEdgeStore."
+        rows = np.array([h.index for h in handles], dtype=np.int64)
+        weights = np.lib.format.open_memmap(os.path.join(directory, 'weights.npy'), mode='w+', dtype=np.float32,
+                                            shape=(len(rows), store.n_days, store.hours_per_day))
+        for start in range(0, len(rows), chunk_edges):
+            weights[start:start + chunk_edges] = store.weights[rows[start:start + chunk_edges]]
+        weights.flush()
+        del weights
+        meta['weights'] = {'file': 'weights.npy', 'day0': store.day0.isoformat(), 'days': store.n_days}
+    with open(os.path.join(directory, 'graph.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return
+
+
+class TrafficGraph(object):
+    """
+    Traffic network saved by save_graph(...), opened by memory-mapping its files, so it is ready to query in
+        milliseconds and its pages are shared read-only among processes opening the same directory.
+    Nodes are numbered 0..nodes-1 in order of their ids, and edges 0..edges-1 in CSR order: the edges out of node i are
+        indptr[i]:indptr[i + 1], going to nodes indices[indptr[i]:indptr[i + 1]].
+    """
+    def __init__(self, directory, mmap_mode='r'):
+        """
+        :param directory: directory written by save_graph(...)
+        :param mmap_mode: numpy.load(...) memory-map mode, None to read the files into memory
+        :return: None
+        """
+        self.directory = directory
+        with open(os.path.join(directory, 'graph.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        def load(fn):
+            return np.load(os.path.join(directory, fn), mmap_mode=mmap_mode)
+
+        self.node_ids = load('node_ids.npy')
+        self.indptr = load('indptr.npy')
+        self.indices = load('indices.npy')
+        self.node_columns = {c['name'][len('node_'):]: self._load_column(c, load) for c in self.meta['node_columns']}
+        self.edge_columns = {c['name'][len('edge_'):]: self._load_column(c, load) for c in self.meta['edge_columns']}
+        if 'weights' in self.meta:
+            day0 = dt.datetime.strptime(self.meta['weights']['day0'], '%Y-%m-%d').date()
+            self.tv_store = TVEdgeStore.from_array(load(self.meta['weights']['file']), day0=day0)
+        else:
+            self.tv_store = None
+        self._sources = None
+
+    def _load_column(self, col, load):
+        """
+        :return: array of the column, or for strings a tuple of (int32 codes, vocabulary array)
+        """
+        if col['kind'] == 'string':
+            return load(col['file']), np.load(os.path.join(self.directory, col['vocabulary_file']))
+        return load(col['file'])
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @property
+    def sources(self):
+        """
+        :return: source node of each edge (built when first asked for)
+        """
+        if self._sources is None:
+            self._sources = np.repeat(np.arange(len(self.node_ids), dtype=self.indices.dtype), np.diff(self.indptr))
+        return self._sources
+
+    def node_index(self, node_id):
+        """
+        :param node_id: node id as in the nodes file
+        :return: node number
+        """
+        ni = int(np.searchsorted(self.node_ids, node_id))
+        if ni >= len(self.node_ids) or self.node_ids[ni] != node_id:
+            raise KeyError("Node %s is not in the graph." % node_id)
+        return ni
+
+    def out_edges(self, ni):
+        """
+        :param ni: node number
+        :return: tuple of (edge numbers, target node numbers) of the edges out of the node
+        """
+        start, stop = self.indptr[ni], self.indptr[ni + 1]
+        return np.arange(start, stop), self.indices[start:stop]
+
+    def edge_index(self, u, v):
+        """
+        :param u: node number of the source
+        :param v: node number of the target
+        :return: edge number of the edge from u to v
+        """
+        start, stop = int(self.indptr[u]), int(self.indptr[u + 1])
+        ei = start + int(np.searchsorted(self.indices[start:stop], v))
+        if ei >= stop or self.indices[ei] != v:
+            raise KeyError("No edge from node number %d to %d." % (u, v))
+        return ei
+
+    def node_value(self, name, ni):
+        return self._value(self.node_columns[name], ni)
+
+    def edge_value(self, name, ei):
+        return self._value(self.edge_columns[name], ei)
+
+    def _value(self, column, i):
+        if isinstance(column, tuple):
+            codes, vocabulary = column
+            return vocabulary[codes[i]]
+        return column[i].item()
+
+    def tve(self, ei):
+        """
+        :return: TVEdge handle of the edge's hourly weights
+        """
+        return self.tv_store.edge(ei)
+
+    def to_networkx(self):
+        """
+        Build the NetworkX DiGraph that was saved, with TVEdge handles into this graph's weights (for code written
+            against the graph pickle; the graph is held in memory).
+        :return: networkx.DiGraph
+        """
+        import networkx as nx
+        G = nx.DiGraph(name='Multimodal Routing Graph')
+        ids = self.node_ids.tolist()
+        for ni, nid in enumerate(ids):
+            G.add_node(nid, **{name: self.node_value(name, ni) for name in self.node_columns})
+        sources = self.sources
+        for ei in xrange(self.n_edges):
+            attrs = {name: self.edge_value(name, ei) for name in self.edge_columns}
+            if self.tv_store is not None:
+                attrs['tve'] = self.tve(ei)
+            G.add_edge(ids[sources[ei]], ids[self.indices[ei]], **attrs)
+        return G
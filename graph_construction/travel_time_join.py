@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import numpy as np
+
+impute_methods = ['previous_hour', 'day_of_week', 'edge_mean']
+
+
+def join_travel_times(store, edge_sources, edge_targets, begin, end, hours, travel_times,
+                      impute=('previous_hour', 'day_of_week'), max_carry_hours=2, default=None, chunk_edges=20000):
+    """
+    Put hourly link travel times into the edge weights of a TVEdgeStore, then fill the hours without records.
+        Records are matched to edges and (day, hour) slots in one vectorised pass: node ids are numbered by binary
+        search into the edges' sorted node ids, (source, target) pairs become single integer keys looked up in the
+        sorted edge keys, and each record's slot is its offset from the store's first day. Several records in one slot
+        are averaged.
+    :param store: TVEdgeStore, row i being the edge from edge_sources[i] to edge_targets[i]
+    :param edge_sources: array of the source node id of each edge (in row order)
+    :param edge_targets: array of the target node id of each edge
+    :param begin: array of the begin node id of each record
+    :param end: array of the end node id of each record
+    :param hours: datetime64 array of the hour of each record
+    :param travel_times: array of the travel time of each record
+    :param impute: methods filling missing hours, applied in order (see impute_weights(...))
+    :param max_carry_hours: most hours a travel time is carried forward by 'previous_hour'
+    :param default: weight of hours still missing after imputation - a number or an array of one per edge (e.g., from
+        the link length); None leaves them NaN
+    :param chunk_edges: edges imputed at a time, bounding temporary arrays
+    :return: ordered dictionary of coverage statistics
+    """
+    n_edges, n_days, n_hours = store.weights.shape
+    stats = OrderedDict([('records', len(begin))])
+    node_ids = np.unique(np.concatenate([edge_sources, edge_targets]))
+    n_nodes = np.int64(len(node_ids))
+    edge_keys = np.searchsorted(node_ids, edge_sources).astype(np.int64) * n_nodes + \
+        np.searchsorted(node_ids, edge_targets)
+    key_order = np.argsort(edge_keys, kind='mergesort')
+    sorted_keys = edge_keys[key_order]
+
+    # records whose nodes aren't both in the graph can't match an edge
+    bi, ei = np.searchsorted(node_ids, begin), np.searchsorted(node_ids, end)
+    bi[bi >= n_nodes], ei[ei >= n_nodes] = 0, 0
+    matched = (node_ids[bi] == begin) & (node_ids[ei] == end)
+    record_keys = bi.astype(np.int64) * n_nodes + ei
+    pos = np.searchsorted(sorted_keys, record_keys)
+    pos[pos >= len(sorted_keys)] = 0
+    matched &= sorted_keys[pos] == record_keys if len(sorted_keys) else False
+    stats['records without an edge'] = int((~matched).sum())
+
+    day = (hours.astype('datetime64[D]') - np.datetime64(store.day0, 'D')).astype(np.int64)
+    inside = (day >= 0) & (day < n_days)
+    stats['records outside of the days'] = int((matched & ~inside).sum())
+    use = matched & inside & np.isfinite(travel_times)
+    hour = (hours.astype('datetime64[h]') - hours.astype('datetime64[D]')).astype(np.int64)
+    flat = (key_order[pos[use]].astype(np.int64) * n_days + day[use]) * n_hours + hour[use]
+    slots, inverse = np.unique(flat, return_inverse=True)
+    sums = np.bincount(inverse, weights=travel_times[use].astype(np.float64))
+    counts = np.bincount(inverse)
+    stats['records joined'] = int(use.sum())
+    stats['slots with several records'] = int((counts > 1).sum())
+
+    weights = store.weights.reshape(-1)
+    weights[:] = np.nan
+    weights[slots] = sums / counts
+    total = n_edges * n_days * n_hours
+    stats['edges'] = n_edges
+    stats['edges with records'] = len(np.unique(slots // (n_days * n_hours)))
+    stats['slots'] = total
+    stats['slots with records'] = len(slots)
+    for method, filled in impute_weights(store, impute, max_carry_hours=max_carry_hours, chunk_edges=chunk_edges):
+        stats['slots filled by ' + method] = filled
+    missing = np.isnan(store.weights)
+    n_missing = int(missing.sum())
+    if default is not None and n_missing:
+        fill = np.broadcast_to(np.asarray(default, dtype=np.float32).reshape(-1, 1, 1) if np.ndim(default) else
+                               np.float32(default), store.weights.shape)
+        store.weights[missing] = fill[missing]
+        stats['slots filled by default'] = n_missing
+        n_missing = int(np.isnan(store.weights).sum())
+    # after the default fill, so that the count is printed after the slots it filled
+    stats['slots missing'] = n_missing
+    return stats
+
+
+def impute_weights(store, methods, max_carry_hours=2, chunk_edges=20000):
+    """
+    Fill missing (NaN) hourly weights of a TVEdgeStore, a chunk of edges at a time.
+        - 'previous_hour': carry each edge's last travel time forward, up to max_carry_hours hours
+        - 'day_of_week': mean travel time of the edge at the same hour on the same weekday
+        - 'edge_mean': mean travel time of the edge over all hours
+    :param store: TVEdgeStore
+    :param methods: list of methods, applied in order
+    :param max_carry_hours: most hours a travel time is carried forward by 'previous_hour'
+    :param chunk_edges: edges imputed at a time
+    :return: list of (method, number of slots it filled)
+    """
+    for method in methods:
+        assert method in impute_methods, "Imputation method must be one of %s." % impute_methods
+    n_edges, n_days, n_hours = store.weights.shape
+    weekdays = (store.day0.weekday() + np.arange(n_days)) % 7
+    filled = [0] * len(methods)
+    for start in range(0, n_edges, chunk_edges):
+        chunk = store.weights[start:start + chunk_edges]
+        for mi, method in enumerate(methods):
+            before = np.isnan(chunk).sum()
+            if not before:
+                break
+            if method == 'previous_hour':
+                _carry_forward(chunk.reshape(len(chunk), n_days * n_hours), max_carry_hours)
+            elif method == 'day_of_week':
+                for wd in range(7):
+                    days = chunk[:, weekdays == wd]
+                    if not days.shape[1]:
+                        continue
+                    profile = _nanmean(days, axis=1)
+                    gaps = np.isnan(days)
+                    days[gaps] = np.broadcast_to(profile[:, np.newaxis, :], days.shape)[gaps]
+                    chunk[:, weekdays == wd] = days
+            elif method == 'edge_mean':
+                flat = chunk.reshape(len(chunk), -1)
+                mean = _nanmean(flat, axis=1)
+                gaps = np.isnan(flat)
+                flat[gaps] = np.broadcast_to(mean[:, np.newaxis], flat.shape)[gaps]
+            filled[mi] += int(before - np.isnan(chunk).sum())
+    return zip(methods, filled)
+
+
+def _nanmean(a, axis):
+    """
+    Mean ignoring NaN, NaN where there are no values (without numpy's warning for empty slices).
+    """
+    valid = ~np.isnan(a)
+    counts = valid.sum(axis=axis)
+    sums = np.where(valid, a, 0.).sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).astype(a.dtype)
+
+
+def _carry_forward(series, max_carry):
+    """
+    Carry values forward over NaN along the rows of a 2D array (in place), at most max_carry positions.
+    """
+    n = series.shape[1]
+    valid = ~np.isnan(series)
+    last = np.where(valid, np.arange(n), -1)
+    np.maximum.accumulate(last, axis=1, out=last)
+    carry = ~valid & (last >= 0) & (np.arange(n) - last <= max_carry)
+    rows = np.nonzero(carry)[0]
+    series[carry] = series[rows, last[carry]]
+    return
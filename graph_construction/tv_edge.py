@@ -1,43 +1,158 @@
 import datetime as dt
+import numpy as np
 from numpy.random import RandomState
 
 
-class TVEdge:
+class TVEdgeStore(object):
     """
+    Hourly weights of every time-variant ('day:hour') edge of a graph in one float32 array of shape (edges, days, 24),
+        day 0 being day0. Edges are handed out as TVEdge handles holding only their row index, so a graph holds one
+        array instead of a dict of dicts of floats per edge. Hours without a weight are NaN.
+    """
+    hours_per_day = 24
+
+    def __init__(self, n_edges, day0, n_days, fill=np.nan):
+        """
+        :param n_edges: number of edges (rows)
+        :param day0: date of the first day
+        :param n_days: number of days covered
+        :param fill: weight every hour starts with
+        :return: None
+        """
+        self.day0 = day0
+        self.n_days = n_days
+        self.weights = np.full((n_edges, n_days, self.hours_per_day), fill, dtype=np.float32)
+        self.count = 0
+
+    @classmethod
+    def from_array(cls, weights, day0):
+        """
+        Edge store over an existing (edges, days, 24) array of weights, e.g., memory-mapped from a saved graph. Every
+            row is taken, so no more edges can be added.
+        :param weights: array of hourly weights
+        :param day0: date of the first day
+        :return: TVEdgeStore
+        """
+        assert weights.ndim == 3 and weights.shape[2] == cls.hours_per_day, "Weights must have shape (edges, days, 24)."
+        store = cls.__new__(cls)
+        store.day0 = day0
+        store.n_days = weights.shape[1]
+        store.weights = weights
+        store.count = weights.shape[0]
+        return store
+
+    def __len__(self):
+        return self.weights.shape[0]
+
+    def add_edge(self, data_map=None):
+        """
+        Take the next row of the array for an edge.
+        :param data_map: (optional) dictionary of date -> dictionary of hour -> weight to fill the row with
+        :return: TVEdge handle of the row
+        """
+        assert self.count < len(self), "Edge store is full (%d edges)." % len(self)
+        ei = self.count
+        self.count += 1
+        if data_map:
+            for day, hours in data_map.items():
+                di = (day - self.day0).days
+                assert 0 <= di < self.n_days, "Date %s is outside of the edge store." % day
+                for h, w in hours.items():
+                    self.weights[ei, di, h] = w
+        return TVEdge(store=self, index=ei)
+
+    def edge(self, index):
+        """
+        :return: TVEdge handle of the edge at a row of the array
+        """
+        return TVEdge(store=self, index=index)
+
+    def slot(self, date_time):
+        """
+        :param date_time: date or datetime
+        :return: tuple of (day index, hour) of the array holding the time
+        """
+        day = date_time.date() if isinstance(date_time, dt.datetime) else date_time
+        di = (day - self.day0).days
+        if not 0 <= di < self.n_days:
+            raise KeyError("Date %s is outside of the edge store (%s + %d days)." % (day, self.day0, self.n_days))
+        return di, date_time.hour if isinstance(date_time, dt.datetime) else 0
+
+    def weight(self, index, date_time, how='last'):
+        """
+        Weight of an edge at a time, from the hour it falls in.
+        :param index: row of the edge
+        :param date_time: datetime
+        :param how: 'last' (the hour's weight), 'next' (the following hour's weight) or 'linear' (interpolated between
+            the two by the minutes past the hour)
+        :return: weight
+        """
+        di, h = self.slot(date_time)
+        if how == 'last':
+            return float(self.weights[index, di, h])
+        # the hour after 23:00 is the next day's first, taken from a day that is inside the store
+        ni, nh = (di, h + 1) if h + 1 < self.hours_per_day else (min(di + 1, self.n_days - 1), 0)
+        if how == 'next':
+            return float(self.weights[index, ni, nh])
+        elif how == 'linear':
+            w0 = float(self.weights[index, di, h])
+            m = float(self.weights[index, ni, nh]) - w0
+            return w0 + m * ((date_time.minute + date_time.second / 60.) / 60.)
+        else:
+            raise AttributeError("Invalid input for argument 'how'.")
 
+
+class TVEdge(object):
+    """
+    Time-variant weight of a graph edge. 'day:hour' edges are handles into a TVEdgeStore, 'day:schedule' edges hold a
+        list of times for each weekday (isoweekday() numbers), and edges that are not time-variant hold a float.
     """
-    def __init__(self, data_map, tv_type):
+    __slots__ = ('tv_type', 'store', 'index', 'data')
+
+    def __init__(self, data_map=None, tv_type='day:hour', store=None, index=None):
+        """
+        :param data_map: 'day:hour' - dictionary of date -> dictionary of hour -> weight (copied into a one-edge store
+            unless store is given), 'day:schedule' - dictionary of weekday number -> list of times, None - float weight
+        :param tv_type: 'day:hour', 'day:schedule' or None
+        :param store: TVEdgeStore holding the edge's weights ('day:hour')
+        :param index: row of the edge in the store
+        :return: None
+        """
         assert tv_type in ['day:hour', 'day:schedule', None], "Invalid time-variant type."
         self.tv_type = tv_type
-
-        assert type(data_map) in [dict, float], "Data must be a dictionary or float type."
-
-        # day_map = {'monday': 1, 'tuesday': 2, 'wednesday': 3, 'thursday': 4, 'friday': 5, 'saturday': 6, 'sunday': 7}
-        # assert all([k.lower() in day_map.keys() for k in data_map.keys()]), "Data input keys are not day names."
-        assert all([type(k) is dt.date for k in data_map.keys()]), "Data input keys are not date objects."
-        if self.tv_type == 'day:hour':
-            assert all([type(v) is dict for v in data_map.values()]), "day:hour type takes data as dict of dicts."
-        elif self.tv_type == 'day:schedule':
-            assert all([type(v) is list for v in data_map.values()]), "day:schedule type takes data as dict of lists."
-        elif self.tv_type is None:
+        self.store = store
+        self.index = index
+        self.data = None
+        if tv_type == 'day:hour' and store is None:
+            assert type(data_map) is dict, "day:hour type takes data as dict of dicts."
+            days = sorted(data_map.keys())
+            edge = TVEdgeStore(n_edges=1, day0=days[0], n_days=(days[-1] - days[0]).days + 1).add_edge(data_map)
+            self.store, self.index = edge.store, edge.index
+        elif tv_type == 'day:schedule':
+            assert type(data_map) is dict, "day:schedule type takes data as dict of lists."
+            self.data = data_map
+        elif tv_type is None:
             assert type(data_map) is float, "If edge is not time-variant, data should be provided as a float."
-        # change dictionary keys to weekday numbers for compatibility with isoweekday() output
-        # verified that this will not interfere with objects shared between keys
-        # self.data = {day_map[k.lower()]: v for k, v in data_map.items()}
-        self.data = data_map
+            self.data = data_map
+
+    @property
+    def weights(self):
+        """
+        :return: (days, 24) view of the edge's hourly weights ('day:hour')
+        """
+        return self.store.weights[self.index]
 
-    def get_weight(self, date_time, how, error_magnitude=0., error_type=None):
+    def get_weight(self, date_time, how, error_magnitude=0., error_type=None, random_state=None):
+        """
+        :param date_time: datetime at which the edge is entered
+        :param how: for 'day:hour', 'last', 'next' or 'linear' (see TVEdgeStore.weight(...))
+        :param error_magnitude: (mean, standard deviation) for 'normal' error, (low, high) for 'uniform'
+        :param error_type: random error added to the weight - 'normal'/'gaussian', 'uniform' or None
+        :param random_state: numpy RandomState drawing the error (default = a new one)
+        :return: weight
+        """
         if self.tv_type == 'day:hour':
-            if how == 'linear':
-                day = date_time.date()
-                m = (self.data[day][date_time.hour + 1] - self.data[day][date_time.hour])
-                w = self.data[day][date_time.hour] + m * (date_time.minutes / 60)
-            elif how == 'last':
-                w = self.data[date_time.day()][date_time.hour]
-            elif how == 'next':
-                w = self.data[date_time.day()][date_time.hour + 1]
-            else:
-                raise AttributeError("Invalid input for argument 'how'.")
+            w = self.store.weight(self.index, date_time, how)
         elif self.tv_type == 'day:schedule':
             w = min([t - date_time.time() for t in self.data[date_time.isoweekday()] if t > date_time.time()])
         elif self.tv_type is None:
@@ -45,10 +160,13 @@ class TVEdge:
         else:
             raise TypeError("Time variance type corrupted.")
 
+        if error_type is None:
+            return w
+        rs = random_state if random_state is not None else RandomState()
         if error_type.lower() in ['normal', 'gaussian']:
-            w += RandomState.normal(loc=error_magnitude[0], scale=error_magnitude[1])
+            w += rs.normal(loc=error_magnitude[0], scale=error_magnitude[1])
         elif error_type.lower() == 'uniform':
-            w += RandomState.uniform(low=error_magnitude[0], high=error_magnitude[1])
+            w += rs.uniform(low=error_magnitude[0], high=error_magnitude[1])
         else:
             pass
 
@@ -0,0 +1,159 @@
+import googlemaps
+import threading
+import time
+import datetime as dt
+from googlemaps_query_util import TokenBucket
+
+
+class KeyClient(googlemaps.Client):
+    """
+    googlemaps.Client that notes, for each calling thread, whether its call got an OVER_QUERY_LIMIT response. The
+        client retries those until retry_timeout and then raises Timeout, the same as for a request that timed out on
+        the network, so this tells the two apart.
+    """
+    def __init__(self, *args, **kwargs):
+        googlemaps.Client.__init__(self, *args, **kwargs)
+        self.last_call = threading.local()
+
+    def _get_body(self, resp):
+        try:
+            return googlemaps.Client._get_body(self, resp)
+        except googlemaps.exceptions._RetriableRequest:
+            # raised for OVER_QUERY_LIMIT, which the client then retries
+            self.last_call.over_query_limit = True
+            raise
+
+    def over_query_limit(self):
+        """
+        :return: T/F the calling thread's last call got OVER_QUERY_LIMIT
+        """
+        return getattr(self.last_call, 'over_query_limit', False)
+
+    def request(self, service, *args, **kwargs):
+        """
+        Call a googlemaps.Client function, first clearing the calling thread's OVER_QUERY_LIMIT note.
+        """
+        self.last_call.over_query_limit = False
+        return getattr(self, service)(*args, **kwargs)
+
+
+class KeyPool(object):
+    """
+    Several Google Maps API keys used as one client. Each call goes to the key with the most headroom: the most daily
+        quota left for that service, then the most tokens in its queries-per-second bucket, then the least used. A key
+        that comes back OVER_QUERY_LIMIT is rested (for a minute, doubling on repeats up to an hour) and the call is
+        retried on another key. A call that times out on the network is raised without resting its key. Provides the
+        directions, distance_matrix and places calls of googlemaps.Client, so it can stand in for one.
+    Quotas are counted per key and per service ('directions', 'distance_matrix', 'places') and reset each local day.
+    """
+    backoff_start = 60.
+    backoff_max = 3600.
+
+    def __init__(self, keys, queries_per_second=1, quotas=None, retry_timeout=10):
+        """
+        :param keys: list of decoded API keys
+        :param queries_per_second: rate limit for each key
+        :param quotas: dictionary of service name to daily requests allowed per key (services not given are unlimited)
+        :param retry_timeout: seconds a client keeps retrying OVER_QUERY_LIMIT on one key before the pool fails over
+        :return: None
+        """
+        assert keys, "Key pool needs at least one API key."
+        self.clients = [KeyClient(key=k, queries_per_second=queries_per_second, retry_timeout=retry_timeout)
+                        for k in keys]
+        self.buckets = [TokenBucket(rate=queries_per_second) for _ in keys]
+        self.quotas = quotas if quotas else {}
+        self.usage = [{} for _ in keys]
+        self.over_limit = [0 for _ in keys]
+        self.rest_until = [0. for _ in keys]
+        self.day = dt.date.today()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.clients)
+
+    def directions(self, *args, **kwargs):
+        return self.request('directions', *args, **kwargs)
+
+    def distance_matrix(self, *args, **kwargs):
+        return self.request('distance_matrix', *args, **kwargs)
+
+    def places(self, *args, **kwargs):
+        return self.request('places', *args, **kwargs)
+
+    def headroom(self, ki, service):
+        """
+        :return: requests left today on key ki for the service (float('inf') if it has no quota)
+        """
+        if service not in self.quotas or self.quotas[service] is None:
+            return float('inf')
+        return self.quotas[service] - self.usage[ki].get(service, 0)
+
+    def _choose(self, service, exclude):
+        """
+        Pick the key to use for a call and count the call against it, waiting if every usable key is resting.
+        :param service: name of the service called
+        :param exclude: set of key indices that already failed this call
+        :return: index of the key
+        """
+        while True:
+            with self.lock:
+                if dt.date.today() != self.day:
+                    self.day = dt.date.today()
+                    self.usage = [{} for _ in self.clients]
+                usable = [ki for ki in range(len(self.clients))
+                          if ki not in exclude and self.headroom(ki, service) > 0]
+                if not usable:
+                    raise googlemaps.exceptions.ApiError('OVER_QUERY_LIMIT',
+                                                         "No key in the pool has %s quota left." % service)
+                now = time.time()
+                ready = [ki for ki in usable if self.rest_until[ki] <= now]
+                if ready:
+                    ki = max(ready, key=lambda k: (self.headroom(k, service), self.buckets[k].available(),
+                                                   -self.usage[k].get(service, 0), -k))
+                    self.usage[ki][service] = self.usage[ki].get(service, 0) + 1
+                    return ki
+                wait = min([self.rest_until[k] for k in usable]) - now
+            time.sleep(wait)
+
+    def request(self, service, *args, **kwargs):
+        """
+        Make a call on the key with the most headroom, failing over to the other keys on OVER_QUERY_LIMIT.
+        :param service: name of the googlemaps.Client function to call
+        :return: result of the call
+        """
+        tried = set()
+        while True:
+            ki = self._choose(service, exclude=tried)
+            self.buckets[ki].acquire()
+            try:
+                result = self.clients[ki].request(service, *args, **kwargs)
+            except (googlemaps.exceptions.ApiError, googlemaps.exceptions.Timeout) as e:
+                # the client retries OVER_QUERY_LIMIT itself until retry_timeout, then raises Timeout - other timeouts
+                #   (network) say nothing about the key's quota
+                if isinstance(e, googlemaps.exceptions.ApiError) and e.status != 'OVER_QUERY_LIMIT':
+                    raise
+                if isinstance(e, googlemaps.exceptions.Timeout) and not self.clients[ki].over_query_limit():
+                    raise
+                with self.lock:
+                    self.over_limit[ki] += 1
+                    self.rest_until[ki] = time.time() + min(self.backoff_start * 2 ** (self.over_limit[ki] - 1),
+                                                            self.backoff_max)
+                print "Key %d over query limit on %s, resting it and failing over." % (ki, service)
+                tried.add(ki)
+                if len(tried) == len(self.clients):
+                    raise
+                continue
+            with self.lock:
+                self.over_limit[ki] = 0
+            return result
+
+    def summary(self):
+        """
+        :return: list of strings describing today's usage of each key
+        """
+        lines = []
+        with self.lock:
+            for ki in range(len(self.clients)):
+                used = ', '.join(["%s %d" % (s, n) for s, n in sorted(self.usage[ki].items())])
+                lines.append("Key %d: %s" % (ki, used if used else 'unused'))
+        return lines
@@ -0,0 +1,220 @@
+from googlemaps_query_util import *
+from googlemaps_api_mining import GooglemapsAPIMiner
+from replay_client import ReplayClient
+import csv
+import datetime as dt
+import getopt
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+
+class NullWriter(object):
+    def write(self, obj):
+        pass
+
+    def flush(self):
+        pass
+
+
+def shift_to_future(queries, margin=dt.timedelta(hours=2)):
+    """
+    Move query times forward by whole weeks until they are in the future, keeping the day of week and time of day, so
+        that recorded inputs can be executed again.
+    :param queries: list of queries (updated in place)
+    :param margin: how far in the future the earliest time must end up
+    :return: None
+    """
+    earliest = localize_to_my_timezone(dt.datetime.now()) + margin
+    for q in queries:
+        for tt in ['departure_time', 'arrival_time']:
+            if tt in q and type(q[tt]) is dt.datetime and q[tt] < earliest:
+                weeks = (earliest - q[tt]).days // 7 + 1
+                q[tt] = convert_to_my_timezone(q[tt] + dt.timedelta(weeks=weeks))
+    return
+
+
+def percentile(values, p):
+    """
+    :param values: list of numbers
+    :param p: percentile [0, 100]
+    :return: value at the percentile (nearest rank), None if values is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(round(p / 100. * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def max_rss_mb():
+    """
+    :return: peak resident memory of this process in MB (ru_maxrss is in KB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_benchmark(input_filename, replay_pickles, init_args=None, client_args=None, verbose=False):
+    """
+    Time reading, executing and writing out an input file against a ReplayClient, as in run_pipeline(...).
+    :param input_filename: query input file
+    :param replay_pickles: list of output pickles to replay responses from
+    :param init_args: dictionary of GooglemapsAPIMiner arguments (api_key_file is not used)
+    :param client_args: dictionary of ReplayClient arguments (latency, error rates, seed)
+    :param verbose: T/F show the miner's output
+    :return: dictionary of measurements
+    """
+    init_args = dict(init_args if init_args else {}, api_key_file=None, execute_in_time=False)
+    client = ReplayClient(replay_pickles, **(client_args if client_args else {}))
+    output_dir = tempfile.mkdtemp()
+    original_stdout = sys.stdout
+    if not verbose:
+        sys.stdout = NullWriter()
+    try:
+        g = GooglemapsAPIMiner(**init_args)
+        g.gmaps = client
+        t0 = time.time()
+        g.read_input_queries(input_filename=input_filename)
+        shift_to_future(g.queries)
+        t1 = time.time()
+        g.run_queries()
+        t2 = time.time()
+        g.output_results(output_filename=output_dir + '/benchmark', write_csv=True, write_pickle=True)
+        t3 = time.time()
+    finally:
+        sys.stdout = original_stdout
+        shutil.rmtree(output_dir)
+    executed = sum(client.calls.values())
+    # results of split transit are in groups of [id stub, result, ...]
+    results = [r for res in g.results for r in res[1:]] if g.split_transit else g.results
+    return {'directions_queries': g.directions_query_count, 'results': len(g.results),
+            'api_calls': executed, 'calls': client.calls, 'matrix_elements': client.matrix_elements,
+            'matrix_results': len([res for res in results if recursive_get(res, (0, 'summary')) == 'Distance Matrix']),
+            'read_sec': t1 - t0, 'run_sec': t2 - t1, 'output_sec': t3 - t2,
+            'queries_per_sec': g.directions_query_count / (t2 - t1) if t2 > t1 else 0.,
+            'calls_per_sec': executed / (t2 - t1) if t2 > t1 else 0.,
+            'p50_sec': percentile(client.latencies, 50), 'p99_sec': percentile(client.latencies, 99),
+            'max_rss_mb': max_rss_mb()}
+
+
+def check_matrix_billing(replay_pickles, verbose=False):
+    """
+    Check that packing queries into Distance Matrix requests bills no element without a query for it, on inputs of
+        unrelated origin/destination pairs, of pairs listed by origin, and of an origin/destination grid range.
+    :param replay_pickles: list of output pickles to replay responses from (with driving results)
+    :return: list of (input name, queries, Distance Matrix calls, elements billed, results from Distance Matrix)
+    """
+    header = ['origin', 'destination', 'mode', 'timezone', 'departure_time']
+    grid = ['origin_min', 'origin_max', 'origin_count', 'origin_arrange',
+            'destination_min', 'destination_max', 'destination_count', 'destination_arrange']
+    departure = ['driving', 'eastern', '01/05/2030 08:00']
+    inputs = {'unrelated_pairs': (header, [["40.%03d;-74.%03d" % (700 + i, 10 + 3 * i),
+                                            "40.%03d;-73.%03d" % (600 + 7 * i, 900 + i)] + departure
+                                           for i in range(12)]),
+              'pairs_by_origin': (header, [["40.%03d;-74.000" % (700 + i), "40.600;-73.%03d" % (900 + j)] + departure
+                                           for i in range(3) for j in range(4)]),
+              'grid_range': (['mode', 'timezone', 'departure_time'] + grid,
+                             [departure + ['40.7;-74.0', '40.8;-73.9', '3;2', 'grid',
+                                           '40.6;-73.9', '40.7;-73.8', '2;2', 'grid']])}
+    input_dir = tempfile.mkdtemp()
+    checked = []
+    try:
+        for name, (columns, rows) in sorted(inputs.items()):
+            input_filename = os.path.join(input_dir, name + '.csv')
+            with open(input_filename, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(rows)
+            m = run_benchmark(input_filename=input_filename, replay_pickles=replay_pickles,
+                              init_args={'queries_per_second': 1000, 'distance_matrix': True},
+                              client_args={'latency': 0., 'seed': 0}, verbose=verbose)
+            checked.append((name, m['results'], m['calls'].get('distance_matrix', 0), m['matrix_elements'],
+                            m['matrix_results']))
+            assert m['matrix_elements'] == m['matrix_results'], \
+                "%s: %d Distance Matrix elements billed for %d results." % (name, m['matrix_elements'],
+                                                                            m['matrix_results'])
+    finally:
+        shutil.rmtree(input_dir)
+    return checked
+
+
+def print_report(name, m):
+    print name
+    print "\tqueries executed:  %d Directions, %d results (%d API calls: %s)" % \
+          (m['directions_queries'], m['results'], m['api_calls'],
+           ', '.join(["%s %d" % (k, v) for k, v in sorted(m['calls'].items())]))
+    if m['matrix_elements']:
+        print "\tDistance Matrix:   %d elements billed for %d results" % (m['matrix_elements'], m['matrix_results'])
+    print "\tread/run/output:   %.3f / %.3f / %.3f sec" % (m['read_sec'], m['run_sec'], m['output_sec'])
+    print "\tthroughput:        %.2f queries/sec, %.2f calls/sec" % (m['queries_per_sec'], m['calls_per_sec'])
+    if m['p50_sec'] is not None:
+        print "\tcall latency:      p50 %.1f ms, p99 %.1f ms" % (m['p50_sec'] * 1000., m['p99_sec'] * 1000.)
+    print "\tpeak memory:       %.1f MB" % m['max_rss_mb']
+
+
+if __name__ == '__main__':
+    usage = """
+    usage: miner_benchmark.py -i <input_filename> -r <replay_pickles>
+            --[latency, latency_jitter, error_rate, over_query_limit_rate, seed, split_transit, queries_per_second,
+                concurrent_requests, distance_matrix, repeat, verbose, check_matrix]
+    ex: python miner_benchmark.py -i "./test_queries.csv" -r "./output_test_queries.cpkl" --split_transit True
+    note: -r takes a |-delimited list of output pickles whose responses are replayed; no API quota is used
+    note: query times in the past are moved forward by whole weeks so that recorded inputs can be executed
+    note: --check_matrix True checks that Distance Matrix packing bills one element per query on built-in inputs
+    """
+    input_filename = './test_queries.csv'
+    replay_pickles = ['./output_test_queries.cpkl']
+    init_args = {'queries_per_second': 50}
+    client_args = {'seed': 0}
+    repeat = 1
+    verbose = False
+    check_matrix = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hi:r:",
+                                   ["latency=", "latency_jitter=", "error_rate=", "over_query_limit_rate=", "seed=",
+                                    "split_transit=", "queries_per_second=", "concurrent_requests=",
+                                    "distance_matrix=", "repeat=", "verbose=", "check_matrix="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print usage
+            sys.exit(0)
+        elif opt == "-i":
+            input_filename = arg
+        elif opt == "-r":
+            replay_pickles = arg.split('|')
+        elif opt in ["--latency", "--latency_jitter", "--error_rate", "--over_query_limit_rate"]:
+            client_args[opt[2:]] = float(arg)
+        elif opt == "--seed":
+            client_args['seed'] = int(arg)
+        elif opt in ["--queries_per_second", "--concurrent_requests"]:
+            init_args[opt[2:]] = int(arg)
+        elif opt in ["--split_transit", "--distance_matrix", "--verbose", "--check_matrix"]:
+            if arg.lower() not in ['true', 'false']:
+                print opt, "should be [True/False/TRUE/FALSE/true/false]"
+                sys.exit(2)
+            if opt == "--verbose":
+                verbose = arg.lower() == 'true'
+            elif opt == "--check_matrix":
+                check_matrix = arg.lower() == 'true'
+            else:
+                init_args[opt[2:]] = arg.lower() == 'true'
+        elif opt == "--repeat":
+            repeat = int(arg)
+
+    if check_matrix:
+        print "%-18s %8s %12s %10s %14s" % ('input', 'queries', 'matrix calls', 'elements', 'matrix results')
+        for row in check_matrix_billing(replay_pickles, verbose=verbose):
+            print "%-18s %8d %12d %10d %14d" % row
+        print "Distance Matrix billing check passed."
+        sys.exit(0)
+    print "Benchmarking", input_filename, "replaying", ', '.join(replay_pickles)
+    print "Miner:", init_args
+    print "Client:", client_args
+    for ri in range(repeat):
+        print_report("Run %d:" % (ri + 1), run_benchmark(input_filename=input_filename, replay_pickles=replay_pickles,
+                                                         init_args=init_args, client_args=client_args,
+                                                         verbose=verbose))
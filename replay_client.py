@@ -0,0 +1,153 @@
+import cPickle
+import random
+import threading
+import time
+import googlemaps
+from copy import deepcopy
+from googlemaps_query_util import LocationIndex, recursive_get
+
+
+class ReplayClient(object):
+    """
+    Stand-in for googlemaps.Client that answers Directions, Distance Matrix and Places calls from results recorded in
+        output_*.cpkl pickles, so mining can be exercised and timed without using API quota. Each call waits for a
+        configurable latency and can fail at random with an error or OVER_QUERY_LIMIT, raised as googlemaps would.
+    Directions responses are matched on (origin, destination, mode) when the pickle holds its queries, otherwise
+        recorded responses of the same travel mode are handed out in turn. Places searches return the nearest station
+        recorded in the pickle's split cache, or a made-up station at the search location.
+    """
+    def __init__(self, pickle_filenames, latency=0.1, latency_jitter=0.5, error_rate=0., over_query_limit_rate=0.,
+                 seed=None):
+        """
+        :param pickle_filenames: list of output pickles written by GooglemapsAPIMiner.output_results(...) (current dict
+            format, or older lists of results or of split result groups)
+        :param latency: mean seconds each call waits
+        :param latency_jitter: fraction of latency by which each call varies (uniformly, +/-)
+        :param error_rate: fraction of calls that raise a transport error
+        :param over_query_limit_rate: fraction of calls that raise ApiError('OVER_QUERY_LIMIT')
+        :param seed: random seed, for repeatable runs
+        :return: None
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.over_query_limit_rate = over_query_limit_rate
+        self.random = random.Random(seed)
+        self.by_query = {}
+        self.by_mode = {}
+        self.stations = {}
+        for fn in pickle_filenames:
+            with open(fn, 'rb') as f:
+                self._load(cPickle.load(f))
+        self.station_index = LocationIndex(self.stations.keys())
+        self.next_by_mode = {m: 0 for m in self.by_mode}
+        self.lock = threading.Lock()
+        # per-service call counts (including calls that raised) and the time each answered call took (seconds)
+        self.calls = {}
+        self.latencies = []
+        # Distance Matrix elements requested (origins x destinations of each call), as they would be billed
+        self.matrix_elements = 0
+
+    def _load(self, recorded):
+        if isinstance(recorded, dict):
+            results, queries = recorded['results'], recorded.get('queries')
+            self.stations.update(recorded.get('split_cache', {}))
+        else:
+            results, queries = recorded, None
+        if results and isinstance(results[0], list) and results[0] and isinstance(results[0][0], str):
+            # split transit results are grouped as [id stub, result, result, ...] - queries are matched by id
+            if queries:
+                by_id = {q['id']: q for q in queries}
+                for group in results:
+                    ids = [group[0] + '-0'] if group[0].endswith('0000') else [group[0] + '-1', group[0] + '-2']
+                    for qid, res in zip(ids, group[1:]):
+                        self._add(res, by_id.get(qid))
+            else:
+                for group in results:
+                    for res in group[1:]:
+                        self._add(res, None)
+        else:
+            for qi, res in enumerate(results):
+                self._add(res, queries[qi] if queries and qi < len(queries) else None)
+
+    def _add(self, res, query):
+        if not res:
+            return
+        steps = recursive_get(res, (0, 'legs', 0, 'steps'))
+        if not steps:
+            return
+        modes = [st['travel_mode'].lower() for st in steps]
+        mode = 'transit' if 'transit' in modes else modes[0]
+        self.by_mode.setdefault(mode, []).append(res)
+        if query is not None:
+            self.by_query[(str(query['origin']), str(query['destination']), query['mode'])] = res
+
+    def _call(self, service):
+        """
+        Count a call, wait for its latency, and raise an injected failure if one comes up.
+        :return: time the call started
+        """
+        start = time.time()
+        with self.lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+            wait = max(self.latency * (1. + self.latency_jitter * (2. * self.random.random() - 1.)), 0.)
+            roll = self.random.random()
+        time.sleep(wait)
+        if roll < self.over_query_limit_rate:
+            raise googlemaps.exceptions.ApiError('OVER_QUERY_LIMIT', "Injected by ReplayClient.")
+        if roll < self.over_query_limit_rate + self.error_rate:
+            raise googlemaps.exceptions.TransportError("Injected by ReplayClient.")
+        return start
+
+    def _done(self, start):
+        with self.lock:
+            self.latencies.append(time.time() - start)
+
+    def _directions(self, origin, destination, mode):
+        key = (str(origin), str(destination), mode)
+        if key in self.by_query:
+            return deepcopy(self.by_query[key])
+        if not self.by_mode.get(mode):
+            return []
+        with self.lock:
+            res = self.by_mode[mode][self.next_by_mode[mode] % len(self.by_mode[mode])]
+            self.next_by_mode[mode] += 1
+        return deepcopy(res)
+
+    def directions(self, origin, destination, mode='driving', **kwargs):
+        start = self._call('directions')
+        res = self._directions(origin, destination, mode)
+        self._done(start)
+        return res
+
+    def distance_matrix(self, origins, destinations, mode='driving', **kwargs):
+        start = self._call('distance_matrix')
+        with self.lock:
+            self.matrix_elements += len(origins) * len(destinations)
+        rows = []
+        for o in origins:
+            elements = []
+            for d in destinations:
+                leg = recursive_get(self._directions(o, d, mode), (0, 'legs', 0))
+                if leg:
+                    element = {'status': 'OK', 'distance': leg['distance'], 'duration': leg['duration']}
+                    if 'duration_in_traffic' in leg:
+                        element['duration_in_traffic'] = leg['duration_in_traffic']
+                else:
+                    element = {'status': 'ZERO_RESULTS'}
+                elements.append(element)
+            rows.append({'elements': elements})
+        self._done(start)
+        return {'status': 'OK', 'rows': rows, 'origin_addresses': [str(o) for o in origins],
+                'destination_addresses': [str(d) for d in destinations]}
+
+    def places(self, query, location=None, type=None, **kwargs):
+        start = self._call('places')
+        found = self.station_index.nearest(lat=location[0], lng=location[1], radius=1.)
+        if found is None:
+            name, loc = "Station %.4f %.4f" % (location[0], location[1]), location
+        else:
+            name, loc = self.stations[found[1]], found[1]
+        self._done(start)
+        return {'status': 'OK', 'results': [{'name': name, 'types': [type],
+                                             'geometry': {'location': {'lat': loc[0], 'lng': loc[1]}}}]}
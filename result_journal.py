@@ -0,0 +1,129 @@
+import cPickle
+import os
+
+
+class ResultJournal(object):
+    """
+    Append-only journal of query results and the split transit bookkeeping needed to resume an interrupted run.
+        Each record is pickled on its own as it happens, so checkpointing costs the same regardless of how long the run
+        has been going. A crash can only leave a partial final record, which is dropped when the journal is replayed.
+    Record types (tuples):
+        ('result', query id, query, result) - a query was executed
+        ('query', query) - a split query was added or its time was set
+        ('remove', query id) - a split query was removed (its pair had an empty result)
+        ('stations', polyline, stations, reverse lookup, places query count) - stations were found for a transit leg
+    """
+    fsync_policies = ['always', 'batch', 'never']
+
+    def __init__(self, filename, fsync='batch'):
+        """
+        :param filename: path of the journal file
+        :param fsync: when to force records to disk - 'always' (every record), 'batch' (when sync() is called, i.e.,
+            after each group of executed queries), 'never' (leave it to the operating system); records are always
+            flushed from Python's buffer as they are written
+        :return: None
+        """
+        assert fsync in self.fsync_policies, "Journal fsync policy must be one of %s." % self.fsync_policies
+        self.filename = filename
+        self.fsync = fsync
+        self.f = None
+        self.valid_length = 0
+
+    def replay(self):
+        """
+        Read the journal back, stopping at the first record that can't be unpickled (the tail of a crashed write).
+        :return: generator of records in the order they were written
+        """
+        self.valid_length = 0
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            while True:
+                try:
+                    record = cPickle.load(f)
+                except (EOFError, cPickle.UnpicklingError, ValueError, KeyError, IndexError, AttributeError,
+                        ImportError, TypeError):
+                    break
+                self.valid_length = f.tell()
+                yield record
+
+    def open(self, append=False):
+        """
+        Open the journal for writing.
+        :param append: T/F keep records already in the file (resuming) - a partial final record is truncated first
+        :return: None
+        """
+        if append and os.path.exists(self.filename):
+            for _ in self.replay():
+                pass
+            with open(self.filename, 'r+b') as f:
+                f.truncate(self.valid_length)
+            self.f = open(self.filename, 'ab')
+        else:
+            self.f = open(self.filename, 'wb')
+        return
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+        return
+
+    def sync(self):
+        """
+        Force written records to disk under the 'batch' policy.
+        :return: None
+        """
+        if self.f is not None and self.fsync == 'batch':
+            os.fsync(self.f.fileno())
+        return
+
+    def write_result(self, qid, query, result):
+        """
+        :return: bytes written (None if not written to a file)
+        """
+        return self._write(('result', qid, query, result))
+
+    def write_query(self, query):
+        self._write(('query', query))
+
+    def write_removal(self, qid):
+        self._write(('remove', qid))
+
+    def write_stations(self, polyline, stations, reverse_lookup, places_queries):
+        self._write(('stations', polyline, stations, reverse_lookup, places_queries))
+
+    def _write(self, record):
+        data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+        self.f.write(data)
+        self.f.flush()
+        if self.fsync == 'always':
+            os.fsync(self.f.fileno())
+        return len(data)
+
+
+class QueueJournal(ResultJournal):
+    """
+    Journal that puts its records on a multiprocessing queue instead of a file, so a coordinating process can merge the
+        results of worker processes as they complete (see GooglemapsAPIMiner.run_queries_on_workers).
+    """
+    def __init__(self, queue):
+        ResultJournal.__init__(self, filename=None, fsync='never')
+        self.queue = queue
+
+    def replay(self):
+        return iter([])
+
+    def open(self, append=False):
+        return
+
+    def close(self):
+        return
+
+    def sync(self):
+        return
+
+    def _write(self, record):
+        self.queue.put(record)
+        return
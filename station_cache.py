@@ -0,0 +1,65 @@
+import cPickle
+import sqlite3
+import datetime as dt
+
+
+class StationCache(object):
+    """
+    On-disk cache of the intermediate transit stations found along transit legs, so that Places searches are made only
+        once for a leg no matter how many processes or daily runs split it. Stored in a SQLite file in write-ahead log
+        mode, which lets the processes of a parallel run read it while one of them writes.
+    Entries are keyed on (encoded polyline of the transit leg, station type searched for) and hold the stations and
+        the reverse lookup from location to station name returned by find_intermediate_transit_stations(...).
+    """
+    def __init__(self, filename, timeout=30.):
+        """
+        :param filename: path of the SQLite file (created if it doesn't exist)
+        :param timeout: seconds to wait on another process holding the write lock
+        :return: None
+        """
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        # autocommit, so that each entry is visible to other processes as soon as it is written
+        self.conn = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stations (polyline TEXT NOT NULL, station_type TEXT NOT NULL, "
+                          "stations BLOB NOT NULL, reverse_lookup BLOB NOT NULL, places_queries INTEGER, "
+                          "created TEXT, PRIMARY KEY (polyline, station_type))")
+
+    def get(self, polyline, station_type):
+        """
+        Look up the stations for a transit leg, counting the hit or miss.
+        :param polyline: encoded polyline of the transit leg
+        :param station_type: Places type searched for (e.g., 'subway_station')
+        :return: tuple of (stations, reverse lookup), or None if not cached
+        """
+        row = self.conn.execute("SELECT stations, reverse_lookup FROM stations WHERE polyline = ? AND station_type = ?",
+                                (polyline, station_type)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cPickle.loads(str(row[0])), cPickle.loads(str(row[1]))
+
+    def put(self, polyline, station_type, stations, reverse_lookup, places_queries=0):
+        """
+        Store the stations found for a transit leg, replacing any earlier entry.
+        :param places_queries: number of Places searches it took to find them
+        :return: None
+        """
+        self.conn.execute("INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?, ?, ?)",
+                          (polyline, station_type,
+                           sqlite3.Binary(cPickle.dumps(stations, cPickle.HIGHEST_PROTOCOL)),
+                           sqlite3.Binary(cPickle.dumps(reverse_lookup, cPickle.HIGHEST_PROTOCOL)),
+                           places_queries, dt.datetime.now().isoformat()))
+        return
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM stations").fetchone()[0]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        return
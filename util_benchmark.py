@@ -0,0 +1,325 @@
+import cPickle
+import csv
+import gc
+import getopt
+import glob
+import imp
+import inspect
+import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import googlemaps_query_util
+import googlemaps_api_mining
+
+# cells of the default CSV output of GooglemapsAPIMiner.output_results(...), read with recursive_get(...) for each row
+csv_outputs = [(0, 'legs', 0, 'distance', 'value'),
+               (0, 'legs', 0, 'duration', 'value'),
+               (0, 'legs', 0, 'duration_in_traffic', 'value'),
+               (0, 'legs', 0, 'start_location', 'lng'),
+               (0, 'legs', 0, 'start_location', 'lat'),
+               (0, 'legs', 0, 'end_location', 'lng'),
+               (0, 'legs', 0, 'end_location', 'lat')]
+
+
+def default_pickles():
+    return sorted(glob.glob('./results/*/*.cpkl') + glob.glob('./results/*/*/*.cpkl') +
+                  glob.glob('./results/*/*/*/*.cpkl') + glob.glob('./output_*.cpkl'))
+
+
+def load_fixtures(pickle_filenames, rows=1000, polylines=None):
+    """
+    Gather benchmark fixtures from recorded output pickles: the encoded polylines of every transit leg (as split
+        transit decodes them) and a result set of the given number of rows (recorded results repeated as needed).
+    :param pickle_filenames: list of output pickles written by GooglemapsAPIMiner.output_results(...)
+    :param rows: number of results in the result set
+    :param polylines: keep only this many of the longest polylines (all if None)
+    :return: dictionary of fixtures
+    """
+    results = []
+    encoded = []
+
+    def walk(obj):
+        if isinstance(obj, list) and obj and isinstance(obj[0], dict) and 'legs' in obj[0]:
+            results.append(obj)
+            for st in obj[0]['legs'][0]['steps']:
+                if st['travel_mode'] == 'TRANSIT':
+                    encoded.append(st['polyline']['points'])
+        elif isinstance(obj, list):
+            for o in obj:
+                walk(o)
+
+    for fn in pickle_filenames:
+        with open(fn, 'rb') as f:
+            recorded = cPickle.load(f)
+        walk(recorded['results'] if isinstance(recorded, dict) else recorded)
+    assert results and encoded, "No transit results found in the pickles given."
+    encoded = sorted(set(encoded), key=len, reverse=True)[:polylines]
+    return {'polylines': encoded, 'results': [results[i % len(results)] for i in range(rows)]}
+
+
+def write_input_fixture(input_filename, rows=40, points=5, departures=25):
+    """
+    Write an input file for GooglemapsAPIMiner.read_input_queries(...) whose rows are all range parameters: a grid of
+        origins around Manhattan and a range of departure times, alternating driving and transit rows.
+    :param input_filename: path of the CSV file to write
+    :param rows: number of input rows
+    :param points: number of origin points along each of latitude and longitude (points^2 origins per row)
+    :param departures: number of departure times per row (10 minutes apart)
+    :return: number of queries the input expands to
+    """
+    with open(input_filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['origin_min', 'origin_max', 'origin_count', 'origin_arrange', 'destination', 'mode',
+                         'timezone', 'departure_time_min', 'departure_time_max', 'departure_time_delta'])
+        for ri in range(rows):
+            writer.writerow(['%.4f;%.4f' % (40.70 + 0.001 * ri, -74.02), '%.4f;%.4f' % (40.80 + 0.001 * ri, -73.92),
+                             '%d;%d' % (points, points), 'grid', 'LaGuardia Airport',
+                             'transit' if ri % 2 else 'driving', 'eastern', '01/01/2030 %02d:00' % (6 + ri % 12),
+                             '01/01/2030 %02d:%02d' % (6 + ri % 12 + (departures - 1) // 6, (departures - 1) % 6 * 10),
+                             '10'])
+    return rows * points ** 2 * departures
+
+
+def input_cases(miner_mod, input_filename, queries):
+    """
+    Build the benchmark cases for reading and range-expanding an input file with one version of
+        GooglemapsAPIMiner.read_input_queries(...), timed per query the input expands to. The miner's own printing is
+        left out of the timing.
+    :param miner_mod: googlemaps_api_mining module (working tree or a loaded revision)
+    :param input_filename: input file from write_input_fixture(...)
+    :param queries: number of queries the input expands to
+    :return: list of (name, number of calls, function making all of the calls and returning their results)
+    """
+    def read(lazy):
+        g = miner_mod.GooglemapsAPIMiner(api_key_file=None)
+        old, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            if lazy:
+                g.read_input_queries(input_filename=input_filename, lazy=True)
+            else:
+                g.read_input_queries(input_filename=input_filename)
+        finally:
+            sys.stdout = old
+        return g.queries
+
+    cases = [('read_input_queries (expanded)', queries, lambda: read(False))]
+    if 'lazy' in inspect.getargspec(miner_mod.GooglemapsAPIMiner.read_input_queries).args:
+        cases.append(('read_input_queries (lazy)', queries, lambda: read(True)))
+    return cases
+
+
+def benchmark_cases(mod, fixtures):
+    """
+    Build the benchmark cases for one version of googlemaps_query_util. Inputs are prepared here, outside the timing,
+        and converted with the version's own functions so that each case times only the function it is named for.
+        Cases for functions a version doesn't have (e.g., batch forms added later) are left out.
+    :param mod: googlemaps_query_util module (working tree or a loaded revision)
+    :param fixtures: dictionary from load_fixtures(...)
+    :return: list of (name, number of calls, function making all of the calls and returning their results)
+    """
+    encoded = fixtures['polylines']
+    # plain float tuples for every version, so the scalar functions aren't timed on NumPy scalars
+    plines = [[tuple(p) for p in np.asarray(mod.decode_polyline(e)).tolist()] for e in encoded]
+    segments = [(p1, p2) for pl in plines for p1, p2 in zip(pl[:-1], pl[1:])]
+    # fractions used by find_intermediate_transit_stations(...) for the most stations it searches for
+    fracs = [(j + 1) * (1. / 6) for j in range(5)]
+    # a station just off the middle of each polyline, measured against every segment as in the station distance check
+    stations = [(pl[len(pl) // 2][0] + 0.0005, pl[len(pl) // 2][1] - 0.0005) for pl in plines]
+    station_segments = [(st, p1, p2) for st, pl in zip(stations, plines) for p1, p2 in zip(pl[:-1], pl[1:])]
+    results = fixtures['results']
+    cases = [('decode_polyline', len(encoded),
+              lambda: [mod.decode_polyline(e) for e in encoded])]
+    if hasattr(mod, 'decode_polylines'):
+        cases.append(('decode_polylines (batch)', len(encoded), lambda: mod.decode_polylines(encoded)))
+    cases.append(('line_interpolate_points', len(plines),
+                  lambda: [mod.line_interpolate_points(points=pl, fracs=fracs) for pl in plines]))
+    if hasattr(mod, 'line_interpolate_points_batch'):
+        coordinates, offsets = mod.decode_polylines(encoded)
+        cases.append(('line_interpolate_points_batch', len(plines),
+                      lambda: mod.line_interpolate_points_batch(coordinates, offsets, fracs)))
+    if hasattr(mod, 'point_to_polyline_distance'):
+        arrays = [np.array(pl) for pl in plines]
+        cases.append(('point_to_polyline_distance', len(plines),
+                      lambda: [mod.point_to_polyline_distance(points=[st], polyline=pl)
+                               for st, pl in zip(stations, arrays)]))
+    if hasattr(mod, 'haversine_array'):
+        seg_from, seg_to = np.array([p1 for p1, _ in segments]), np.array([p2 for _, p2 in segments])
+        cases.append(('haversine_array', len(segments),
+                      lambda: mod.haversine_array(seg_from[:, 1], seg_from[:, 0], seg_to[:, 1], seg_to[:, 0])))
+    if hasattr(mod, 'compile_getter'):
+        getters = [mod.compile_getter(oh) for oh in csv_outputs]
+        cases.append(('compile_getter (compiled)', len(results) * len(csv_outputs),
+                      lambda: [[getter(res) for getter in getters] for res in results]))
+    return cases + [
+        ('dist_to_segment', len(station_segments),
+         lambda: [mod.dist_to_segment(p1[1], p1[0], p2[1], p2[0], st[1], st[0]) for st, p1, p2 in station_segments]),
+        ('haversine', len(segments),
+         lambda: [mod.haversine(p1[1], p1[0], p2[1], p2[0]) for p1, p2 in segments]),
+        ('recursive_get', len(results) * len(csv_outputs),
+         lambda: [[mod.recursive_get(res, oh) for oh in csv_outputs] for res in results])]
+
+
+def deep_sizeof(obj):
+    """
+    :return: bytes held by obj and the lists, tuples and dicts within it (arrays count their own buffer)
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum([deep_sizeof(o) for o in obj])
+    elif isinstance(obj, dict):
+        size += sum([deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items()])
+    return size
+
+
+def time_case(function, calls, repeat=5):
+    """
+    Time a benchmark case, taking the best of several runs, and measure what one run allocates. CPython 2.7 has no
+        allocation tracer, so allocations are given as the garbage-collected objects (lists, tuples, dicts, arrays...)
+        created and the bytes held by the results.
+    :param function: function making all of the case's calls
+    :param calls: number of calls the function makes
+    :param repeat: number of timed runs
+    :return: dictionary of microseconds per call, objects created per call and bytes of results per call
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.time()
+        function()
+        best = min(best, time.time() - t0)
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        out = function()
+        objects = gc.get_count()[0] - before
+    finally:
+        gc.enable()
+    return {'usec': best / calls * 1e6, 'objects': float(objects) / calls, 'bytes': float(deep_sizeof(out)) / calls}
+
+
+def load_revision(revision, path='googlemaps_query_util.py'):
+    """
+    Load a module as it was at a git revision, alongside the working tree's version (its own imports, such as
+        googlemaps_api_mining's import of googlemaps_query_util, come from the working tree).
+    :param revision: any git revision (e.g., 'HEAD~3', a commit hash or a branch)
+    :param path: path of the module's file in the repository
+    :return: module
+    """
+    source = subprocess.check_output(['git', 'show', revision + ':' + path])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmp_dir, os.path.basename(path))
+        with open(fn, 'w') as f:
+            f.write(source)
+        name = os.path.splitext(os.path.basename(path))[0]
+        return imp.load_source(name + '_' + ''.join([c if c.isalnum() else '_' for c in revision]), fn)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run_benchmarks(mod, fixtures, repeat=5, miner_mod=None):
+    """
+    :param miner_mod: googlemaps_api_mining module to time reading the input fixture with (not timed if None)
+    :return: list of (case name, number of calls, measurements from time_case(...))
+    """
+    cases = benchmark_cases(mod, fixtures)
+    if miner_mod is not None:
+        cases += input_cases(miner_mod, fixtures['input_filename'], fixtures['input_queries'])
+    return [(name, calls, time_case(function, calls, repeat=repeat)) for name, calls, function in cases]
+
+
+def print_report(measured, baseline=None, names=('', '')):
+    if baseline is None:
+        print "%-30s %8s %12s %12s %12s" % ('function', 'calls', 'usec/call', 'objects/call', 'bytes/call')
+        for name, calls, m in measured:
+            print "%-30s %8d %12.3f %12.2f %12.1f" % (name, calls, m['usec'], m['objects'], m['bytes'])
+        return
+    print "%-30s %8s %12s %12s %8s %14s %14s" % ('function', 'calls', 'usec/call', '', 'speedup', 'objects/call',
+                                                 'bytes/call')
+    print "%-30s %8s %12s %12s %8s %14s %14s" % ('', '', names[0][:12], names[1][:12], '', 'base -> new',
+                                                 'base -> new')
+    base_measured = {name: b for name, _, b in baseline}
+    for name, calls, m in measured:
+        if name not in base_measured:
+            print "%-30s %8d %12s %12.3f" % (name, calls, '-', m['usec'])
+            continue
+        b = base_measured[name]
+        print "%-30s %8d %12.3f %12.3f %7.2fx %6.1f -> %-6.1f %6.0f -> %-6.0f" % \
+              (name, calls, b['usec'], m['usec'], b['usec'] / m['usec'] if m['usec'] else float('inf'),
+               b['objects'], m['objects'], b['bytes'], m['bytes'])
+
+
+if __name__ == '__main__':
+    usage = """
+    usage: util_benchmark.py -p <pickle_files> --[rows, polylines, input_rows, repeat, base, new]
+    ex: python util_benchmark.py --base HEAD~3
+    note: -p takes a |-delimited list of output pickles to draw fixtures from (default: all under ./results/)
+    note: --input_rows is the number of rows in the generated input file (625 queries each), 0 to skip timing it
+    note: --base and --new are git revisions of googlemaps_query_util.py and googlemaps_api_mining.py to compare (--new
+        defaults to the working tree)
+    """
+    pickle_filenames = default_pickles()
+    rows = 1000
+    polylines = None
+    input_rows = 40
+    repeat = 5
+    base = None
+    new = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:", ["rows=", "polylines=", "input_rows=", "repeat=",
+                                                         "base=", "new="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print usage
+            sys.exit(0)
+        elif opt == "-p":
+            pickle_filenames = arg.split('|')
+        elif opt == "--rows":
+            rows = int(arg)
+        elif opt == "--polylines":
+            polylines = int(arg)
+        elif opt == "--input_rows":
+            input_rows = int(arg)
+        elif opt == "--repeat":
+            repeat = int(arg)
+        elif opt == "--base":
+            base = arg
+        elif opt == "--new":
+            new = arg
+
+    fixtures = load_fixtures(pickle_filenames, rows=rows, polylines=polylines)
+    print "Fixtures: %d transit polylines (%d characters, %d points), %d result rows from %d pickles" % \
+          (len(fixtures['polylines']), sum([len(e) for e in fixtures['polylines']]),
+           sum([len(googlemaps_query_util.decode_polyline(e)) for e in fixtures['polylines']]),
+           len(fixtures['results']), len(pickle_filenames))
+    input_dir = tempfile.mkdtemp()
+    try:
+        if input_rows:
+            fixtures['input_filename'] = os.path.join(input_dir, 'input_fixture.csv')
+            fixtures['input_queries'] = write_input_fixture(fixtures['input_filename'], rows=input_rows)
+            print "Input fixture: %d rows of range parameters expanding to %d queries" % \
+                  (input_rows, fixtures['input_queries'])
+
+        def miner(revision):
+            if not input_rows:
+                return None
+            return load_revision(revision, path='googlemaps_api_mining.py') if revision else googlemaps_api_mining
+
+        new_mod = load_revision(new) if new else googlemaps_query_util
+        new_measured = run_benchmarks(new_mod, fixtures, repeat=repeat, miner_mod=miner(new))
+        if base:
+            print_report(new_measured, run_benchmarks(load_revision(base), fixtures, repeat=repeat,
+                                                      miner_mod=miner(base)),
+                         names=(base, new if new else 'working'))
+        else:
+            print_report(new_measured)
+    finally:
+        shutil.rmtree(input_dir)